@@ -0,0 +1,4 @@
+"""Benchmarks of gyimager, that run on synthetic data without casacore.
+
+Run with: python -m benchmarks.run --help
+"""
@@ -0,0 +1,200 @@
+"""Benchmarks of the numpy hot paths of gyimager.
+
+Each benchmark takes an Observation and the number of pixels along each image
+axis, performs its setup, and returns (run, work, unit): a function that runs
+the code under benchmark once, and the amount of work (in unit) that run
+processes.
+"""
+
+import numpy
+
+from gyimager.processors import imaging_weight
+from gyimager.processors import averaging
+from gyimager.processors import spans
+from gyimager.processors import reduction
+from gyimager.processors import gridding
+from gyimager.processors import image_domain_gridding
+from gyimager.processors.sparse_model import SparseModel
+from gyimager.algorithms import constants
+from gyimager.algorithms import major_cycle
+from gyimager.algorithms import restore
+
+BENCHMARKS = []
+
+def benchmark(function):
+    """Register a benchmark."""
+    BENCHMARKS.append((function.__name__, function))
+    return function
+
+class _Beam:
+    def __init__(self, major_axis, minor_axis, position_angle):
+        self.major_axis = major_axis
+        self.minor_axis = minor_axis
+        self.position_angle = position_angle
+
+def _residual(observation, n_pixel):
+    """Return a noise-like residual image and its weight."""
+    (shape, coordinates) = observation.image_configuration(n_pixel)
+    rng = numpy.random.RandomState(1)
+    residual = rng.randn(*shape)
+    weight = numpy.ones(shape[:2])
+    return (residual, weight)
+
+def _psf(observation, n_pixel):
+    """Return a Gaussian PSF with sidelobes."""
+    (shape, coordinates) = observation.image_configuration(n_pixel)
+    (y, x) = numpy.mgrid[:shape[2], :shape[3]]
+    r = numpy.hypot(y - shape[2] // 2, x - shape[3] // 2)
+    psf = numpy.exp(-numpy.square(r / 3.0)) + 0.05 * numpy.cos(r / 2.0) \
+        * numpy.exp(-r / 50.0)
+    return numpy.tile(psf, shape[:2] + (1, 1))
+
+@benchmark
+def density(observation, n_pixel):
+    (shape, coordinates) = observation.image_configuration(n_pixel)
+    def run():
+        imaging_weight.density(observation.uvw, observation.freqs,
+            observation.weight_spectrum, shape[2:],
+            coordinates.get_increment()[2])
+    return (run, observation.n_visibility(), "vis")
+
+@benchmark
+def weight_natural(observation, n_pixel):
+    weight = imaging_weight.ImagingWeight(weighttype = "natural")
+    def run():
+        weight.imaging_weight(observation.uvw, observation.freqs,
+            observation.flag, observation.weight_spectrum)
+    return (run, observation.n_visibility(), "vis")
+
+@benchmark
+def weight_robust(observation, n_pixel):
+    (shape, coordinates) = observation.image_configuration(n_pixel)
+    weight = imaging_weight.ImagingWeight(weighttype = "robust", rmode =
+        "normal", robustness = 0.0)
+    weight.set_density(imaging_weight.density(observation.uvw,
+        observation.freqs, observation.weight_spectrum, shape[2:],
+        coordinates.get_increment()[2]), coordinates)
+    def run():
+        weight.imaging_weight(observation.uvw, observation.freqs,
+            observation.flag, observation.weight_spectrum)
+    return (run, observation.n_visibility(), "vis")
+
+@benchmark
+def mapping_time_w(observation, n_pixel):
+    # W-planes of 100 wavelengths, as a stand-in for casaimwrap.w_index().
+    ref_freq = numpy.mean(observation.freqs)
+    w_index = numpy.round(numpy.abs(observation.uvw[:, 2]) * ref_freq
+        / constants.speed_of_light / 100.0).astype(int)
+    def run():
+        spans.make_mapping_time_w(observation.antenna1, observation.antenna2,
+            observation.uvw, observation.time, w_index, ref_freq, 300.0, 0.0,
+            1e6, 1e6)
+    return (run, observation.n_visibility(), "vis")
+
+def _w_step(observation, shape, coordinates):
+    w_max = observation.maximum_baseline_length() \
+        * numpy.max(observation.freqs) / constants.speed_of_light
+    return gridding.w_step(shape[2:], coordinates.get_increment()[2], w_max)
+
+@benchmark
+def grid_w_stacking(observation, n_pixel):
+    (shape, coordinates) = observation.image_configuration(n_pixel)
+    increment = coordinates.get_increment()[2]
+    w_step = _w_step(observation, shape, coordinates)
+    weight = numpy.where(numpy.any(observation.flag, axis=2), 0.0, 1.0)
+    def run():
+        gridder = gridding.WStackGridder(shape[2:], increment, 1.2, w_step,
+            observation.n_correlation)
+        gridder.add(observation.uvw, observation.freqs, observation.data,
+            weight)
+        gridder.image()
+    return (run, observation.n_visibility(), "vis")
+
+@benchmark
+def degrid_w_stacking(observation, n_pixel):
+    (shape, coordinates) = observation.image_configuration(n_pixel)
+    (residual, weight) = _residual(observation, n_pixel)
+    model = gridding.stokes_to_linear(residual[0], observation.n_correlation)
+    w_step = _w_step(observation, shape, coordinates)
+    def run():
+        degridder = gridding.WStackDegridder(model,
+            coordinates.get_increment()[2], 1.2, w_step)
+        degridder.predict(observation.uvw, observation.freqs)
+    return (run, observation.n_visibility(), "vis")
+
+@benchmark
+def grid_idg(observation, n_pixel):
+    (shape, coordinates) = observation.image_configuration(n_pixel)
+    increment = coordinates.get_increment()[2]
+    w_step = image_domain_gridding.w_step(shape[2:], increment, 1.2)
+    weight = numpy.where(numpy.any(observation.flag, axis=2), 0.0, 1.0)
+    def run():
+        gridder = image_domain_gridding.IDGGridder(shape[2:], increment, 1.2,
+            w_step, observation.n_correlation)
+        gridder.add(observation.uvw, observation.freqs, observation.data,
+            weight, observation.antenna1, observation.antenna2,
+            observation.time)
+        gridder.image()
+    return (run, observation.n_visibility(), "vis")
+
+@benchmark
+def degrid_idg(observation, n_pixel):
+    (shape, coordinates) = observation.image_configuration(n_pixel)
+    (residual, weight) = _residual(observation, n_pixel)
+    model = gridding.stokes_to_linear(residual[0], observation.n_correlation)
+    w_step = image_domain_gridding.w_step(shape[2:],
+        coordinates.get_increment()[2], 1.2)
+    def run():
+        degridder = image_domain_gridding.IDGDegridder(model,
+            coordinates.get_increment()[2], 1.2, w_step)
+        degridder.predict(observation.uvw, observation.freqs,
+            observation.antenna1, observation.antenna2, observation.time)
+    return (run, observation.n_visibility(), "vis")
+
+@benchmark
+def average(observation, n_pixel):
+    (shape, coordinates) = observation.image_configuration(n_pixel)
+    chunk = observation.chunk()
+    field_of_view = averaging.field_of_view(coordinates, shape)
+    def run():
+        averaging.average(chunk, observation.freqs, field_of_view, 0.1)
+    return (run, observation.n_visibility(), "vis")
+
+@benchmark
+def max_field(observation, n_pixel):
+    (residual, weight) = _residual(observation, n_pixel)
+    def run():
+        major_cycle.max_field([residual], [weight])
+    return (run, residual.size, "pixel")
+
+@benchmark
+def convolve_with_psf(observation, n_pixel):
+    (residual, weight) = _residual(observation, n_pixel)
+    psf = _psf(observation, n_pixel)
+    def run():
+        major_cycle.convolve_with_psf(residual, psf)
+    return (run, residual.size, "pixel")
+
+@benchmark
+def sum_results(observation, n_pixel):
+    # Partial images and weights of eight engines, as summed by the parallel
+    # processor.
+    (residual, weight) = _residual(observation, n_pixel)
+    results = [(residual, weight) for i in range(8)]
+    def run():
+        reduction.sum_results(results)
+    return (run, 8 * residual.size, "pixel")
+
+@benchmark
+def restore_sparse(observation, n_pixel):
+    (shape, coordinates) = observation.image_configuration(n_pixel)
+    rng = numpy.random.RandomState(2)
+    n_component = 1000
+    index = rng.randint(0, shape[2] * shape[3], n_component)
+    model = SparseModel(shape, index, rng.rand(n_component, shape[1]))
+    increment = coordinates.get_increment()[2]
+    beam = restore.RestoringBeam(increment, _Beam(4.0 * abs(increment[1]),
+        3.0 * abs(increment[1]), 0.5))
+    def run():
+        beam.convolve(model)
+    return (run, numpy.prod(shape), "pixel")
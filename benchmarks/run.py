@@ -0,0 +1,115 @@
+"""Run the benchmarks and report throughput and peak memory use.
+
+Usage: python -m benchmarks.run [options] [benchmark ...]
+
+Each benchmark is run --repeat times, and the fastest run is reported. Peak
+memory is the increase of the peak resident set size of the process while the
+benchmark runs (including its setup). It is measured by resetting the peak
+through /proc/self/clear_refs, which requires Linux.
+"""
+
+import gc
+import sys
+import json
+import time
+import argparse
+
+import hot_paths
+from synthetic import Observation
+
+def _memory(field):
+    """Return field (e.g. VmRSS, VmHWM) of /proc/self/status in bytes, or
+    None if not available."""
+    try:
+        with open("/proc/self/status") as fin:
+            for line in fin:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+def _reset_peak_memory():
+    try:
+        with open("/proc/self/clear_refs", "w") as fout:
+            fout.write("5")
+        return True
+    except IOError:
+        return False
+
+def run_benchmark(function, observation, n_pixel, repeat):
+    """Run a benchmark and return a dict with the results."""
+    gc.collect()
+    baseline = _memory("VmRSS") if _reset_peak_memory() else None
+
+    (run, work, unit) = function(observation, n_pixel)
+    seconds = []
+    for i in range(repeat):
+        begin = time.time()
+        run()
+        seconds.append(time.time() - begin)
+
+    peak = None
+    if baseline is not None:
+        peak = max(0, _memory("VmHWM") - baseline)
+
+    best = min(seconds)
+    return {"work": work, "unit": unit, "seconds": best, "throughput": work
+        / best if best > 0.0 else float("inf"), "peak_memory": peak}
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = "gyimager benchmarks")
+    parser.add_argument("--rows", type = int, default = 100000,
+        help = "number of rows of the synthetic observation")
+    parser.add_argument("--channels", type = int, default = 16,
+        help = "number of channels of the synthetic observation")
+    parser.add_argument("--stations", type = int, default = 48,
+        help = "number of stations of the synthetic observation")
+    parser.add_argument("--pixels", type = int, default = 1024,
+        help = "number of pixels along each image axis")
+    parser.add_argument("--repeat", type = int, default = 3,
+        help = "number of runs of each benchmark")
+    parser.add_argument("--json", dest = "json_file", default = None,
+        metavar = "FILE", help = "also write the results to FILE")
+    parser.add_argument("names", nargs = "*", metavar = "benchmark",
+        help = "benchmarks to run (default: all)")
+    options = parser.parse_args(argv)
+
+    available = [name for (name, function) in hot_paths.BENCHMARKS]
+    for name in options.names:
+        if name not in available:
+            parser.error("unknown benchmark: %s (available: %s)" % (name,
+                ", ".join(available)))
+
+    observation = Observation.with_rows(options.rows, options.channels,
+        n_station = options.stations)
+    print "observation: %d rows, %d channels, %d correlations, %d stations" \
+        % (observation.n_row(), observation.n_channel,
+        observation.n_correlation, observation.n_station)
+
+    results = {}
+    print "%-20s %12s %12s %16s %12s" % ("benchmark", "work", "time (s)",
+        "throughput", "peak (MB)")
+    for (name, function) in hot_paths.BENCHMARKS:
+        if options.names and name not in options.names:
+            continue
+
+        result = run_benchmark(function, observation, options.pixels,
+            options.repeat)
+        results[name] = result
+
+        peak = "n/a" if result["peak_memory"] is None else "%.1f" \
+            % (result["peak_memory"] / 1048576.0)
+        print "%-20s %12d %12.4f %12.3g %s/s %12s" % (name, result["work"],
+            result["seconds"], result["throughput"], result["unit"], peak)
+
+    if options.json_file is not None:
+        configuration = {"rows": observation.n_row(), "channels":
+            observation.n_channel, "stations": observation.n_station,
+            "pixels": options.pixels, "repeat": options.repeat}
+        with open(options.json_file, "w") as fout:
+            json.dump({"configuration": configuration, "results": results},
+                fout, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,103 @@
+"""Benchmark of the startup time of the gyimager command line tool.
+
+Usage: python -m benchmarks.startup [--repeat N] [--json FILE]
+
+Each scenario is run in a fresh interpreter, --repeat times, and the fastest
+run is reported. A scenario fails if it imports any of the modules that are
+slow to load (casacore, casaimwrap, IPython) or that are only needed by a
+specific data processor, such that the entry point and the engines of the
+parallel processor stay cheap to start. The exit status is non-zero if any
+scenario fails.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SCRIPT = os.path.join(_ROOT, "gyimager", "bin", "gyimager")
+
+# Modules (or packages) that should not be imported by any scenario.
+GUARDED = ["pyrap", "casacore", "casaimwrap", "_casaimwrap", "IPython",
+    "gyimager.processors.casa", "gyimager.processors.pywsplit",
+    "gyimager.processors.reference", "gyimager.processors.idg",
+    "gyimager.processors.parallel", "gyimager.processors.gpu"]
+
+# Code run by each scenario. The modules imported by the scenario are written
+# to stdout as JSON.
+_REPORT = "import sys, json; print json.dumps(sorted(name for (name, module)" \
+    " in sys.modules.items() if module is not None))"
+
+_CLI = "import sys, runpy; sys.argv = [%r] + %%r\ntry:\n" \
+    "    runpy.run_path(%r, run_name = '__main__')\nexcept SystemExit:\n" \
+    "    pass\n" % (_SCRIPT, _SCRIPT)
+
+SCENARIOS = [
+    ("interpreter", "pass"),
+    ("help", _CLI % ["--help"]),
+    ("subcommand_help", _CLI % ["mfclean", "--help"]),
+    ("usage_error", _CLI % ["mfclen"]),
+    ("engine", "from gyimager.processors import"
+        " create_data_processor_low_level"),
+]
+
+def guarded(modules):
+    """Return the guarded modules among modules."""
+    return sorted(name for name in modules if any(name == prefix
+        or name.startswith(prefix + ".") for prefix in GUARDED))
+
+def run_scenario(code, repeat):
+    """Run code in a fresh interpreter repeat times, and return the fastest
+    wall clock time (s) and the modules it imported."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([_ROOT] + filter(None,
+        [env.get("PYTHONPATH")]))
+
+    seconds = []
+    for i in range(repeat):
+        begin = time.time()
+        process = subprocess.Popen([sys.executable, "-c", code + "\n"
+            + _REPORT], stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+            env = env)
+        (output, errors) = process.communicate()
+        seconds.append(time.time() - begin)
+        if process.returncode != 0:
+            raise RuntimeError("scenario failed:\n%s" % errors)
+
+    # Help and usage messages precede the report.
+    modules = json.loads(output.strip().splitlines()[-1])
+    return (min(seconds), modules)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = "gyimager startup"
+        " benchmark")
+    parser.add_argument("--repeat", type = int, default = 5,
+        help = "number of runs of each scenario")
+    parser.add_argument("--json", dest = "json_file", default = None,
+        metavar = "FILE", help = "also write the results to FILE")
+    options = parser.parse_args(argv)
+
+    results = {}
+    failed = False
+    print "%-20s %12s %10s  %s" % ("scenario", "time (s)", "modules",
+        "guarded modules imported")
+    for (name, code) in SCENARIOS:
+        (seconds, modules) = run_scenario(code, options.repeat)
+        imported = guarded(modules)
+        failed = failed or len(imported) > 0
+        results[name] = {"seconds": seconds, "modules": len(modules),
+            "guarded": imported}
+        print "%-20s %12.4f %10d  %s" % (name, seconds, len(modules),
+            ", ".join(imported) if imported else "-")
+
+    if options.json_file is not None:
+        with open(options.json_file, "w") as fout:
+            json.dump({"configuration": {"repeat": options.repeat},
+                "results": results}, fout, indent=2, sort_keys=True)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,159 @@
+"""Synthetic observations for benchmarking.
+
+Observation generates the columns of a measurement set for an interferometer
+tracking a field of point sources: a LOFAR-like array layout (a dense core and
+remote stations on a logarithmic spiral), UVW tracks computed from the earth
+rotation, random flags, unit weights and the visibilities of the sources. The
+data is generated from a fixed seed, such that benchmark runs are repeatable.
+"""
+
+import numpy
+
+from gyimager.algorithms import constants
+
+# Sidereal day (s).
+_SIDEREAL_DAY = 86164.0905
+
+class Coordinates:
+    """Stand-in for the pyrap coordinate system of an image, that only
+    provides the pixel increments used by the code under benchmark."""
+    def __init__(self, increment):
+        self._increment = increment
+
+    def get_increment(self):
+        return [numpy.array([1.0]), numpy.array([1.0]),
+            numpy.array([-self._increment, self._increment])]
+
+class Observation:
+    def __init__(self, n_station = 48, n_time = 60, n_channel = 16,
+        n_correlation = 4, integration = 10.0, frequency = 150e6,
+        bandwidth = 3e6, latitude = 0.924, declination = 0.8,
+        flag_fraction = 0.05, n_source = 10, seed = 0):
+        """Generate an observation of n_time integrations of n_station
+        stations, with n_channel channels spread evenly over bandwidth (Hz)
+        around frequency (Hz). The latitude of the array and the declination
+        of the phase center are in rad."""
+        rng = numpy.random.RandomState(seed)
+
+        self.n_station = n_station
+        self.n_time = n_time
+        self.n_channel = n_channel
+        self.n_correlation = n_correlation
+        self.freqs = frequency + bandwidth * ((numpy.arange(n_channel) + 0.5)
+            / n_channel - 0.5)
+
+        position = _layout(rng, n_station, latitude)
+        (antenna1, antenna2) = numpy.triu_indices(n_station, 1)
+        n_baseline = len(antenna1)
+        n_row = n_time * n_baseline
+
+        # Rows are sorted by time, then baseline, as in a measurement set.
+        time = 4.8e9 + integration * numpy.arange(n_time)
+        self.antenna1 = numpy.tile(antenna1, n_time).astype(numpy.int32)
+        self.antenna2 = numpy.tile(antenna2, n_time).astype(numpy.int32)
+        self.time = numpy.repeat(time, n_baseline)
+        self.time_centroid = self.time.copy()
+
+        # UVW coordinates of each baseline, for a phase center that transits
+        # half-way through the observation.
+        hour_angle = 2.0 * numpy.pi * (self.time - numpy.mean(time)) \
+            / _SIDEREAL_DAY
+        baseline = position[self.antenna2] - position[self.antenna1]
+        (sin_h, cos_h) = (numpy.sin(hour_angle), numpy.cos(hour_angle))
+        (sin_d, cos_d) = (numpy.sin(declination), numpy.cos(declination))
+        self.uvw = numpy.empty((n_row, 3))
+        self.uvw[:, 0] = sin_h * baseline[:, 0] + cos_h * baseline[:, 1]
+        self.uvw[:, 1] = -sin_d * cos_h * baseline[:, 0] + sin_d * sin_h \
+            * baseline[:, 1] + cos_d * baseline[:, 2]
+        self.uvw[:, 2] = cos_d * cos_h * baseline[:, 0] - cos_d * sin_h \
+            * baseline[:, 1] + sin_d * baseline[:, 2]
+
+        shape = (n_row, n_channel, n_correlation)
+        self.flag_row = numpy.zeros(n_row, dtype=bool)
+        self.flag = rng.rand(*shape) < flag_fraction
+        self.weight_spectrum = numpy.ones(shape, dtype=numpy.float32)
+
+        # Point sources within a few degrees of the phase center.
+        self.sources = [(l, m, flux) for (l, m, flux) in zip(rng.uniform(-0.05,
+            0.05, n_source), rng.uniform(-0.05, 0.05, n_source),
+            rng.uniform(0.1, 10.0, n_source))]
+        self.data = self._visibilities(shape)
+
+    @staticmethod
+    def with_rows(n_row, n_channel, n_station = 48, **kwargs):
+        """Generate an observation of (about) n_row rows."""
+        n_baseline = n_station * (n_station - 1) // 2
+        n_time = max(1, int(numpy.ceil(n_row / float(n_baseline))))
+        return Observation(n_station = n_station, n_time = n_time,
+            n_channel = n_channel, **kwargs)
+
+    def n_row(self):
+        return len(self.time)
+
+    def n_visibility(self):
+        return self.n_row() * self.n_channel * self.n_correlation
+
+    def maximum_baseline_length(self):
+        return numpy.max(numpy.sqrt(numpy.sum(numpy.square(self.uvw), 1)))
+
+    def image_configuration(self, n_pixel):
+        """Return the shape and coordinates of an image of n_pixel x n_pixel
+        pixels, sampled at three pixels per beam at the highest frequency."""
+        wl = constants.speed_of_light / numpy.max(self.freqs)
+        increment = wl / (3.0 * self.maximum_baseline_length())
+        return ((1, 4, n_pixel, n_pixel), Coordinates(increment))
+
+    def chunk(self, start = 0, nrow = -1):
+        """Return a chunk of rows as passed to the gridders."""
+        end = self.n_row() if nrow < 0 else start + nrow
+        chunk = {}
+        chunk["ANTENNA1"] = self.antenna1[start:end]
+        chunk["ANTENNA2"] = self.antenna2[start:end]
+        chunk["UVW"] = self.uvw[start:end]
+        chunk["TIME"] = self.time[start:end]
+        chunk["TIME_CENTROID"] = self.time_centroid[start:end]
+        chunk["FLAG_ROW"] = self.flag_row[start:end]
+        chunk["FLAG"] = self.flag[start:end]
+        chunk["IMAGING_WEIGHT_CUBE"] = None
+        chunk["DATA"] = self.data[start:end]
+        return chunk
+
+    def _visibilities(self, shape):
+        """Return the visibilities of the (unpolarized) sources."""
+        data = numpy.zeros(shape, dtype=numpy.complex64)
+        scale = self.freqs / constants.speed_of_light
+        for (l, m, flux) in self.sources:
+            n = numpy.sqrt(1.0 - l * l - m * m)
+            delay = self.uvw[:, 0] * l + self.uvw[:, 1] * m + self.uvw[:, 2] \
+                * (n - 1.0)
+            vis = flux * numpy.exp(-2j * numpy.pi * numpy.outer(delay, scale))
+            data[:, :, 0] += vis
+            data[:, :, shape[2] - 1] += vis
+        return data
+
+def _layout(rng, n_station, latitude):
+    """Return the positions (m) of n_station stations in a local equatorial
+    frame (X towards the meridian at the equator, Z towards the pole)."""
+    n_core = n_station // 2
+    n_remote = n_station - n_core
+
+    # Core stations within a few km, remote stations on a logarithmic spiral
+    # out to about 100 km.
+    east = numpy.empty(n_station)
+    north = numpy.empty(n_station)
+    radius = 1500.0 * numpy.sqrt(rng.rand(n_core))
+    angle = 2.0 * numpy.pi * rng.rand(n_core)
+    (east[:n_core], north[:n_core]) = (radius * numpy.cos(angle),
+        radius * numpy.sin(angle))
+
+    radius = numpy.logspace(numpy.log10(3e3), numpy.log10(1e5), n_remote)
+    angle = 1.2 * numpy.log(radius) + 0.2 * rng.randn(n_remote)
+    (east[n_core:], north[n_core:]) = (radius * numpy.cos(angle),
+        radius * numpy.sin(angle))
+    up = rng.randn(n_station)
+
+    position = numpy.empty((n_station, 3))
+    position[:, 0] = -numpy.sin(latitude) * north + numpy.cos(latitude) * up
+    position[:, 1] = east
+    position[:, 2] = numpy.cos(latitude) * north + numpy.sin(latitude) * up
+    return position
@@ -1,6 +1,27 @@
 # $Id$
 
-from empty import empty
-from dirty import dirty
-from mfclean import mfclean
-from degridder import degridder
+# The algorithms depend on casacore and casaimwrap. They are imported on first
+# use, such that the casacore independent modules of this package (e.g.
+# constants, instrumentation, major_cycle) can be imported without them.
+
+def empty(options):
+    return _load("empty")(options)
+
+def dirty(options):
+    return _load("dirty")(options)
+
+def mfclean(options):
+    return _load("mfclean")(options)
+
+def snapshot(options):
+    return _load("snapshot")(options)
+
+def degridder(options):
+    return _load("degridder")(options)
+
+def _load(name):
+    """Import the module that implements algorithm name, and replace the
+    wrapper defined above by the actual implementation."""
+    module = __import__(name, globals())
+    globals()[name] = getattr(module, name)
+    return globals()[name]
@@ -0,0 +1,92 @@
+"""Checkpointing of the clean state, such that a long running clean can be
+resumed after the process died.
+
+A checkpoint is a directory that contains one .npy file per array and a JSON
+file that describes the scalar state. Arrays are stored in the native NumPy
+format, such that they can be memory mapped when the checkpoint is loaded.
+
+A new checkpoint is written to a temporary directory first and then renamed
+into place, such that a crash while writing never destroys the last complete
+checkpoint.
+"""
+
+import os
+import json
+import shutil
+import numpy
+
+_STATE_FILE = "state.json"
+_VERSION = 1
+
+def exists(path):
+    """Return True if a (complete) checkpoint is available at path."""
+    return _find(path) is not None
+
+def save(path, state, arrays):
+    """Write a checkpoint to path.
+
+    Keyword arguments:
+    path -- Name of the checkpoint directory.
+    state -- A dict of JSON serializable values.
+    arrays -- A dict that maps names to NumPy arrays.
+    """
+    tmp_path = path + ".tmp"
+    old_path = path + ".old"
+
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    for (name, array) in arrays.iteritems():
+        numpy.save(os.path.join(tmp_path, name + ".npy"), array)
+
+    header = dict(state)
+    header["version"] = _VERSION
+    header["arrays"] = sorted(arrays.keys())
+    with open(os.path.join(tmp_path, _STATE_FILE), "w") as fout:
+        json.dump(header, fout, indent=2, sort_keys=True)
+
+    # Swap in the new checkpoint. If the process dies in between the two
+    # renames, load() falls back to the previous checkpoint.
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+def load(path):
+    """Load the checkpoint stored at path and return a (state, arrays) tuple.
+
+    Arrays are memory mapped copy-on-write, i.e. they can be modified in
+    memory without affecting the checkpoint on disk.
+    """
+    location = _find(path)
+    if location is None:
+        raise RuntimeError("No checkpoint found at: %s" % path)
+
+    with open(os.path.join(location, _STATE_FILE)) as fin:
+        state = json.load(fin)
+
+    if state.get("version") != _VERSION:
+        raise RuntimeError("Unsupported checkpoint version: %s"
+            % state.get("version"))
+
+    arrays = {}
+    for name in state["arrays"]:
+        arrays[name] = numpy.load(os.path.join(location, name + ".npy"),
+            mmap_mode="c")
+    return (state, arrays)
+
+def remove(path):
+    """Remove the checkpoint at path, including any partial leftovers."""
+    for location in (path, path + ".tmp", path + ".old"):
+        if os.path.exists(location):
+            shutil.rmtree(location)
+
+def _find(path):
+    for location in (path, path + ".old"):
+        if os.path.isfile(os.path.join(location, _STATE_FILE)):
+            return location
+    return None
@@ -4,6 +4,7 @@ import pyrap.tables
 
 import _casaimwrap as casaimwrap
 import gyimager.processors as processors
+import instrumentation
 import util
 
 def degridder(options):
@@ -12,7 +13,8 @@ def degridder(options):
 
     processor_options = {}
     processor_options["threads"] = options.threads
-    processor_options["processor"] = options.processor
+    processor_options["processor"] = util.select_processor(options.processor,
+        {processors.registry.DEGRID: True})
     processor_options["w_max"] = max_baseline
     processor_options["padding"] = 1.0
     processor_options["image"] = options.image
@@ -23,12 +25,24 @@ def degridder(options):
     processor_options["profile"] = options.profile
     processor_options["chunksize"] = options.chunksize
     processor_options["outcol"] = options.outcol
+    processor_options["outcol_tile_rows"] = options.outcol_tile_rows
+    processor_options["write_buffer"] = options.write_buffer
+    processor_options["w_planes"] = options.w_planes
+    processor_options["w_memory"] = options.w_memory
+    processor_options["idg_aterm"] = options.idg_aterm
+    processor_options["time_range"] = options.time_range
+    processor_options["uv_range"] = options.uv_range
+    processor_options["channels"] = options.channels
+    processor_options["correlations"] = options.correlations
     
     processor_options["gridding.ATerm.name"] = "ATermPython"
     processor_options["ATermPython.module"] = "imager.myaterm"
     processor_options["ATermPython.class"] = "MyATerm"
     
     processor = processors.create_data_processor(options.ms, processor_options)
+    capabilities = processor.capabilities()
+    processors.registry.check(processor_options["processor"], capabilities,
+        {processors.registry.DEGRID: True})
 
     '''channel_freq = processor.channel_frequency()
     channel_width = processor.channel_width()
@@ -60,26 +74,25 @@ def degridder(options):
     modelim = pyrap.images.image(processor_options['image'])
 
     util.notice("Model name: %s"%processor_options['image'])
-    print type(modelim)
     util.notice('model shape: %s'%modelim.shape());
 
     #Get image coordinates
     model_coordinates = modelim.coordinates()
     model = modelim.getdata()
 
-    print type(model_coordinates)
-    print type(model)
-    print 'model shape after getdata: ',model.shape;
-
     #degrid
     util.notice("Predicting visibilities...")
     tab = pyrap.tables.table(options.ms)
     nrows = tab.nrows()
     tab.close()
-    print "There are ", nrows, " rows in the MS..."
-    if options.chunksize > 0 and options.chunksize <= nrows:
-      print 'calling degrid_chunk...'
-      processor.degrid_chunk(model_coordinates, model, processors.Normalization.FLAT_GAIN, options.chunksize)
+    util.notice("measurement set contains %d rows" % nrows)
+    chunked = capabilities.get(processors.registry.CHUNKED_IO)
+    if options.chunksize > 0 and not chunked:
+      util.warning("data processor does not process chunks, ignoring chunk"
+        " size")
+    if chunked and options.chunksize > 0 and options.chunksize <= nrows:
+      with instrumentation.timer("degridder.degrid"):
+        processor.degrid_chunk(model_coordinates, model, processors.Normalization.FLAT_GAIN, options.chunksize)
     else:
-      print 'calling degrid...'
-      processor.degrid(model_coordinates, model, processors.Normalization.FLAT_GAIN)
+      with instrumentation.timer("degridder.degrid"):
+        processor.degrid(model_coordinates, model, processors.Normalization.FLAT_GAIN)
@@ -3,6 +3,7 @@ import pyrap.images
 
 import _casaimwrap as casaimwrap
 import gyimager.processors as processors
+import instrumentation
 import util
 
 def dirty(options):
@@ -24,17 +25,29 @@ def dirty(options):
     max_baseline = options.max_baseline if options.max_baseline > 0.0 else \
         10000.0
     processor_options = {}
-    processor_options["processor"] = options.processor
+    processor_options["processor"] = util.select_processor(options.processor,
+        {processors.registry.GRID: True})
     processor_options["w_max"] = max_baseline
     processor_options["padding"] = 1.0
     processor_options["image"] = options.image
     processor_options["threads"] = options.threads
+    processor_options["processes"] = options.processes
     processor_options["weighttype"] = options.weighttype
     processor_options["rmode"] = options.rmode
     processor_options["noise"] = options.noise
     processor_options["robustness"] = options.robustness
     processor_options["profile"] = options.profile
     processor_options["chunksize"] = options.chunksize
+    processor_options["cache_dir"] = options.cache_dir
+    processor_options["cache_size"] = options.cache_size
+    processor_options["w_planes"] = options.w_planes
+    processor_options["w_memory"] = options.w_memory
+    processor_options["idg_aterm"] = options.idg_aterm
+    processor_options["time_range"] = options.time_range
+    processor_options["uv_range"] = options.uv_range
+    processor_options["channels"] = options.channels
+    processor_options["correlations"] = options.correlations
+    processor_options["averaging_tolerance"] = options.averaging_tolerance
 
     processor_options["gridding.ATerm.name"] = "ATermPython"
     processor_options["ATermPython.module"] = "imager.myaterm"
@@ -59,6 +72,9 @@ def dirty(options):
     # the image is sampled at approximately 3 pixels per beam.
     (n_px, delta_px) = util.image_configuration(image_size, max_freq,
         max_baseline)
+    capabilities = processor.capabilities()
+    processors.registry.check(processor_options["processor"], capabilities,
+        {processors.registry.MAX_IMAGE_SIZE: n_px})
 
     util.notice("image configuration:")
     util.notice("    size: %d x %d pixel" % (n_px, n_px))
@@ -79,15 +95,19 @@ def dirty(options):
     tab = pyrap.tables.table(options.ms)
     nrows = tab.nrows()
     tab.close()
-    print "There are ", nrows, " rows in the MS..."
-    if options.chunksize > 0 and options.chunksize <= nrows:
-      print 'calling grid_chunk...'
-      dirty_image, _ = processor.grid_chunk(image_coordinates, image_shape,
-        processors.Normalization.FLAT_NOISE, options.chunksize)
+    util.notice("measurement set contains %d rows" % nrows)
+    chunked = capabilities.get(processors.registry.CHUNKED_IO)
+    if options.chunksize > 0 and not chunked:
+      util.warning("data processor does not process chunks, ignoring chunk"
+        " size")
+    if chunked and options.chunksize > 0 and options.chunksize <= nrows:
+      with instrumentation.timer("dirty.grid"):
+        dirty_image, _ = processor.grid_chunk(image_coordinates, image_shape,
+          processors.Normalization.FLAT_NOISE, options.chunksize)
     else:
-      print 'calling grid...'
-      dirty_image, _ = processor.grid(image_coordinates, image_shape,
-        processors.Normalization.FLAT_NOISE)
+      with instrumentation.timer("dirty.grid"):
+        dirty_image, _ = processor.grid(image_coordinates, image_shape,
+          processors.Normalization.FLAT_NOISE)
 
     # Store output images. Store both a flat noise and a flat gain image.
     util.notice("storing dirty images...")
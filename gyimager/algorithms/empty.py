@@ -10,7 +10,8 @@ def empty(options):
         10000.0
 
     processor_options = {}
-    processor_options["processor"] = options.processor
+    processor_options["processor"] = util.select_processor(options.processor,
+        {processors.registry.GRID: True})
     processor_options["w_max"] = max_baseline
     processor_options["padding"] = 1.0
     processor_options["image"] = options.image
@@ -0,0 +1,76 @@
+"""Asynchronous output of images.
+
+An ImageWriter stores images (see util.store_image()) in a pool of background
+threads, such that the caller can compute the next product while an image is
+written to disk. An image can be passed as a function without arguments, in
+which case the image itself (e.g. its normalization) is computed in the
+background as well. flush() waits until all images have been stored.
+
+casacore is not thread-safe, so the images are written one at a time; the
+computation and conversion of the images proceed concurrently.
+"""
+
+import threading
+import multiprocessing.pool
+import numpy
+
+import instrumentation
+import util
+
+# Serializes all calls into casacore made by the writer threads.
+_casacore_lock = threading.Lock()
+
+class ImageWriter:
+    def __init__(self, threads = 1, format = "casa", dtype = None):
+        """Create a writer that stores images in the given format ("casa" or
+        "fits"), converted to dtype if not None, using threads background
+        threads (if 0, images are stored immediately by store())."""
+        if format not in util.IMAGE_FORMATS:
+            raise RuntimeError("Unsupported image format: %s" % format)
+        self._format = format
+        self._dtype = dtype
+        self._pool = None
+        if threads > 0:
+            self._pool = multiprocessing.pool.ThreadPool(threads)
+        self._pending = []
+
+    def store(self, name, coordinates, image):
+        """Store image, which is either an array or a function without
+        arguments that returns the image to store."""
+        if self._pool is None:
+            self._store(name, coordinates, image)
+        else:
+            self._pending.append(self._pool.apply_async(self._store, (name,
+                coordinates, image)))
+
+    def flush(self):
+        """Wait until all images passed to store() have been stored. If any
+        of them failed, the first error is raised (after all images have been
+        processed)."""
+        pending, self._pending = self._pending, []
+        with instrumentation.timer("image_writer.flush"):
+            for result in pending:
+                result.wait()
+        for result in pending:
+            result.get()
+
+    def close(self):
+        """Flush, and stop the background threads."""
+        try:
+            self.flush()
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+    def _store(self, name, coordinates, image):
+        if callable(image):
+            with instrumentation.timer("image_writer.compute"):
+                image = image()
+        if self._dtype is not None:
+            image = numpy.asarray(image, dtype=self._dtype)
+
+        with _casacore_lock:
+            util.store_image(name, coordinates, image, self._format,
+                self._dtype)
@@ -0,0 +1,96 @@
+"""Named timers and counters for profiling the stages of an imaging run.
+
+Stages are timed with the timer() context manager:
+
+    with instrumentation.timer("grid"):
+        ...
+
+and quantities (e.g. rows or bytes read) are accumulated with count(). Timers
+with the same name accumulate the total time spent and the number of calls.
+Nested timers are inclusive, i.e. the time of an inner timer is also included
+in the time of the outer timer. Names use dots to group related stages, e.g.
+"ms.read" and "ms.write".
+
+The collected statistics are process wide, and can be written as JSON or CSV
+with write_report(). Statistics of remote engines (parallel processor) are
+collected in the engine processes and are not included.
+"""
+
+import csv
+import json
+import time
+import threading
+import contextlib
+
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+_start = time.time()
+
+@contextlib.contextmanager
+def timer(name):
+    """Context manager that adds the time spent in its body to timer name."""
+    begin = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - begin
+        with _lock:
+            (calls, total) = _timers.get(name, (0, 0.0))
+            _timers[name] = (calls + 1, total + elapsed)
+
+def timed(name):
+    """Decorator that times each call of the decorated function with timer
+    name."""
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+def count(name, value = 1):
+    """Add value to counter name."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def reset():
+    """Discard all statistics collected so far."""
+    global _start
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _start = time.time()
+
+def report():
+    """Return the statistics collected so far as a dict."""
+    with _lock:
+        timers = dict((name, {"calls": calls, "seconds": total}) for (name,
+            (calls, total)) in _timers.iteritems())
+        counters = dict(_counters)
+        wall = time.time() - _start
+    return {"wall_seconds": wall, "timers": timers, "counters": counters}
+
+def write_report(path):
+    """Write the statistics collected so far to path. The format is CSV if
+    path ends in .csv, and JSON otherwise."""
+    statistics = report()
+
+    if not path.lower().endswith(".csv"):
+        with open(path, "w") as fout:
+            json.dump(statistics, fout, indent=2, sort_keys=True)
+        return
+
+    with open(path, "wb") as fout:
+        writer = csv.writer(fout)
+        writer.writerow(["kind", "name", "calls", "value"])
+        writer.writerow(["timer", "wall", 1, "%.6f"
+            % statistics["wall_seconds"]])
+        for name in sorted(statistics["timers"]):
+            entry = statistics["timers"][name]
+            writer.writerow(["timer", name, entry["calls"], "%.6f"
+                % entry["seconds"]])
+        for name in sorted(statistics["counters"]):
+            writer.writerow(["counter", name, "", statistics["counters"][name]])
@@ -0,0 +1,84 @@
+"""Image plane operations of the mfclean major cycle.
+
+These functions only depend on numpy, such that they can be used (and
+benchmarked) without casacore.
+"""
+
+import numpy
+
+import instrumentation
+
+@instrumentation.timed("mfclean.max_field")
+def max_field(residual, weight):
+    """Re-normalize the residual and return the (signed) minimum and maximum
+    residual, as well as the (absolute) maximum residual.
+
+    Re-implementation of MFCleanImageSkyModel::maxField().
+    """
+    assert(len(weight) == len(residual))
+    n_model = len(weight)
+
+    # Compute the (signed) maximum of weight over all models.
+    max_weight = 0.0
+    for i in range(n_model):
+        max_weight = max(max_weight, numpy.max(weight[i]))
+
+    absmax = 0.0
+    min_residual = [1e20 for i in range(n_model)]
+    max_residual = [-1e20 for i in range(n_model)]
+    for i in range(n_model):
+        for ch in range(len(residual[i])):
+            # TODO: Why is the residual re-weighted here? In practice for LOFAR
+            # all weights seem to be equal, which causes the residual to be
+            # re-weighted by a factor 1.0. Ensure that this is the case, such
+            # that it does not go unnoticed when the re-weighting would have had
+            # an effect.
+            #
+#            residual[i][ch, :, :, :] *= \
+#                numpy.sqrt(weight[i][ch, :, :, :] / max_weight)
+            assert(numpy.all(weight[i][ch, :] == max_weight))
+
+            fmax = numpy.max(residual[i][ch, :, :, :])
+            fmin = numpy.min(residual[i][ch, :, :, :])
+
+            # TODO: What is the logic behind this?
+            if fmax < 0.99 * -1e20:
+                fmax = 0.0
+            if fmin > 0.99 * 1e20:
+                fmin = 0.0
+
+            absmax = max(absmax, max(abs(fmax), abs(fmin)))
+            min_residual[i] = min(min_residual[i], fmin)
+            max_residual[i] = max(max_residual[i], fmax)
+
+    return (absmax, min_residual, max_residual)
+
+@instrumentation.timed("fft.convolve_psf")
+def convolve_with_psf(image, psf):
+    """Convolve each image plane with the first correlation of the PSF of the
+    same channel, normalized to unit peak.
+
+    This is used to approximate the effect of subtracting a set of clean
+    components from the residual in the image plane, without going through
+    the visibility data.
+    """
+    assert(len(image.shape) == 4 and image.shape[0] == psf.shape[0])
+
+    shape = image.shape[2:]
+    padded_shape = (2 * shape[0], 2 * shape[1])
+    center = (shape[0] // 2, shape[1] // 2)
+
+    result = numpy.zeros(image.shape)
+    for ch in range(image.shape[0]):
+        peak = numpy.max(psf[ch, 0, :, :])
+        if peak <= 0.0:
+            continue
+
+        # Zero padding to twice the image size avoids wrap-around.
+        kernel = numpy.fft.rfft2(psf[ch, 0, :, :] / peak, padded_shape)
+        planes = numpy.fft.rfft2(image[ch, :, :, :], padded_shape)
+        planes = numpy.fft.irfft2(planes * kernel, padded_shape)
+
+        result[ch, :, :, :] = planes[:, center[0]:center[0] + shape[0],
+            center[1]:center[1] + shape[1]]
+    return result
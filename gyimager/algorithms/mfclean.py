@@ -9,7 +9,13 @@ import pyrap.images
 
 import _casaimwrap as casaimwrap
 import gyimager.processors as processors
+from gyimager.processors.sparse_model import as_dense
+import checkpoint
+import image_writer
+import instrumentation
+import restore
 import util
+from major_cycle import max_field, convolve_with_psf
 
 class BeamParameters:
     def __init__(self, major_axis = 1.0, minor_axis = 1.0,
@@ -138,65 +144,48 @@ def validate_psf(csys, psf, beam):
 
     return (min_psf, max_psf, max_psf_outer, psf_patch_size, max_sidelobe)
 
-def max_field(residual, weight):
-    """Re-normalize the residual and return the (signed) minimum and maximum
-    residual, as well as the (absolute) maximum residual.
-
-    Re-implementation of MFCleanImageSkyModel::maxField().
-    """
-    assert(len(weight) == len(residual))
-    n_model = len(weight)
-
-    # Compute the (signed) maximum of weight over all models.
-    max_weight = 0.0
-    for i in range(n_model):
-        max_weight = max(max_weight, numpy.max(weight[i]))
-
-    absmax = 0.0
-    min_residual = [1e20 for i in range(n_model)]
-    max_residual = [-1e20 for i in range(n_model)]
-    for i in range(n_model):
-        for ch in range(len(residual[i])):
-            # TODO: Why is the residual re-weighted here? In practice for LOFAR
-            # all weights seem to be equal, which causes the residual to be
-            # re-weighted by a factor 1.0. Ensure that this is the case, such
-            # that it does not go unnoticed when the re-weighting would have had
-            # an effect.
-            #
-#            residual[i][ch, :, :, :] *= \
-#                numpy.sqrt(weight[i][ch, :, :, :] / max_weight)
-            assert(numpy.all(weight[i][ch, :] == max_weight))
-
-            fmax = numpy.max(residual[i][ch, :, :, :])
-            fmin = numpy.min(residual[i][ch, :, :, :])
-
-            # TODO: What is the logic behind this?
-            if fmax < 0.99 * -1e20:
-                fmax = 0.0
-            if fmin > 0.99 * 1e20:
-                fmin = 0.0
-
-            absmax = max(absmax, max(abs(fmax), abs(fmin)))
-            min_residual[i] = min(min_residual[i], fmin)
-            max_residual[i] = max(max_residual[i], fmax)
-
-    return (absmax, min_residual, max_residual)
-
-def restore_image(csys, image, residual, beam):
+@instrumentation.timed("restore")
+def restore_image(restoring_beam, image, residual):
     """Convolve the input clean component image with a Gaussian restoring beam
     and add the residual."""
-    if beam.major_axis > 0.0 and beam.minor_axis > 0.0:
-        major = beam.major_axis * 180.0 * 3600.0 / numpy.pi
-        minor = beam.minor_axis * 180.0 * 3600.0 / numpy.pi
-        pa = beam.position_angle * 180.0 / numpy.pi
-        restored = casaimwrap.convolve_with_beam(csys, image, major,
-            minor, pa)
-    else:
-        restored = numpy.copy(image)
-
+    restored = restoring_beam.convolve(image)
     restored += residual
     return restored
 
+def flat_gain(processor, coordinates, image):
+    """Return a function that returns image (flat noise) normalized to flat
+    gain, such that the normalization can be deferred to an image writer."""
+    return lambda: as_dense(processor.normalize(coordinates, image,
+        processors.Normalization.FLAT_NOISE,
+        processors.Normalization.FLAT_GAIN))
+
+def save_checkpoint(path, image_shape, join_stokes, cycle, previous_absmax,
+    max_weight, updated, beam, psf, weight, model, residual, iterations):
+    """Write the state of the major cycle loop to a checkpoint."""
+    n_model = len(model)
+
+    state = {}
+    state["image_shape"] = list(image_shape)
+    state["n_model"] = n_model
+    state["join_stokes"] = join_stokes
+    state["cycle"] = cycle
+    state["previous_absmax"] = previous_absmax
+    state["max_weight"] = float(max_weight)
+    state["updated"] = [bool(x) for x in updated]
+    state["beam"] = [(x.major_axis, x.minor_axis, x.position_angle)
+        for x in beam]
+
+    arrays = {}
+    arrays["iterations"] = iterations
+    for i in range(n_model):
+        arrays["psf.%d" % i] = psf[i]
+        arrays["weight.%d" % i] = weight[i]
+        arrays["model.%d.index" % i] = model[i].index
+        arrays["model.%d.flux" % i] = model[i].flux
+        arrays["residual.%d" % i] = residual[i]
+
+    checkpoint.save(path, state, arrays)
+
 def mfclean(options):
     clark_options = {}
     clark_options["gain"] = options.gain
@@ -207,16 +196,32 @@ def mfclean(options):
         10000.0
 
     processor_options = {}
-    processor_options["processor"] = options.processor
+    processor_options["processor"] = util.select_processor(options.processor,
+        {processors.registry.GRID: True, processors.registry.RESIDUAL: True})
     processor_options["w_max"] = max_baseline
     processor_options["padding"] = 1.0
     processor_options["image"] = options.image
     processor_options["threads"] = options.threads
+    processor_options["processes"] = options.processes
     processor_options["weighttype"] = options.weighttype
     processor_options["rmode"] = options.rmode
     processor_options["noise"] = options.noise
     processor_options["robustness"] = options.robustness
     processor_options["profile"] = options.profile
+    processor_options["cache_dir"] = options.cache_dir
+    processor_options["cache_size"] = options.cache_size
+    processor_options["w_planes"] = options.w_planes
+    processor_options["w_memory"] = options.w_memory
+    processor_options["idg_aterm"] = options.idg_aterm
+    processor_options["time_range"] = options.time_range
+    processor_options["uv_range"] = options.uv_range
+    processor_options["channels"] = options.channels
+    processor_options["correlations"] = options.correlations
+    processor_options["averaging_tolerance"] = options.averaging_tolerance
+    processor_options["reorder_cache"] = options.reorder_cache
+    processor_options["vis_cache"] = options.vis_cache
+    processor_options["vis_cache_precision"] = options.vis_cache_precision
+    processor_options["vis_cache_compress"] = options.vis_cache_compress
     processor = processors.create_data_processor(options.ms, processor_options)
 
     channel_freq = processor.channel_frequency()
@@ -232,6 +237,9 @@ def mfclean(options):
 
     (n_px, delta_px) = util.image_configuration(image_size, max_freq,
         max_baseline)
+    processors.registry.check(processor_options["processor"],
+        processor.capabilities(), {processors.registry.RESIDUAL: True,
+        processors.registry.MAX_IMAGE_SIZE: n_px})
 
     util.notice("image configuration:")
     util.notice("    size: %d x %d pixel" % (n_px, n_px))
@@ -258,53 +266,123 @@ def mfclean(options):
 #    join_stokes = False
     join_stokes = True
 
-    # Compute approximate PSFs.
-    util.notice("computing approximate point spread functions...")
-    psf = [None for i in range(n_model)]
-    beam = [None for i in range(n_model)]
-    for i in range(n_model):
-        psf[i] = processor.point_spread_function(image_coordinates, image_shape)
-        fit = casaimwrap.fit_gaussian_psf(image_coordinates.dict(),
-            psf[i])
-        assert(fit["ok"])
+    if join_stokes:
+        stokes = ["JOINT"]
+        cr_slices = [slice(None)]
+    else:
+        stokes = image_coordinates.get_coordinate("stokes").get_stokes()
+        cr_slices = [slice(i, i + 1) for i in range(4)]
+
+    checkpoint_path = options.image + ".checkpoint"
+    if options.resume:
+        # Restore the clean state from the last checkpoint. The PSFs and the
+        # residuals stored in the checkpoint are re-used, such that neither
+        # the PSFs nor the first residual need to be recomputed.
+        util.notice("resuming from checkpoint: %s" % checkpoint_path)
+        (state, arrays) = checkpoint.load(checkpoint_path)
+        if tuple(state["image_shape"]) != image_shape \
+            or state["n_model"] != n_model \
+            or state["join_stokes"] != join_stokes:
+            raise RuntimeError("Checkpoint does not match the current image"
+                " configuration: %s" % checkpoint_path)
+
+        psf = [arrays["psf.%d" % i] for i in range(n_model)]
+        beam = [BeamParameters(*state["beam"][i]) for i in range(n_model)]
+        for i in range(n_model):
+            util.notice("model %d/%d: major axis: %f arcsec, minor axis: %f"
+                " arcsec, position angle: %f deg" % (i, n_model - 1,
+                beam[i].major_axis * 3600.0 * 180.0 / numpy.pi,
+                beam[i].minor_axis * 3600.0 * 180.0 / numpy.pi,
+                beam[i].position_angle * 180.0 / numpy.pi))
+    else:
+        # The PSFs are cached by the processor. The beam parameters fitted to
+        # them are cached here, under the same key.
+        cache = processors.ProductCache.from_options(processor_options)
+        if cache is not None:
+            cache_key = cache.key(options.ms, processor_options,
+                image_coordinates, image_shape)
+
+        # Compute approximate PSFs.
+        util.notice("computing approximate point spread functions...")
+        psf = [None for i in range(n_model)]
+        beam = [None for i in range(n_model)]
+        for i in range(n_model):
+            with instrumentation.timer("mfclean.psf"):
+                psf[i] = processor.point_spread_function(image_coordinates,
+                    image_shape)
 
-        beam[i] = BeamParameters((fit["major"] * numpy.pi) / (3600.0 * 180.0),
-            (fit["minor"] * numpy.pi) / (3600.0 * 180.0), (fit["angle"]
-            * numpy.pi) / 180.0)
+            fit = None
+            if cache is not None:
+                fit = cache.get(cache_key, "beam.%d" % i)
 
-        util.notice("model %d/%d: major axis: %f arcsec, minor axis: %f arcsec,"
-            " position angle: %f deg" % (i, n_model - 1, abs(fit["major"]),
-            abs(fit["minor"]), fit["angle"]))
+            if fit is None:
+                with instrumentation.timer("mfclean.fit_psf"):
+                    fit = casaimwrap.fit_gaussian_psf(
+                        image_coordinates.dict(), psf[i])
+                assert(fit["ok"])
+
+                fit = dict((name, float(fit[name])) for name in ["major",
+                    "minor", "angle"])
+                if cache is not None:
+                    cache.put(cache_key, "beam.%d" % i, fit)
+
+            beam[i] = BeamParameters((fit["major"] * numpy.pi)
+                / (3600.0 * 180.0), (fit["minor"] * numpy.pi)
+                / (3600.0 * 180.0), (fit["angle"] * numpy.pi) / 180.0)
+
+            util.notice("model %d/%d: major axis: %f arcsec, minor axis: %f"
+                " arcsec, position angle: %f deg" % (i, n_model - 1,
+                abs(fit["major"]), abs(fit["minor"]), fit["angle"]))
 
     # Validate PSFs.
     (min_psf, max_psf, max_psf_outer, psf_patch_size, max_sidelobe) = \
         validate_psf(image_coordinates, psf, beam)
     clark_options["psf_patch_size"] = psf_patch_size
 
-    updated = [False for i in range(n_model)]
-    weight = [None for i in range(n_model)]
-    model = [numpy.zeros(image_shape) for i in range(n_model)]
     delta = [numpy.zeros(image_shape) for i in range(n_model)]
-    residual = [numpy.zeros(image_shape) for i in range(n_model)]
 
-    if join_stokes:
-        iterations = numpy.zeros((n_model, 1, image_shape[0]))
-        stokes = ["JOINT"]
-        cr_slices = [slice(None)]
-    else:
-        iterations = numpy.zeros((n_model, image_shape[1], image_shape[0]))
-        stokes = image_coordinates.get_coordinate("stokes").get_stokes()
-        cr_slices = [slice(i, i + 1) for i in range(4)]
+    # Model plane approximation of the residual after subtracting the most
+    # recent delta image, i.e. the delta that has not been folded into the
+    # stored residual yet, and the relative error of this approximation
+    # measured against the most recent residual computed from the data.
+    predicted = [None for i in range(n_model)]
+    prediction_error = [None for i in range(n_model)]
 
-    cycle = 0
     diverged = False
     absmax = options.threshold
-    previous_absmax = 1e30
+
+    if options.resume:
+        updated = list(state["updated"])
+        weight = [arrays["weight.%d" % i] for i in range(n_model)]
+        model = [processors.SparseModel(image_shape,
+            arrays["model.%d.index" % i], arrays["model.%d.flux" % i])
+            for i in range(n_model)]
+        residual = [arrays["residual.%d" % i] for i in range(n_model)]
+        iterations = arrays["iterations"]
+        cycle = state["cycle"]
+        previous_absmax = state["previous_absmax"]
+        max_weight = state["max_weight"]
+        util.notice("resuming at major cycle: %d, iterations: %s" % (cycle,
+            str(iterations.tolist())))
+    else:
+        updated = [False for i in range(n_model)]
+        weight = [None for i in range(n_model)]
+        model = [processors.SparseModel(image_shape) for i in range(n_model)]
+        residual = [numpy.zeros(image_shape) for i in range(n_model)]
+        if join_stokes:
+            iterations = numpy.zeros((n_model, 1, image_shape[0]))
+        else:
+            iterations = numpy.zeros((n_model, image_shape[1],
+                image_shape[0]))
+        cycle = 0
+        previous_absmax = 1e30
+        max_weight = 0.0
 
     while absmax >= options.threshold and numpy.max(iterations) \
         < options.iterations and (cycle == 0 or any(updated)):
 
         util.notice(">> starting major cycle: %d <<" % cycle)
+        instrumentation.count("mfclean.major_cycles")
 
         # Comment from CASA source code:
         #
@@ -321,16 +399,29 @@ def mfclean(options):
             # equal the observed visibilities and therefore we only need to
             # grid them.
             for i in range(n_model):
-                residual[i], weight[i] = processor.grid(image_coordinates,
-                    image_shape, processors.Normalization.FLAT_NOISE)
+                with instrumentation.timer("mfclean.residual"):
+                    residual[i], weight[i] = processor.grid(
+                        image_coordinates, image_shape,
+                        processors.Normalization.FLAT_NOISE)
         else:
             for i in range(n_model):
                 if updated[i]:
-                    residual[i], weight[i] = \
-                        processor.residual(image_coordinates, model[i],
-                            processors.Normalization.FLAT_NOISE,
-                            processors.Normalization.FLAT_NOISE)
+                    with instrumentation.timer("mfclean.residual"):
+                        residual[i], weight[i] = \
+                            processor.residual(image_coordinates, model[i],
+                                processors.Normalization.FLAT_NOISE,
+                                processors.Normalization.FLAT_NOISE)
+
+                    if predicted[i] is not None:
+                        prediction_error[i] = numpy.max(numpy.abs(residual[i]
+                            - predicted[i])) / max(numpy.max(numpy.abs(
+                            residual[i])), 1e-20)
+                        util.notice("model %d/%d: relative error of model"
+                            " plane residual: %f" % (i, n_model - 1,
+                            prediction_error[i]))
+
                 updated[i] = False
+                predicted[i] = None
 
         # Compute residual statistics.
         (absmax, resmin, resmax) = max_field(residual, weight)
@@ -437,9 +528,12 @@ def mfclean(options):
                     # We only want the PSF for the first polarization so we
                     # iterate over polarization LAST.
                     #
-                    result = casaimwrap.clark_clean(psf[i][ch,0,:,:],
-                        residual[i][ch,cr_slice,:,:], weight_mask,
-                        iterations[i,cr,ch], clark_options)
+                    with instrumentation.timer("mfclean.minor_cycle"):
+                        result = casaimwrap.clark_clean(psf[i][ch,0,:,:],
+                            residual[i][ch,cr_slice,:,:], weight_mask,
+                            iterations[i,cr,ch], clark_options)
+                    instrumentation.count("mfclean.iterations",
+                        int(result["iterations"] - iterations[i,cr,ch]))
 
                     if result["iterations"] > iterations[i,cr,ch]:
                         updated[i] = True
@@ -458,16 +552,46 @@ def mfclean(options):
             if updated[i]:
                 model[i] += delta[i]
 
+                if options.residual_tolerance > 0.0:
+                    predicted[i] = residual[i] - convolve_with_psf(delta[i],
+                        psf[i])
+
         # Update major cycle counter.
         cycle += 1
 
+        # Save the clean state, such that the clean can be resumed from this
+        # point if the process dies.
+        if options.checkpoint_interval > 0 \
+            and cycle % options.checkpoint_interval == 0:
+            util.notice("writing checkpoint: %s" % checkpoint_path)
+            save_checkpoint(checkpoint_path, image_shape, join_stokes, cycle,
+                previous_absmax, max_weight, updated, beam, psf, weight,
+                model, residual, iterations)
+
     if any(updated):
         util.notice("finalizing residual images for all fields...")
         for i in range(n_model):
-            if updated[i]:
-                residual[i], weight[i] = processor.residual(image_coordinates,
-                    model[i], processors.Normalization.FLAT_NOISE,
-                    processors.Normalization.FLAT_NOISE)
+            if not updated[i]:
+                continue
+
+            # Accept the model plane approximation if it was accurate enough
+            # in the previous major cycle. This saves a full pass over the
+            # visibility data.
+            if predicted[i] is not None and prediction_error[i] is not None \
+                and prediction_error[i] <= options.residual_tolerance:
+                util.notice("model %d/%d: using model plane residual"
+                    " (relative error %f <= %f)" % (i, n_model - 1,
+                    prediction_error[i], options.residual_tolerance))
+                residual[i] = predicted[i]
+            else:
+                with instrumentation.timer("mfclean.residual"):
+                    residual[i], weight[i] = processor.residual(
+                        image_coordinates, model[i],
+                        processors.Normalization.FLAT_NOISE,
+                        processors.Normalization.FLAT_NOISE)
+
+            updated[i] = False
+            predicted[i] = None
         (absmax, resmin, resmax) = max_field(residual, weight)
 
         # Print some statistics.
@@ -478,45 +602,53 @@ def mfclean(options):
     else:
         util.notice("residual images for all fields are up-to-date...")
 
-    # Store output images.
+    # Store output images. The images are normalized and written by
+    # background threads, while the next product is computed. The average
+    # response is computed first, such that it is cached when the
+    # normalizations run.
+    writer = image_writer.ImageWriter(options.image_writers,
+        options.image_format, numpy.float32 if options.single_precision else
+        None)
+
     util.notice("storing average response...")
-    util.store_image(options.image + ".response", image_coordinates,
+    writer.store(options.image + ".response", image_coordinates,
         processor.response(image_coordinates, image_shape))
 
     util.notice("storing model images...")
     for i in range(n_model):
-        util.store_image(options.image + ".model.flat_noise",
-            image_coordinates, model[i])
-        util.store_image(options.image + ".model", image_coordinates,
-            processor.normalize(image_coordinates, model[i],
-            processors.Normalization.FLAT_NOISE,
-            processors.Normalization.FLAT_GAIN))
+        writer.store(options.image + ".model.flat_noise", image_coordinates,
+            model[i].to_dense)
+        writer.store(options.image + ".model", image_coordinates,
+            flat_gain(processor, image_coordinates, model[i]))
 
     util.notice("storing residual images...")
     for i in range(n_model):
-        util.store_image(options.image + ".residual.flat_noise",
+        writer.store(options.image + ".residual.flat_noise",
             image_coordinates, residual[i])
-        util.store_image(options.image + ".residual", image_coordinates,
-            processor.normalize(image_coordinates, residual[i],
-            processors.Normalization.FLAT_NOISE,
-            processors.Normalization.FLAT_GAIN))
+        writer.store(options.image + ".residual", image_coordinates,
+            flat_gain(processor, image_coordinates, residual[i]))
 
     util.notice("storing restored images...")
     for i in range(n_model):
-        restored = restore_image(image_coordinates.dict(), model[i],
-            residual[i], beam[i])
+        restoring_beam = restore.RestoringBeam(
+            image_coordinates.get_increment()[2], beam[i])
+        restored = restore_image(restoring_beam, model[i], residual[i])
 
-        util.store_image(options.image + ".restored.flat_noise",
+        writer.store(options.image + ".restored.flat_noise",
             image_coordinates, restored)
-        util.store_image(options.image + ".restored", image_coordinates,
-            processor.normalize(image_coordinates, restored,
-            processors.Normalization.FLAT_NOISE,
-            processors.Normalization.FLAT_GAIN))
+        writer.store(options.image + ".restored", image_coordinates,
+            flat_gain(processor, image_coordinates, restored))
+
+    # Wait until all images are on disk.
+    writer.close()
 
     # Print some statistics.
     for i in range(n_model):
         util.notice("model %d/%d: clean flux: %f, residual rms: %f" % (i,
-            n_model - 1, numpy.sum(model[i]), numpy.std(residual[i])))
+            n_model - 1, model[i].sum(), numpy.std(residual[i])))
+
+    # The output images are complete, so the checkpoint is no longer needed.
+    checkpoint.remove(checkpoint_path)
 
     if diverged:
         util.error("clean diverged.")
@@ -0,0 +1,140 @@
+"""Restoration of clean component images with an elliptical Gaussian beam.
+
+The transfer function of the restoring beam is computed once per beam and
+padded image size, after which all correlations (and channels) of a model
+image are convolved together using real FFTs. Only the bounding box of the
+non-zero model pixels is transformed, which is much smaller than the full
+image for typical clean models.
+"""
+
+import numpy
+
+import gyimager.processors as processors
+
+# Radius of the beam kernel, in units of the full width at half maximum. The
+# Gaussian drops below 1e-7 of its peak beyond this radius.
+_SUPPORT_FWHM = 2.5
+
+class RestoringBeam:
+    def __init__(self, increment, beam):
+        """Create a restoring beam.
+
+        Keyword arguments:
+        increment -- Pixel increments (rad) along the image axes (y, x), i.e.
+            (declination, right ascension), as returned by
+            coordinatesystem.get_increment() for the direction coordinate.
+        beam -- BeamParameters of the restoring beam.
+        """
+        self._increment = (float(increment[0]), float(increment[1]))
+        self._major = beam.major_axis
+        self._minor = beam.minor_axis
+        self._angle = beam.position_angle
+
+        # Cache of transfer functions, indexed by padded image size.
+        self._transfer = {}
+
+        if self.is_identity():
+            self._support = (0, 0)
+        else:
+            self._support = tuple(int(numpy.ceil(_SUPPORT_FWHM * self._major
+                / abs(inc))) for inc in self._increment)
+
+    def is_identity(self):
+        """Return True if the beam is degenerate, in which case restoring is
+        a no-op."""
+        return not (self._major > 0.0 and self._minor > 0.0)
+
+    def convolve(self, image):
+        """Convolve image with the restoring beam.
+
+        The image can be a dense image or a SparseModel. The beam is
+        normalized to unit peak, such that a clean component of 1 Jy results
+        in a peak of 1 Jy/beam. All leading axes of image (e.g. channel,
+        correlation) are convolved independently.
+        """
+        if isinstance(image, processors.SparseModel):
+            box = image.bounding_box()
+            if box is not None:
+                planes = image.to_dense(box)
+        else:
+            # Find the bounding box of the non-zero pixels, over all planes.
+            (rows, cols) = numpy.nonzero(numpy.any(image.reshape((-1,)
+                + image.shape[-2:]) != 0.0, axis=0))
+            box = None
+            if len(rows) > 0:
+                box = ((numpy.min(rows), numpy.max(rows) + 1),
+                    (numpy.min(cols), numpy.max(cols) + 1))
+                planes = image[..., box[0][0]:box[0][1], box[1][0]:box[1][1]]
+
+        image_shape = image.shape[-2:]
+        result = numpy.zeros((numpy.prod(image.shape[:-2]),) + image_shape)
+        if box is None:
+            return result.reshape(image.shape)
+
+        planes = planes.reshape((-1,) + planes.shape[-2:])
+        if self.is_identity():
+            result[:, box[0][0]:box[0][1], box[1][0]:box[1][1]] = planes
+            return result.reshape(image.shape)
+
+        # Pad the bounding box with the kernel support on all sides, such that
+        # the circular convolution does not wrap around.
+        padded_shape = tuple(_fast_size(box[k][1] - box[k][0] + 2
+            * self._support[k]) for k in range(2))
+
+        padded = numpy.zeros((planes.shape[0],) + padded_shape)
+        padded[:, self._support[0]:self._support[0] + box[0][1] - box[0][0],
+            self._support[1]:self._support[1] + box[1][1] - box[1][0]] = \
+            planes
+
+        padded = numpy.fft.irfft2(numpy.fft.rfft2(padded)
+            * self._transfer_function(padded_shape), padded_shape)
+
+        # Copy the part of the result that falls within the image.
+        out = [(max(box[k][0] - self._support[k], 0), min(box[k][1]
+            + self._support[k], image_shape[k])) for k in range(2)]
+        offset = [box[k][0] - self._support[k] for k in range(2)]
+        result[:, out[0][0]:out[0][1], out[1][0]:out[1][1]] = \
+            padded[:, out[0][0] - offset[0]:out[0][1] - offset[0],
+            out[1][0] - offset[1]:out[1][1] - offset[1]]
+
+        return result.reshape(image.shape)
+
+    def _transfer_function(self, shape):
+        if shape not in self._transfer:
+            self._transfer[shape] = numpy.fft.rfft2(self._kernel(shape))
+        return self._transfer[shape]
+
+    def _kernel(self, shape):
+        """Return the beam sampled on a grid of the given shape, centered on
+        pixel (0, 0) with negative offsets wrapped around."""
+        dy = numpy.fft.ifftshift(numpy.arange(shape[0]) - shape[0] // 2)
+        dx = numpy.fft.ifftshift(numpy.arange(shape[1]) - shape[1] // 2)
+        (dy, dx) = numpy.meshgrid(dy, dx, indexing="ij")
+
+        # Offsets towards the north (m) and east (l). The position angle is
+        # measured from north through east.
+        m = dy * self._increment[0]
+        l = dx * self._increment[1]
+        major = l * numpy.sin(self._angle) + m * numpy.cos(self._angle)
+        minor = l * numpy.cos(self._angle) - m * numpy.sin(self._angle)
+
+        kernel = numpy.exp(-4.0 * numpy.log(2.0) * (numpy.square(major
+            / self._major) + numpy.square(minor / self._minor)))
+
+        # Truncate the kernel to its support.
+        kernel[(numpy.abs(dy) > self._support[0]) | (numpy.abs(dx)
+            > self._support[1])] = 0.0
+        return kernel
+
+def _fast_size(n):
+    """Return the smallest integer >= n that only has 2, 3 and 5 as prime
+    factors."""
+    size = n
+    while True:
+        m = size
+        for factor in (2, 3, 5):
+            while m % factor == 0:
+                m //= factor
+        if m == 1:
+            return size
+        size += 1
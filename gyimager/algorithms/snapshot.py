@@ -0,0 +1,210 @@
+import sys
+import Queue
+import threading
+import collections
+import multiprocessing.pool
+import numpy
+import pyrap.images
+
+import _casaimwrap as casaimwrap
+import gyimager.processors as processors
+from gyimager.processors.ms_reader import MSReader
+from gyimager.processors import streaming
+from gyimager.processors import gridding
+import instrumentation
+import util
+
+# Column that holds the visibilities, as gridded by the data processors.
+_DATA_COLUMN = "CORRECTED_DATA"
+
+# Number of blocks of rows that may be read ahead of the gridders, per
+# interval that is gridded concurrently.
+_READ_AHEAD = 2
+
+def snapshot(options):
+    # Snapshot imaging: a dirty image per time interval. The measurement is
+    # read once, in time order, in blocks of rows that do not cross interval
+    # boundaries. Each interval is gridded by its own streaming gridder (see
+    # processors/streaming.py), such that the data processor is created only
+    # once. Up to concurrent_intervals intervals are
+    # gridded concurrently by a pool of threads, while the next blocks are
+    # read.
+    #
+    if options.interval <= 0.0:
+        raise RuntimeError("Invalid interval: %f" % options.interval)
+
+    max_baseline = options.max_baseline if options.max_baseline > 0.0 else \
+        10000.0
+    processor_options = {}
+    processor_options["processor"] = util.select_processor(options.processor,
+        {processors.registry.GRID: True, processors.registry.INCREMENTAL:
+        True})
+    processor_options["w_max"] = max_baseline
+    processor_options["padding"] = 1.0
+    processor_options["image"] = options.image
+    processor_options["threads"] = options.threads
+    processor_options["weighttype"] = options.weighttype
+    processor_options["rmode"] = options.rmode
+    processor_options["noise"] = options.noise
+    processor_options["robustness"] = options.robustness
+    processor_options["chunksize"] = options.chunksize
+    processor_options["cache_dir"] = options.cache_dir
+    processor_options["cache_size"] = options.cache_size
+    processor_options["w_planes"] = options.w_planes
+    processor_options["idg_aterm"] = options.idg_aterm
+    processor_options["time_range"] = options.time_range
+    processor_options["uv_range"] = options.uv_range
+    processor_options["channels"] = options.channels
+    processor_options["correlations"] = options.correlations
+    processor_options["averaging_tolerance"] = options.averaging_tolerance
+
+    processor_options["gridding.ATerm.name"] = "ATermPython"
+    processor_options["ATermPython.module"] = "imager.myaterm"
+    processor_options["ATermPython.class"] = "MyATerm"
+
+    # Only data processors that process data concurrently can keep more than
+    # one gridder open at a time.
+    concurrent = max(1, options.concurrent_intervals)
+    capabilities = processors.registry.capabilities(
+        processor_options["processor"])
+    if concurrent > 1 and not capabilities[processors.registry.THREADS]:
+        util.warning("data processor %s grids one interval at a time"
+            % processor_options["processor"])
+        concurrent = 1
+
+    # Each open gridder keeps its own W-planes in memory.
+    processor_options["w_memory"] = options.w_memory / concurrent
+
+    processor = processors.create_data_processor(options.ms, processor_options)
+
+    channel_freq = processor.channel_frequency()
+    channel_width = processor.channel_width()
+
+    # Estimate the size of the image in radians, based on an esitmate of the
+    # FWHM of the station beam, assuming a station diameter of 70 meters (see
+    # dirty.py).
+    max_freq = numpy.max(channel_freq)
+    image_size = 4.0 * util.full_width_half_max(70.0, max_freq)
+
+    # Estimate the number of pixels and the pixels size in radians such that
+    # the image is sampled at approximately 3 pixels per beam.
+    (n_px, delta_px) = util.image_configuration(image_size, max_freq,
+        max_baseline)
+    processors.registry.check(processor_options["processor"],
+        processor.capabilities(), {processors.registry.MAX_IMAGE_SIZE: n_px})
+
+    util.notice("image configuration:")
+    util.notice("    size: %d x %d pixel" % (n_px, n_px))
+    util.notice("    angular size: %.2f deg" % (image_size * 180.0 / numpy.pi))
+    util.notice("    angular resolution @ 3 pixel/beam: %.2f arcsec/pixel"
+        % (3600.0 * delta_px * 180.0 / numpy.pi))
+
+    image_shape = (1, 4, n_px, n_px)
+    image_coordinates = pyrap.images.coordinates.coordinatesystem(
+        casaimwrap.make_coordinate_system(image_shape[2:], [delta_px,
+        delta_px], processor.phase_reference(), channel_freq, channel_width))
+
+    # The rows are read with the selection applied by the data processor.
+    ms = MSReader(options.ms, processor_options)
+    with instrumentation.timer("snapshot.intervals"):
+        intervals = time_intervals(ms.getcol("TIME"), options.interval)
+    util.notice("imaging %d interval(s) of %.1f s, %d at a time..."
+        % (len(intervals), options.interval, concurrent))
+
+    chunksize = options.chunksize
+    if chunksize <= 0:
+        chunksize = max(1, gridding.BLOCK_SIZE // len(channel_freq))
+
+    pool = multiprocessing.pool.ThreadPool(concurrent)
+    budget = threading.Semaphore(_READ_AHEAD * concurrent)
+    pending = collections.deque()
+    origin = intervals[0][0] if intervals else 0.0
+    try:
+        for (start, end, row, nrow) in intervals:
+            # Wait until a worker thread is available.
+            while len(pending) >= concurrent:
+                _store(options.image, image_coordinates, pending.popleft())
+
+            # The gridder is opened here, such that the data processor is
+            # only configured by the main thread.
+            gridder = processor.open_grid(image_coordinates, image_shape)
+            blocks = Queue.Queue()
+            index = int(round((start - origin) / options.interval))
+            pending.append((index, start - origin, end - origin, blocks,
+                pool.apply_async(_grid_interval, (gridder, blocks, budget))))
+
+            for first in range(row, row + nrow, chunksize):
+                budget.acquire()
+                blocks.put(_read(ms, first, min(chunksize, row + nrow
+                    - first)))
+            blocks.put(None)
+
+        while pending:
+            _store(options.image, image_coordinates, pending.popleft())
+    finally:
+        # Release the worker threads that still wait for blocks (if an error
+        # occurred).
+        for (index, start, end, blocks, result) in pending:
+            blocks.put(None)
+        pool.close()
+        pool.join()
+
+def time_intervals(time, interval):
+    """Return the (start, end, row, nrow) of each interval of length interval
+    (s) that contains at least one row, where the intervals are aligned to the
+    first time stamp. The time stamps should be sorted."""
+    if len(time) == 0:
+        return []
+    if numpy.any(numpy.diff(time) < 0.0):
+        raise RuntimeError("Snapshot imaging requires a measurement sorted in"
+            " time")
+
+    index = numpy.floor((time - time[0]) / interval).astype(int)
+    rows = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(index)) + 1,
+        [len(time)]))
+    return [(time[0] + index[row] * interval, time[0] + (index[row] + 1)
+        * interval, int(row), int(end - row)) for (row, end) in
+        zip(rows[:-1], rows[1:])]
+
+def _read(ms, start, nrow):
+    """Read a block of rows (see streaming.COLUMNS)."""
+    with instrumentation.timer("snapshot.read"):
+        chunk = {}
+        for name in streaming.COLUMNS[:-1] + ["WEIGHT_SPECTRUM"]:
+            chunk[name] = ms.getcol(name, start, nrow)
+        chunk["DATA"] = ms.getcol(_DATA_COLUMN, start, nrow)
+    return chunk
+
+def _grid_interval(gridder, blocks, budget):
+    """Worker thread: add the blocks received through the queue blocks to
+    gridder until None is received, and return the image. All blocks are
+    consumed (and their budget released) even if gridding fails, such that
+    the reader never waits for a failed worker."""
+    failure = None
+    while True:
+        chunk = blocks.get()
+        if chunk is None:
+            break
+        try:
+            if failure is None:
+                with instrumentation.timer("snapshot.grid"):
+                    gridder.add(chunk)
+        except Exception:
+            failure = sys.exc_info()
+        finally:
+            del chunk
+            budget.release()
+
+    if failure is not None:
+        raise failure[0], failure[1], failure[2]
+    with instrumentation.timer("snapshot.grid"):
+        return gridder.close()
+
+def _store(name, coordinates, item):
+    """Wait for the image of an interval, and store it."""
+    (index, start, end, blocks, result) = item
+    (image, weight) = result.get()
+    util.notice("interval %d: %.1f - %.1f s, weight: %g" % (index, start,
+        end, numpy.max(weight)))
+    util.store_image("%s.snapshot-%04d.flat_noise" % (name, index),
+        coordinates, image)
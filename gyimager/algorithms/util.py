@@ -1,7 +1,7 @@
 import numpy
 import constants
+import instrumentation
 
-import pyrap.images
 #import matplotlib.pyplot
 import datetime
 
@@ -18,12 +18,53 @@ def warning(msg):
 def error(msg):
     print "\033[91m[%s] error: %s\033[m" % (now(), msg)
 
-def store_image(name, coordinates, image):
+def select_processor(name, requirements):
+    """Return the name of the data processor to use for name, which can be
+    "auto" (see processors.registry.resolve()), and report the choice."""
+    from gyimager.processors import registry
+    selected = registry.resolve(name, requirements)
+    if selected != name:
+        notice("data processor: %s" % selected)
+
+    # The automatic choice may fall back to a data processor that does not
+    # apply the beam (e.g. if casaimwrap is not installed).
+    if name == registry.AUTO and registry.missing(registry.capabilities(
+        selected), {registry.DIRECTION_DEPENDENT: True}):
+        warning("data processor %s does not apply direction dependent effects"
+            " (beam, A-terms)" % selected)
+    return selected
+
+# Image formats supported by store_image().
+IMAGE_FORMATS = ["casa", "fits"]
+
+@instrumentation.timed("store_image")
+def store_image(name, coordinates, image, format = "casa", dtype = None):
+    """Store image as a CASA image, or as a FITS file (with the extension
+    .fits appended to name) if format is "fits". If dtype is not None, the
+    pixels are converted to dtype (e.g. numpy.float32) and stored at that
+    precision."""
     assert(len(image.shape) <= 4)
+    if format not in IMAGE_FORMATS:
+        raise RuntimeError("Unsupported image format: %s" % format)
     shape = [1 for i in range(4)]
     shape[(4 - len(image.shape)):] = image.shape
-    im = pyrap.images.image(name, shape=shape, coordsys=coordinates)
-    im.putdata(image)
+    # Imported here, such that the messages above can be used without
+    # casacore (e.g. by the numpy data processors).
+    import pyrap.images
+    # A FITS file is written from a temporary (in memory) image.
+    path = name if format == "casa" else ""
+    if dtype is None:
+        im = pyrap.images.image(path, shape=shape, coordsys=coordinates)
+        im.putdata(image)
+    else:
+        im = pyrap.images.image(path, values=numpy.asarray(image,
+            dtype=dtype).reshape(shape), coordsys=coordinates)
+
+    if format == "fits":
+        # Images created from a shape hold single precision pixels.
+        bitpix = -64 if dtype is not None and numpy.dtype(dtype) \
+            == numpy.float64 else -32
+        im.tofits(name + ".fits", overwrite=True, bitpix=bitpix)
 
 #def show_image(data, title = None):
 #    """Create a figure with 2 x 2 subplots that show the four correlation planes
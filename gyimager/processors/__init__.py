@@ -4,6 +4,9 @@ import os
 import json
 from data_processor_base import DataProcessorBase, ImageWeight, Normalization
 from data_processor_low_level_base import DataProcessorLowLevelBase
+from product_cache import ProductCache
+from sparse_model import SparseModel
+import registry
 
 def read_data_descriptor(descriptor):
     with open(descriptor) as fin:
@@ -28,23 +31,12 @@ def create_data_processor(measurement, options):
         import serial
         return serial.create_data_processor(measurement, options)
 
-    name = options["processor"]
+    if options.get("processes", 1) > 1:
+        import local
+        return local.create_data_processor(measurement, options)
 
-    try:
-        # The call to __import__ fails when not passing the global variables.
-        module = __import__(name, globals=globals())
-    except ImportError:
-        raise RuntimeError("Unable to import data processor implementation: %s"
-            % name)
-
-    try:
-        processor = module.create_data_processor(measurement, options)
-    except AttributeError:
-        try:
-            processor = module.DataProcessor(measurement, options)
-        except AttributeError:
-            raise RuntimeError("Non-conforming data processor implementation:"
-                " %s" % name)
+    name = registry.resolve(options["processor"], {registry.GRID: True})
+    processor = registry.load(name).create_data_processor(measurement, options)
 
     if not isinstance(processor, DataProcessorBase) :
         raise RuntimeError("Non-conforming data processor implementation: %s"
@@ -64,25 +56,13 @@ def create_data_processor_low_level(measurement, options):
         import serial
         return serial.create_data_processor_low_level(measurement, options)
 
-    name = options["processor"]
+    if options.get("processes", 1) > 1:
+        import local
+        return local.create_data_processor_low_level(measurement, options)
 
-    try:
-        # The call to __import__ fails when not passing the global variables.
-        module = __import__(name, globals = globals())
-    except ImportError:
-        raise RuntimeError("Unable to import data processor implementation: %s"
-            % name)
-
-    try:
-        processor = module.create_data_processor_low_level(measurement, options)
-    except AttributeError:
-        # Apparently there is no factory function, try to create instance
-        # directly
-        try:
-            processor = module.DataProcessorLowLevel(measurement, options)
-        except AttributeError:
-            raise RuntimeError("No DataProcessorLowLevel found in module: %s"
-                % name)
+    name = registry.resolve(options["processor"], {registry.GRID: True})
+    processor = registry.load(name).create_data_processor_low_level(
+        measurement, options)
 
     if not isinstance(processor, DataProcessorLowLevelBase):
         raise RuntimeError("Non-conforming DataProcessorLowLevel"
@@ -0,0 +1,153 @@
+"""Baseline dependent averaging of visibility data before gridding.
+
+Short baselines move slowly through the uv plane, so they are heavily
+oversampled in time and frequency compared to the uv cell size (the inverse of
+the image field of view). Averaging consecutive samples of such baselines
+reduces the amount of data to grid, without noticeably smearing the image.
+
+The averaging is controlled by a tolerance: the maximum distance between an
+averaged sample and the samples that contribute to it, as a fraction of the uv
+cell size. Half of the tolerance is spent on averaging in time, the other half
+on averaging in frequency.
+
+Samples are averaged in groups of an odd number of consecutive time samples
+and channels. The averaged visibility is positioned at the central sample, so
+for regularly sampled data its uv coordinate is exact. Averaging in time
+reduces the number of rows. Averaging in frequency keeps the channel layout
+the gridders expect: the averaged visibility is stored in the central channel
+of each group and all other channels of the group are flagged. The gridders
+skip flagged samples, so both reduce the gridding cost.
+
+The imaging weight of an averaged sample is the sum of the weights of the
+unflagged samples that contribute to it, such that gridding the average is
+equivalent to gridding each of the contributing samples.
+"""
+
+import numpy
+from ..algorithms import constants
+
+# Columns of a chunk that contain a single value per row.
+_ROW_COLUMNS = ["ANTENNA1", "ANTENNA2", "UVW", "TIME", "TIME_CENTROID"]
+
+def field_of_view(coordinates, shape):
+    """Return the field of view (rad) of an image of the given shape, i.e. the
+    largest extent along either of the direction axes."""
+    increment = coordinates.get_increment()[2]
+    return max(shape[-2] * abs(increment[0]), shape[-1] * abs(increment[1]))
+
+def average(chunk, freqs, field_of_view, tolerance):
+    """Average a chunk of visibility data in time and frequency.
+
+    Keyword arguments:
+    chunk -- Dict of columns, as passed to the gridder. IMAGING_WEIGHT_CUBE
+        may be None, which means all weights are equal to 1.0. DATA is
+        optional (it is not needed to compute the PSF).
+    freqs -- Channel frequencies (Hz).
+    field_of_view -- Field of view (rad) of the image to make.
+    tolerance -- Maximum uv distance between averaged samples, as a fraction
+        of the uv cell size.
+
+    Return a new chunk that contains the averaged data. The returned chunk
+    always includes an IMAGING_WEIGHT_CUBE.
+    """
+    freqs = numpy.asarray(freqs, dtype=float)
+    limit = 0.5 * tolerance / field_of_view
+
+    flag = chunk["FLAG"] | chunk["FLAG_ROW"][:, numpy.newaxis, numpy.newaxis]
+    weight = chunk["IMAGING_WEIGHT_CUBE"]
+    if weight is None:
+        weight = numpy.ones(flag.shape, dtype=numpy.float32)
+    weight = numpy.where(flag, numpy.float32(0.0), weight)
+
+    # Sort the rows by baseline and time, such that the rows of each group of
+    # samples to average are consecutive.
+    order = numpy.lexsort((chunk["TIME"], chunk["ANTENNA2"],
+        chunk["ANTENNA1"]))
+    antenna1 = chunk["ANTENNA1"][order]
+    antenna2 = chunk["ANTENNA2"][order]
+    uvw = chunk["UVW"][order]
+    (baseline, first) = _baselines(antenna1, antenna2)
+
+    # The uv distance (m) a baseline moves per time sample, which is (very
+    # nearly) constant over the short stretch of time within a chunk.
+    step = numpy.zeros(len(first))
+    same = baseline[1:] == baseline[:-1]
+    distance = numpy.sqrt(numpy.sum(numpy.square(uvw[1:, :2]
+        - uvw[:-1, :2]), axis=1))
+    numpy.maximum.at(step, baseline[1:][same], distance[same])
+
+    # Group size in time, per baseline.
+    size = _group_size(step * numpy.max(freqs) / constants.speed_of_light,
+        limit, len(order))
+
+    # Group consecutive rows of each baseline.
+    position = numpy.arange(len(order)) - first[baseline]
+    start = numpy.flatnonzero((position % size[baseline]) == 0)
+    count = numpy.diff(numpy.append(start, len(order)))
+    center = start + (count - 1) // 2
+
+    result = {}
+    for name in _ROW_COLUMNS:
+        result[name] = chunk[name][order][center]
+
+    # Average along the time axis.
+    weight = weight[order]
+    weight_sum = numpy.add.reduceat(weight, start, axis=0)
+    data = None
+    if "DATA" in chunk:
+        data = numpy.add.reduceat(chunk["DATA"][order] * weight, start,
+            axis=0)
+
+    # Group size in frequency, per (averaged) row.
+    length = numpy.sqrt(numpy.sum(numpy.square(result["UVW"][:, :2]),
+        axis=1))
+    width = numpy.max(numpy.abs(numpy.diff(freqs))) if len(freqs) > 1 else 0.0
+    size = _group_size(length * width / constants.speed_of_light, limit,
+        len(freqs))
+    for k in numpy.unique(size[size > 1]):
+        rows = numpy.flatnonzero(size == k)
+        weight_sum[rows] = _average_channels(weight_sum[rows], k)
+        if data is not None:
+            data[rows] = _average_channels(data[rows], k)
+
+    flag = weight_sum <= 0.0
+    result["FLAG"] = flag
+    result["FLAG_ROW"] = numpy.all(flag.reshape((flag.shape[0], -1)), axis=1)
+    result["IMAGING_WEIGHT_CUBE"] = weight_sum.astype(numpy.float32)
+    if data is not None:
+        result["DATA"] = (data / numpy.where(flag, 1.0,
+            weight_sum)).astype(numpy.complex64)
+
+    # Restore the time order of the measurement.
+    order = numpy.lexsort((result["ANTENNA2"], result["ANTENNA1"],
+        result["TIME"]))
+    for name in result:
+        result[name] = result[name][order]
+    return result
+
+def _baselines(antenna1, antenna2):
+    """Return the baseline index of each row, and the index of the first row
+    of each baseline. The rows should be sorted by baseline."""
+    new = numpy.ones(len(antenna1), dtype=bool)
+    new[1:] = (antenna1[1:] != antenna1[:-1]) | (antenna2[1:] != antenna2[:-1])
+    return (numpy.cumsum(new) - 1, numpy.flatnonzero(new))
+
+def _group_size(step, limit, maximum):
+    """Return the (odd) number of samples that can be averaged, such that the
+    distance of any sample to the central sample is at most limit, given the
+    distance between consecutive samples."""
+    half = numpy.floor(limit / numpy.maximum(step, 1e-30))
+    half = numpy.minimum(half, maximum // 2).astype(int)
+    return 2 * half + 1
+
+def _average_channels(value, size):
+    """Sum value over groups of size consecutive channels, store the sum in
+    the central channel of each group, and set all other channels to zero."""
+    nchan = value.shape[1]
+    start = numpy.arange(0, nchan, size)
+    count = numpy.diff(numpy.append(start, nchan))
+    center = start + (count - 1) // 2
+
+    result = numpy.zeros_like(value)
+    result[:, center] = numpy.add.reduceat(value, start, axis=1)
+    return result
@@ -3,16 +3,42 @@ import itertools
 import os.path as path
 import numpy
 import casaimwrap
-from ...algorithms import constants
 import pyrap.tables
-import imaging_weight
+from .. import imaging_weight
+from .. import registry
+from .. import averaging
+from weight_provider import WeightProvider
+from ..sparse_model import as_dense
+from ..ms_reader import MSReader
+from ..vis_cache import VisibilityCache
+from ..output_sink import OutputSink
+from ...algorithms import instrumentation
+from ...algorithms import util
+
+# Columns of a chunk, in the order expected by casaimwrap.grid_buffers() and
+# casaimwrap.degrid_buffers(), and their required element type.
+_CHUNK_COLUMNS = [("ANTENNA1", numpy.int32), ("ANTENNA2", numpy.int32),
+    ("UVW", numpy.float64), ("TIME", numpy.float64), ("TIME_CENTROID",
+    numpy.float64), ("FLAG_ROW", numpy.bool_), ("IMAGING_WEIGHT_CUBE",
+    numpy.float32), ("FLAG", numpy.bool_)]
+
+def _chunk_buffers(chunk):
+    """Return the columns of chunk as C contiguous arrays of the element type
+    expected by casaimwrap. Columns that already satisfy these requirements
+    are passed through as is, and are used by casaimwrap without copying.
+    Columns that are None (e.g. constant imaging weights) are passed as
+    None."""
+    return [None if chunk[name] is None else numpy.ascontiguousarray(
+        chunk[name], dtype=dtype) for (name, dtype) in _CHUNK_COLUMNS]
 
 class DataProcessorLowLevel(DataProcessorLowLevelBase):
     def __init__(self, measurement, options):
         self._measurement = measurement
-        self._ms = pyrap.tables.table(measurement, readonly = False)
-        self._ms = self._ms.query("ANTENNA1 != ANTENNA2 && OBSERVATION_ID ==" \
-            " 0 && FIELD_ID == 0 && DATA_DESC_ID == 0")
+        self._ms = MSReader(measurement, options, readonly = False)
+        if options.get("vis_cache"):
+            self._ms = VisibilityCache(self._ms, measurement,
+                options["vis_cache"], options.get("vis_cache_precision",
+                "single"), options.get("vis_cache_compress", False))
 
 #        assert(options["weight_algorithm"] == WeightAlgorithm.NATURAL)
 
@@ -24,6 +50,13 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
 
         self._modeldata_column = "MODEL_DATA"
 
+        # Create or validate the output column up front, rather than failing
+        # after all the degridding is done.
+        if options.has_key("outcol"):
+            self._ms.ensure_column(self._data_column, tile_rows =
+                options.get("outcol_tile_rows", 0))
+        self._write_buffer = options.get("write_buffer", 64.0)
+
         self._coordinates = None
         self._shape = None
         self._response_available = False
@@ -81,11 +114,23 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         weightoptions = dict( (key, value) for (key,value) in options.iteritems() if key in weightoptionnames)
         self.imw = imaging_weight.ImagingWeight(**weightoptions)
 
+        # Natural weighting uses constant imaging weights. Otherwise, the
+        # weights are computed from WEIGHT_SPECTRUM and cached per block of
+        # rows until the density changes.
+        if self.imw.needs_density():
+            self._weights = WeightProvider(self._imaging_weight)
+        else:
+            self._weights = WeightProvider()
+
+        # Baseline dependent averaging before gridding (disabled if None or
+        # 0.0).
+        self._averaging_tolerance = options.get("averaging_tolerance")
+
         self._context = casaimwrap.CASAContext()
         casaimwrap.init(self._context, self._measurement, parms)
 
     def capabilities(self):
-        return {}
+        return registry.capabilities("casa")
 
     def phase_reference(self):
         field = pyrap.tables.table(path.join(self._measurement, "FIELD"))
@@ -107,36 +152,15 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         return numpy.max(numpy.sqrt(numpy.sum(numpy.square( \
             self._ms.getcol("UVW")), 1)))
 
+    @instrumentation.timed("density")
     def density(self, coordinates, shape):
-        increment = coordinates.get_increment()
-        freqs = self.channel_frequency()
-        f = freqs/constants.speed_of_light
-
-        density_shape = shape[2:]
-        density_increment = increment[2]
-
-        uorig = int(density_shape[1]/2)
-        vorig = int(density_shape[0]/2)
-
-        density = numpy.zeros(density_shape)
-        uscale = density_shape[1]*density_increment[1]
-        vscale = density_shape[0]*density_increment[0]
-        uvw = self._ms.getcol("UVW")
-        weight = self._ms.getcol("WEIGHT_SPECTRUM")
-        for i in range(len(self._ms)):
-          u1 = uvw[i,0]*uscale
-          v1 = uvw[i,1]*vscale
-          for j in range(len(f)):
-              u = int(u1*f[j])
-              v = int(v1*f[j])
-              if abs(u)<uorig and abs(v)<vorig :
-                  w = sum(weight[i, j,:])
-                  density[vorig+v,uorig+u] += w
-                  density[vorig-v,uorig-u] += w
-        return density
+        return imaging_weight.density(self._ms.getcol("UVW"),
+            self.channel_frequency(), self._ms.getcol("WEIGHT_SPECTRUM"),
+            shape[2:], coordinates.get_increment()[2])
 
     def set_density(self, density, coordinates) :
         self.imw.set_density(density, coordinates)
+        self._weights.invalidate()
 
     def response(self, coordinates, shape):
         self._update_image_configuration(coordinates, shape)
@@ -155,14 +179,15 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         args["TIME_CENTROID"] = self._ms.getcol("TIME_CENTROID")
         args["FLAG_ROW"] = self._ms.getcol("FLAG_ROW")
         args["FLAG"] = self._ms.getcol("FLAG")
-        #args["IMAGING_WEIGHT"] = self.imw.imaging_weight(args["UVW"], \
-            #self.channel_frequency(), args["FLAG"], self._ms.getcol("WEIGHT_SPECTRUM"))
-        args["IMAGING_WEIGHT_CUBE"] = numpy.ones(args["FLAG"].shape, dtype=numpy.float32)
-        args["DATA"] = numpy.ones(args["FLAG"].shape, dtype=numpy.complex64)
+        args["IMAGING_WEIGHT_CUBE"] = self._weights.imaging_weight(args,
+            (0, self._ms.nrows()))
 
+        # The visibilities are taken to be 1.0 when computing the PSF, so DATA
+        # is not needed.
         casaimwrap.begin_grid(self._context, shape, coordinates.dict(), \
-            True, args)
-        result = casaimwrap.end_grid(self._context, False)
+            True)
+        self._grid(self._average(args, coordinates, shape))
+        result = self._end_grid()
         return (result["image"], result["weight"])
 
     def grid(self, coordinates, shape, as_grid):
@@ -177,7 +202,8 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         args["TIME_CENTROID"] = self._ms.getcol("TIME_CENTROID")
         args["FLAG_ROW"] = self._ms.getcol("FLAG_ROW")
         args["FLAG"] = self._ms.getcol("FLAG")
-        args["IMAGING_WEIGHT_CUBE"] = numpy.ones(args["FLAG"].shape, dtype=numpy.float32)
+        args["IMAGING_WEIGHT_CUBE"] = self._weights.imaging_weight(args,
+            (0, self._ms.nrows()))
         args["DATA"] = self._ms.getcol(self._data_column)
 
 	# INI: Modified grid in casaimwrap to separate begin_grid, grid and end_grid
@@ -187,9 +213,8 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
 
         casaimwrap.begin_grid(self._context, shape, coordinates.dict(), \
             False)
-        casaimwrap.grid(self._context, \
-            args)
-        result = casaimwrap.end_grid(self._context, False) # INI: why is this False? Insert proper options here
+        self._grid(self._average(args, coordinates, shape))
+        result = self._end_grid()
 
         self._response_available = True
         return (result["image"], result["weight"])
@@ -209,7 +234,8 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         else:
             nchunks = nrows / chunksize
 
-        print 'nrows, chunksize, lastchunksize: ', nrows, chunksize, lastchunksize
+        util.notice("processing %d rows in chunks of %d rows" % (nrows,
+            chunksize))
 
         for chunk in numpy.arange(nchunks):
                 start = chunk * chunksize
@@ -226,15 +252,13 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         	args["TIME_CENTROID"] = self._ms.getcol("TIME_CENTROID",start,nrow)
 	        args["FLAG_ROW"] = self._ms.getcol("FLAG_ROW",start,nrow)
         	args["FLAG"] = self._ms.getcol("FLAG",start,nrow)
-	        args["IMAGING_WEIGHT_CUBE"] = numpy.ones(args["FLAG"].shape, dtype=numpy.float32)
+	        args["IMAGING_WEIGHT_CUBE"] = self._weights.imaging_weight(args,
+                    (start, nrow))
         	args["DATA"] = self._ms.getcol(self._data_column,start,nrow)
 
-	        casaimwrap.grid(self._context, \
-        	    args)
+	        self._grid(self._average(args, coordinates, shape))
 
-        result = casaimwrap.end_grid(self._context, False) # INI: why is this False? Insert proper options here
-
-	print "Result is ------------------: ", result
+        result = self._end_grid()
 
         self._response_available = True
         return (result["image"], result["weight"])
@@ -242,6 +266,7 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
     def degrid(self, coordinates, model, as_grid):
         assert(not as_grid)
         self._update_image_configuration(coordinates, model.shape)
+        model = as_dense(model)
 
         args = {}
         args["ANTENNA1"] = self._ms.getcol("ANTENNA1")
@@ -251,25 +276,27 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         args["TIME_CENTROID"] = self._ms.getcol("TIME_CENTROID")
         args["FLAG_ROW"] = self._ms.getcol("FLAG_ROW")
         args["FLAG"] = self._ms.getcol("FLAG")
-        args["IMAGING_WEIGHT_CUBE"] = numpy.ones(args["FLAG"].shape, dtype=numpy.float32)
+        # Imaging weights are not used for degridding.
+        args["IMAGING_WEIGHT_CUBE"] = None
 
-        casaimwrap.begin_degrid(self._context, \
-            coordinates.dict(), model)
+        self._begin_degrid(coordinates, model)
           
-        result = casaimwrap.degrid(self._context, \
-            args)
+        data = self._degrid(args)
           
         casaimwrap.end_degrid(self._context)
         self._response_available = True
 	# INI: uncommenting the line below so that the result is written to the MS.
-        self._ms.putcol(self._data_column, result["data"])
+        sink = self._output_sink()
+        sink.write(data, 0)
+        sink.close()
 
     def degrid_chunk(self, coordinates, model, as_grid, chunksize):
         assert(not as_grid)
         self._update_image_configuration(coordinates, model.shape)
+        model = as_dense(model)
 
-        casaimwrap.begin_degrid(self._context, \
-            coordinates.dict(), model)
+        self._begin_degrid(coordinates, model)
+        sink = self._output_sink()
 
 	# INI: looping through chunks of data
 	nrows = self._ms.nrows()
@@ -279,7 +306,8 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
 	else:
 	    nchunks = nrows / chunksize
 
-	print 'nrows, chunksize, lastchunksize: ', nrows, chunksize, lastchunksize
+	util.notice("processing %d rows in chunks of %d rows" % (nrows,
+	    chunksize))
 
 	for chunk in numpy.arange(nchunks):
 		start = chunk * chunksize
@@ -296,19 +324,20 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
 	        args["TIME_CENTROID"] = self._ms.getcol("TIME_CENTROID",start,nrow)
 	        args["FLAG_ROW"] = self._ms.getcol("FLAG_ROW",start,nrow)
 	        args["FLAG"] = self._ms.getcol("FLAG",start,nrow)
-	        args["IMAGING_WEIGHT_CUBE"] = numpy.ones(args["FLAG"].shape, dtype=numpy.float32)
+	        args["IMAGING_WEIGHT_CUBE"] = None
      
-        	result = casaimwrap.degrid(self._context, \
-	            args)
-	        self._ms.putcol(self._data_column, result["data"], start, nrow)
+        	data = self._degrid(args)
+	        sink.write(data, start)
           
         casaimwrap.end_degrid(self._context)
+        sink.close()
 
         self._response_available = True
 
     def residual(self, coordinates, model, as_grid):
         assert(not as_grid)
         self._update_image_configuration(coordinates, model.shape)
+        model = as_dense(model)
 
         # Degrid model.
         args = {}
@@ -319,14 +348,14 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         args["TIME_CENTROID"] = self._ms.getcol("TIME_CENTROID")
         args["FLAG_ROW"] = self._ms.getcol("FLAG_ROW")
         args["FLAG"] = self._ms.getcol("FLAG")
-        args["IMAGING_WEIGHT_CUBE"] = numpy.ones(args["FLAG"].shape, dtype=numpy.float32)
+        args["IMAGING_WEIGHT_CUBE"] = None
 
-        result = casaimwrap.begin_degrid(self._context, \
-            coordinates.dict(), model, args)
+        self._begin_degrid(coordinates, model)
+        data = self._degrid(args)
         casaimwrap.end_degrid(self._context)
 
         # Compute residual.
-        residual = self._ms.getcol(self._data_column) - result["data"]
+        residual = self._ms.getcol(self._data_column) - data
 
         # Grid residual.
         args = {}
@@ -337,16 +366,77 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         args["TIME_CENTROID"] = self._ms.getcol("TIME_CENTROID")
         args["FLAG_ROW"] = self._ms.getcol("FLAG_ROW")
         args["FLAG"] = self._ms.getcol("FLAG")
-        args["IMAGING_WEIGHT_CUBE"] = numpy.ones(args["FLAG"].shape, dtype=numpy.float32)
+        args["IMAGING_WEIGHT_CUBE"] = self._weights.imaging_weight(args,
+            (0, self._ms.nrows()))
         args["DATA"] = residual
 
         casaimwrap.begin_grid(self._context, model.shape, \
-            coordinates.dict(), False, args)
-        result = casaimwrap.end_grid(self._context, False)
+            coordinates.dict(), False)
+        self._grid(self._average(args, coordinates, model.shape))
+        result = self._end_grid()
         self._response_available = True
 
         return (result["image"], result["weight"])
 
+    @instrumentation.timed("weights")
+    def _imaging_weight(self, chunk, block):
+        """Compute the imaging weights of a chunk that consists of the given
+        (start, count) block of rows."""
+        return self.imw.imaging_weight(chunk["UVW"], self.channel_frequency(),
+            chunk["FLAG"], self._ms.getcol("WEIGHT_SPECTRUM", block[0],
+            block[1]))
+
+    def _output_sink(self):
+        """Return a sink that writes to the output column."""
+        self._ms.ensure_column(self._data_column)
+        return OutputSink(self._ms, self._data_column, self._write_buffer)
+
+    @instrumentation.timed("averaging")
+    def _average(self, chunk, coordinates, shape):
+        """Return chunk averaged in time and frequency, if enabled."""
+        if not self._averaging_tolerance:
+            return chunk
+        return averaging.average(chunk, self.channel_frequency(),
+            averaging.field_of_view(coordinates, shape),
+            self._averaging_tolerance)
+
+    def _grid(self, chunk):
+        """Grid a chunk of visibility data, passed to casaimwrap by reference.
+        Without DATA, unit visibilities are gridded (PSF only)."""
+        buffers = _chunk_buffers(chunk)
+        if "DATA" in chunk:
+            buffers.append(numpy.ascontiguousarray(chunk["DATA"],
+                dtype=numpy.complex64))
+        else:
+            buffers.append(None)
+        with instrumentation.timer("casaimwrap.grid"):
+            casaimwrap.grid_buffers(self._context, *buffers)
+        instrumentation.count("rows.gridded", len(chunk["ANTENNA1"]))
+
+    def _degrid(self, chunk):
+        """Degrid a chunk and return the model visibilities. The model
+        visibilities are written by casaimwrap directly into the returned
+        array."""
+        data = numpy.empty(chunk["FLAG"].shape, dtype=numpy.complex64)
+        buffers = _chunk_buffers(chunk)
+        buffers.append(data)
+        with instrumentation.timer("casaimwrap.degrid"):
+            casaimwrap.degrid_buffers(self._context, *buffers)
+        instrumentation.count("rows.degridded", len(chunk["ANTENNA1"]))
+        return data
+
+    @instrumentation.timed("casaimwrap.begin_degrid")
+    def _begin_degrid(self, coordinates, model):
+        """Prepare for degridding model (includes the FFT of the model)."""
+        casaimwrap.begin_degrid(self._context, coordinates.dict(), model)
+
+    @instrumentation.timed("casaimwrap.end_grid")
+    def _end_grid(self):
+        """Finish gridding (includes the FFT of the grid) and return the
+        result."""
+        # INI: why is this False? Insert proper options here
+        return casaimwrap.end_grid(self._context, False)
+
     def _update_image_configuration(self, coordinates, shape):
         # Comparing coordinate systems is tricky!
         #
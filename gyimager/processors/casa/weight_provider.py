@@ -0,0 +1,57 @@
+import numpy
+
+class WeightProvider:
+    """Provides the IMAGING_WEIGHT_CUBE column of each chunk passed to
+    casaimwrap.
+
+    Without a weight function all imaging weights are equal to 1.0. In that
+    case imaging_weight() returns None, which tells casaimwrap to use
+    constant weights, such that no weight cube needs to be allocated at all.
+
+    Otherwise, weight_function(chunk, block) is called to compute the imaging
+    weights of a chunk, where block is the (start, count) row range of the
+    chunk. It should return an array of shape (row, channel). The weights are
+    cached per block, such that they are only computed once per imaging
+    configuration; call invalidate() when the configuration changes. The
+    weights are expanded along the correlation axis into a buffer that is
+    allocated once per chunk shape.
+    """
+
+    def __init__(self, weight_function = None):
+        self._weight_function = weight_function
+        self._weights = {}
+        self._buffers = {}
+
+    def constant(self):
+        """Return True if all imaging weights are equal to 1.0."""
+        return self._weight_function is None
+
+    def invalidate(self):
+        """Discard all cached weights."""
+        self._weights = {}
+
+    def imaging_weight(self, chunk, block = None):
+        """Return the imaging weights for chunk, or None if all weights are
+        equal to 1.0. Weights are only cached if block is given.
+
+        The returned array is re-used for the next chunk of the same shape,
+        so it should not be kept beyond the call to casaimwrap.
+        """
+        if self.constant():
+            return None
+
+        weight = self._weights.get(block)
+        if weight is None:
+            weight = numpy.asarray(self._weight_function(chunk, block),
+                dtype=numpy.float32)
+            if block is not None:
+                self._weights[block] = weight
+
+        shape = chunk["FLAG"].shape
+        buffer = self._buffers.get(shape)
+        if buffer is None:
+            buffer = numpy.empty(shape, dtype=numpy.float32)
+            self._buffers[shape] = buffer
+
+        buffer[...] = weight[:, :, numpy.newaxis]
+        return buffer
@@ -60,6 +60,12 @@ class DataProcessorBase:
         """
         """
 
+    def open_grid(self, coordinates, shape):
+        """Return a streaming.StreamingGridder, if the registry.INCREMENTAL
+        capability is declared.
+        """
+        raise NotImplementedError("open_grid not implemented")
+
     @abstractmethod
     def degrid(self, coordinates, model, normalization):
         """
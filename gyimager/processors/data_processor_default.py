@@ -1,5 +1,9 @@
 from abc import ABCMeta, abstractmethod
 from data_processor_base import *
+from product_cache import ProductCache
+from reduction import normalized
+import streaming
+from ..algorithms import instrumentation
 
 import numpy
 
@@ -14,6 +18,14 @@ class DataProcessorDefault(DataProcessorBase):
         self._cached_density = None
         self._cached_response = None
         self._weighting_needs_density = (options["weighttype"] != "natural")
+
+        # The density, average response and PSF are also cached on disk, such
+        # that they can be re-used by subsequent runs on the same data.
+        self._measurement = measurement
+        self._options = options
+        self._product_cache = ProductCache.from_options(options)
+        self._product_key = None
+
         self._create_processor(measurement, options)
 
     @abstractmethod
@@ -41,11 +53,17 @@ class DataProcessorDefault(DataProcessorBase):
 
     def point_spread_function(self, coordinates, shape):
         self._update_image_configuration(coordinates, shape)
+
+        psf = self._get_product("psf")
+        if psf is not None:
+            return psf
+
         psf, weight = self._processor.point_spread_function(self._coordinates,
             self._shape, False)
 
-        #exp_weight = weight[:, :, numpy.newaxis, numpy.newaxis]
-        #return numpy.where(exp_weight > 0.0, psf / exp_weight, 0.0)
+        # Divide out the summed weight.
+        psf = normalized(psf, weight)
+        self._put_product("psf", psf)
         return psf
 
     def density(self, coordinates, shape):
@@ -66,8 +84,7 @@ class DataProcessorDefault(DataProcessorBase):
             False)
 
         # Divide out the summed weight.
-        exp_weight = weight[:, :, numpy.newaxis, numpy.newaxis]
-        #image = numpy.where(exp_weight > 0.0, image / exp_weight, 0.0)
+        image = normalized(image, weight)
 
         # Normalize residual image to the requested normalization. Note that the
         # image produced by gridding is flat noise by default.
@@ -84,14 +101,20 @@ class DataProcessorDefault(DataProcessorBase):
             False, chunksize)
 
         # Divide out the summed weight.
-        exp_weight = weight[:, :, numpy.newaxis, numpy.newaxis]
-        #image = numpy.where(exp_weight > 0.0, image / exp_weight, 0.0)
+        image = normalized(image, weight)
 
         # Normalize residual image to the requested normalization. Note that the
         # image produced by gridding is flat noise by default.
         return (self.normalize(coordinates, image, Normalization.FLAT_NOISE,
             normalization), weight)
 
+    def open_grid(self, coordinates, shape):
+        # The snapshots are normalized, such that they are flat noise images
+        # as those returned by grid().
+        self._update_image_configuration(coordinates, shape)
+        return streaming.NormalizedGridder(self._processor.open_grid(
+            self._coordinates, self._shape))
+
     def degrid(self, coordinates, model, normalization =
         Normalization.FLAT_GAIN):
 
@@ -128,20 +151,20 @@ class DataProcessorDefault(DataProcessorBase):
             False)
 
         # Divide out the summed weight.
-        exp_weight = weight[:, :, numpy.newaxis, numpy.newaxis]
-        residual = numpy.where(exp_weight > 0.0, residual / exp_weight, 0.0)
+        residual = normalized(residual, weight)
 
         # Normalize residual image to the requested normalization. Note that the
         # residual image is flat noise by default.
         return (self.normalize(coordinates, residual, Normalization.FLAT_NOISE,
             normalization_residual), weight)
 
+    @instrumentation.timed("normalize")
     def normalize(self, coordinates, image, normalization_in,
         normalization_out):
 
-        # Identity.
+        # Identity. Note that image can be a dense image or a SparseModel.
         if normalization_in == normalization_out:
-            return numpy.copy(image)
+            return image.copy()
 
         self._update_image_configuration(coordinates, image.shape)
 
@@ -190,17 +213,36 @@ class DataProcessorDefault(DataProcessorBase):
             self._cached_density = None
             self._cached_response = None
 
+            if self._product_cache is not None:
+                self._product_key = self._product_cache.key(self._measurement,
+                    self._options, self._coordinates, self._shape)
+
             if self._weighting_needs_density:
                 self._processor.set_density(self._density(), self._coordinates)
 
     def _density(self):
+        if self._cached_density is None:
+            self._cached_density = self._get_product("density")
         if self._cached_density is None:
             self._cached_density = self._processor.density(self._coordinates,
                 self._shape)
+            self._put_product("density", self._cached_density)
         return self._cached_density
 
     def _response(self):
+        if self._cached_response is None:
+            self._cached_response = self._get_product("response")
         if self._cached_response is None:
             self._cached_response = self._processor.response(self._coordinates,
                 self._shape)
+            self._put_product("response", self._cached_response)
         return self._cached_response
+
+    def _get_product(self, name):
+        if self._product_cache is None:
+            return None
+        return self._product_cache.get(self._product_key, name)
+
+    def _put_product(self, name, value):
+        if self._product_cache is not None:
+            self._product_cache.put(self._product_key, name, value)
@@ -34,6 +34,12 @@ class DataProcessorLowLevelBase:
         """
         """
 
+    # The images returned by point_spread_function(), grid(), grid_chunk() and
+    # residual() are not normalized: they are returned together with the sum
+    # of the weights of each (channel, Stokes) plane, such that the results
+    # computed for different parts of the data can be summed (see
+    # reduction.sum_results()). DataProcessorDefault divides out the weight.
+
     @abstractmethod
     def point_spread_function(self, coordinates, shape, as_grid):
         """
@@ -54,6 +60,12 @@ class DataProcessorLowLevelBase:
         """
         """
 
+    def open_grid(self, coordinates, shape):
+        """Return a streaming.StreamingGridder, if the registry.INCREMENTAL
+        capability is declared.
+        """
+        raise NotImplementedError("open_grid not implemented")
+
     @abstractmethod
     def degrid(self, coordinates, model, as_grid):
         """
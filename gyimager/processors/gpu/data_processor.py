@@ -1,5 +1,6 @@
 import numpy
 from ...processors import Normalization
+from .. import registry
 
 class DataProcessor:
     def __init__(self, measurement, options):
@@ -18,7 +19,7 @@ class DataProcessor:
         #self._weighting_needs_density = (options["weighttype"] != "natural")
 
     def capabilities(self):
-        raise RuntimeError("GPU dataprocessor capabilities not implemented")
+        return registry.capabilities("gpu")
 
     def phase_reference(self):
         raise RuntimeError("GPU dataprocessor phase_reference not implemented")
@@ -0,0 +1,423 @@
+"""Convolutional gridding and degridding with a prolate spheroidal kernel, and
+W-stacking.
+
+Visibility samples are convolved onto (or interpolated from) a padded uv grid
+with the prolate spheroidal function used by CASA (support of 6 cells, Schwab's
+rational approximation). The taper this kernel causes in the image domain is
+divided out after gridding, and divided into the model before degridding.
+
+The W-term is handled by W-stacking: samples are binned into W-planes of equal
+width, each plane is gridded onto its own uv grid, and after the inverse FFT
+the W-screen exp(2 pi i w (n - 1)) of the plane is applied in the image domain
+before the planes are added. The width of the planes is chosen such that the
+phase error at the edge of the image is bounded.
+
+Grid coordinates follow the convention of imaging_weight: the grid position of
+a sample along an axis is its coordinate (in wavelengths) times the pixel
+increment (rad) times the size of the (padded) grid, with the origin at the
+center.
+
+The W-planes of a block of samples are independent, so they are gridded,
+degridded and transformed concurrently if a thread pool is given, and the
+number of uv grids kept in memory can be bounded (see plane_size()).
+
+This module only depends on numpy.
+"""
+
+import sys
+import threading
+import collections
+import numpy
+import numpy.fft
+
+from ..algorithms import constants
+from ..algorithms import instrumentation
+
+# Support (cells) of the gridding kernel.
+SUPPORT = 6
+
+# Number of samples processed at once, which bounds the size of the
+# temporaries used to evaluate the kernel (SUPPORT**2 values per sample).
+BLOCK_SIZE = 32768
+
+# Maximum phase error (turns) at the edge of the image due to the difference
+# between the W coordinate of a sample and that of its W-plane.
+W_TOLERANCE = 0.01
+
+# Coefficients of the rational approximation of the prolate spheroidal function
+# (alpha = 1, m = 6), for 0 <= nu < 0.75 and 0.75 <= nu <= 1.
+_P = numpy.array([[8.203343e-2, -3.644705e-1, 6.278660e-1, -5.335581e-1,
+    2.312756e-1], [4.028559e-3, -3.697768e-2, 1.021332e-1, -1.201436e-1,
+    6.412774e-2]])
+_Q = numpy.array([[1.0, 8.212018e-1, 2.078043e-1], [1.0, 9.599102e-1,
+    2.918724e-1]])
+
+def prolate_spheroidal(nu):
+    """Evaluate the prolate spheroidal function for -1 <= nu <= 1 (zero
+    outside this range)."""
+    nu = numpy.abs(nu)
+    part = (nu >= 0.75).astype(int)
+    end = numpy.where(part, 1.0, 0.75)
+    delta = nu * nu - end * end
+
+    top = _P[part, 4]
+    for k in range(3, -1, -1):
+        top = top * delta + _P[part, k]
+    bottom = _Q[part, 2]
+    for k in range(1, -1, -1):
+        bottom = bottom * delta + _Q[part, k]
+    return numpy.where(nu <= 1.0, top / bottom, 0.0)
+
+def kernel(offset):
+    """Return the gridding kernel at offset (cells) from a sample."""
+    nu = numpy.asarray(offset) / (0.5 * SUPPORT)
+    return numpy.where(numpy.abs(nu) < 1.0, (1.0 - nu * nu)
+        * prolate_spheroidal(nu), 0.0)
+
+def kernel_response(x, padded_size):
+    """Return the image domain response of the kernel at offsets x (pixels)
+    from the center of an image of padded_size pixels (along one axis)."""
+    # The (continuous) Fourier transform of the kernel, integrated at 64
+    # samples per cell.
+    step = 1.0 / 64.0
+    t = numpy.arange(-0.5 * SUPPORT, 0.5 * SUPPORT, step) + 0.5 * step
+    return numpy.dot(numpy.cos(2.0 * numpy.pi * numpy.outer(x, t)
+        / padded_size), kernel(t)) * step
+
+def taper(size, padded_size):
+    """Return the image domain response of the kernel for the central size
+    pixels of an image of padded_size pixels (along one axis)."""
+    return kernel_response(numpy.arange(size) - size // 2, padded_size)
+
+def padded_shape(shape, padding):
+    """Return the (even) shape of the uv grid for an image of shape (y, x)
+    and the given padding factor."""
+    return tuple(2 * int(numpy.ceil(0.5 * padding * n)) for n in shape)
+
+def w_step(shape, increment, w_max, w_planes = 0):
+    """Return the width (wavelengths) of a W-plane.
+
+    Keyword arguments:
+    shape -- Shape (y, x) of the image.
+    increment -- Pixel increments (rad) of the image along (y, x).
+    w_max -- Maximum absolute W coordinate (wavelengths).
+    w_planes -- Number of W-planes to cover [-w_max, w_max] with, or 0 to
+        choose the width from the field of view (see W_TOLERANCE).
+    """
+    if w_planes > 0:
+        return max(2.0 * w_max / w_planes, 1e-6)
+
+    # The W-screen varies most at the corners of the image.
+    l = 0.5 * shape[1] * abs(increment[1])
+    m = 0.5 * shape[0] * abs(increment[0])
+    n = numpy.sqrt(max(0.0, 1.0 - l * l - m * m))
+    return 2.0 * W_TOLERANCE / max(1.0 - n, 1e-12)
+
+def w_screen(shape, increment, w):
+    """Return the W-screen exp(2 pi i w (n - 1)) for W coordinate w
+    (wavelengths) on an image of shape (y, x)."""
+    l = (numpy.arange(shape[1]) - shape[1] // 2) * increment[1]
+    m = (numpy.arange(shape[0]) - shape[0] // 2) * increment[0]
+    r2 = numpy.add.outer(numpy.square(m), numpy.square(l))
+    n = numpy.sqrt(numpy.maximum(1.0 - r2, 0.0))
+    return numpy.exp(2j * numpy.pi * w * (n - 1.0))
+
+def linear_to_stokes(image):
+    """Convert an image of linear correlations (XX, XY, YX, YY) or (XX, YY)
+    to Stokes (I, Q, U, V)."""
+    stokes = numpy.zeros((4,) + image.shape[1:])
+    xx, yy = image[0], image[-1]
+    stokes[0] = 0.5 * numpy.real(xx + yy)
+    stokes[1] = 0.5 * numpy.real(xx - yy)
+    if image.shape[0] == 4:
+        stokes[2] = 0.5 * numpy.real(image[1] + image[2])
+        stokes[3] = 0.5 * numpy.imag(image[1] - image[2])
+    return stokes
+
+def stokes_to_linear(image, n_correlation):
+    """Convert an image of Stokes (I, Q, U, V) to linear correlations (XX,
+    XY, YX, YY) or, if n_correlation is 2, (XX, YY)."""
+    (i, q, u, v) = image
+    if n_correlation == 2:
+        return numpy.array([i + q, i - q], dtype=complex)
+    return numpy.array([i + q, u + 1j * v, u - 1j * v, i - q])
+
+def _taps(position, size):
+    """Return the index of the first cell covered by the kernel of each
+    sample along one axis, and the kernel values of the covered cells."""
+    first = numpy.floor(position).astype(int) - (SUPPORT // 2 - 1)
+    offset = first[:, numpy.newaxis] + numpy.arange(SUPPORT) \
+        - position[:, numpy.newaxis]
+    return (first + size // 2, kernel(offset))
+
+def _inside(first, size):
+    return (first >= 0) & (first + SUPPORT <= size)
+
+def on_grid(gx, gy, shape):
+    """Return a mask that selects the samples at grid positions (gx, gy) of
+    which the kernel fits on a grid of shape (y, x)."""
+    first = SUPPORT // 2 - 1
+    return _inside(numpy.floor(gx).astype(int) - first + shape[1] // 2,
+        shape[1]) & _inside(numpy.floor(gy).astype(int) - first + shape[0]
+        // 2, shape[0])
+
+def _footprint(gx, gy, shape):
+    """Return the flat grid indices (sample, SUPPORT**2) covered by the
+    kernel of each sample, the kernel values, and a mask that selects the
+    samples of which the kernel fits on the grid."""
+    (x0, kx) = _taps(gx, shape[1])
+    (y0, ky) = _taps(gy, shape[0])
+    inside = _inside(x0, shape[1]) & _inside(y0, shape[0])
+
+    taps = numpy.arange(SUPPORT)
+    index = (y0[:, numpy.newaxis, numpy.newaxis] + taps[:, numpy.newaxis]) \
+        * shape[1] + x0[:, numpy.newaxis, numpy.newaxis] + taps
+    weight = ky[:, :, numpy.newaxis] * kx[:, numpy.newaxis, :]
+    n = len(gx)
+    return (index.reshape(n, -1), weight.reshape(n, -1), inside)
+
+def grid_samples(grid, gx, gy, values):
+    """Convolve samples at grid positions (gx, gy) onto grid, which has shape
+    (correlation, y, x). The values have shape (sample, correlation)."""
+    flat = grid.reshape(grid.shape[0], -1)
+    for start in range(0, len(gx), BLOCK_SIZE):
+        block = slice(start, start + BLOCK_SIZE)
+        (index, weight, inside) = _footprint(gx[block], gy[block],
+            grid.shape[1:])
+        if not numpy.all(inside):
+            (index, weight) = (index[inside], weight[inside])
+        if len(index) == 0:
+            continue
+
+        # Accumulate with bincount() over the range of cells covered by the
+        # block, which is much faster than numpy.add.at().
+        low = numpy.min(index)
+        index = (index - low).ravel()
+        size = numpy.max(index) + 1
+        for k in range(grid.shape[0]):
+            value = values[block, k][inside][:, numpy.newaxis] * weight
+            flat[k, low:low + size] += numpy.bincount(index,
+                value.real.ravel(), minlength=size) + 1j \
+                * numpy.bincount(index, value.imag.ravel(), minlength=size)
+
+def degrid_samples(grid, gx, gy):
+    """Interpolate grid, which has shape (correlation, y, x), at grid
+    positions (gx, gy). Return an array of shape (sample, correlation).
+    Samples of which the kernel does not fit on the grid are zero."""
+    flat = grid.reshape(grid.shape[0], -1)
+    result = numpy.zeros((len(gx), grid.shape[0]), dtype=grid.dtype)
+    for start in range(0, len(gx), BLOCK_SIZE):
+        block = slice(start, start + BLOCK_SIZE)
+        (index, weight, inside) = _footprint(gx[block], gy[block],
+            grid.shape[1:])
+        index = numpy.where(inside[:, numpy.newaxis], index, 0)
+        weight[~inside] = 0.0
+        for k in range(grid.shape[0]):
+            result[block, k] = numpy.sum(flat[k][index] * weight, axis=1)
+    return result
+
+def plane_size(shape, padding, n_correlation):
+    """Return the size (bytes) of the uv grid of a single W-plane."""
+    padded = padded_shape(shape, padding)
+    return n_correlation * padded[0] * padded[1] \
+        * numpy.dtype(complex).itemsize
+
+def _planes(plane, selection):
+    """Return a list of (plane, samples) for each W-plane in
+    plane[selection]."""
+    selection = numpy.flatnonzero(selection)
+    order = selection[numpy.argsort(plane[selection], kind="mergesort")]
+    bounds = numpy.flatnonzero(numpy.diff(plane[order])) + 1
+    return [(plane[samples[0]], samples) for samples in numpy.split(order,
+        bounds) if len(samples) > 0]
+
+def _batches(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+class _WStack:
+    def __init__(self, shape, increment, padding, w_step, pool, max_planes):
+        self._shape = tuple(shape)
+        self._increment = tuple(increment)
+        self._padded_shape = padded_shape(shape, padding)
+        self._w_step = w_step
+
+        # The W-planes are processed concurrently if a (thread) pool is given.
+        # At most max_planes uv grids are kept in memory (0 for no limit).
+        self._pool = pool
+        self._max_planes = max_planes if max_planes > 0 else sys.maxint
+        self._grids = collections.OrderedDict()
+
+        # Pixels of the padded image that make up the image.
+        self._crop = tuple(slice(p // 2 - n // 2, p // 2 - n // 2 + n) for
+            (n, p) in zip(self._shape, self._padded_shape))
+        self._taper = numpy.outer(taper(self._shape[0],
+            self._padded_shape[0]), taper(self._shape[1],
+            self._padded_shape[1]))
+
+    def _map(self, function, items):
+        if self._pool is None or len(items) < 2:
+            return map(function, items)
+        return self._pool.map(function, items)
+
+    def _positions(self, uvw, freqs):
+        """Return the grid positions (gx, gy) and the W-plane of each sample
+        (row, channel), flattened."""
+        scale = numpy.asarray(freqs) / constants.speed_of_light
+        gx = numpy.outer(uvw[:, 0], scale * self._increment[1]
+            * self._padded_shape[1]).ravel()
+        gy = numpy.outer(uvw[:, 1], scale * self._increment[0]
+            * self._padded_shape[0]).ravel()
+        plane = numpy.round(numpy.outer(uvw[:, 2], scale)
+            / self._w_step).astype(int).ravel()
+        return (gx, gy, plane)
+
+    def _screen(self, plane):
+        return w_screen(self._shape, self._increment, plane * self._w_step)
+
+    def _reserve(self, planes):
+        """Make room for the grids of planes, by releasing the least recently
+        used grids of other planes if needed. Return the planes of which the
+        grid is not in memory."""
+        missing = [p for p in planes if p not in self._grids]
+        excess = len(self._grids) + len(missing) - self._max_planes
+        if excess > 0:
+            wanted = set(planes)
+            self._release([p for p in self._grids if p not in
+                wanted][:excess])
+
+        # Mark the grids of planes as most recently used.
+        for p in planes:
+            if p in self._grids:
+                self._grids[p] = self._grids.pop(p)
+        return missing
+
+    def _release(self, planes):
+        for p in planes:
+            del self._grids[p]
+
+class WStackGridder(_WStack):
+    """Accumulates visibilities on one uv grid per W-plane, and turns them
+    into an image.
+
+    If the number of W-planes exceeds max_planes, the grids of the least
+    recently used planes are transformed and added to the image early, to
+    bound the memory use. A plane may then be transformed more than once,
+    which costs additional FFTs.
+    """
+    def __init__(self, shape, increment, padding, w_step, n_correlation,
+        pool = None, max_planes = 0):
+        _WStack.__init__(self, shape, increment, padding, w_step, pool,
+            max_planes)
+        self._n_correlation = n_correlation
+        self._image = numpy.zeros((n_correlation,) + self._shape,
+            dtype=complex)
+        self._lock = threading.Lock()
+        self._weight = 0.0
+
+    def add(self, uvw, freqs, data, weight):
+        """Grid a block of rows.
+
+        Keyword arguments:
+        uvw -- UVW coordinates (m) of shape (row, 3).
+        freqs -- Channel frequencies (Hz).
+        data -- Visibilities of shape (row, channel, correlation), or None to
+            grid unit visibilities (PSF).
+        weight -- Imaging weights of shape (row, channel); zero for flagged
+            samples.
+        """
+        (gx, gy, plane) = self._positions(uvw, freqs)
+        weight = weight.ravel()
+        if data is None:
+            values = numpy.repeat(weight[:, numpy.newaxis],
+                self._n_correlation, axis=1).astype(complex)
+        else:
+            values = data.reshape(-1, self._n_correlation) \
+                * weight[:, numpy.newaxis]
+
+        # Samples that do not fit on the grid are skipped, and do not count
+        # towards the sum of the weights.
+        selection = (weight != 0.0) & on_grid(gx, gy, self._padded_shape)
+        self._weight += numpy.sum(weight[selection])
+
+        def _grid_plane(item):
+            (p, samples) = item
+            grid_samples(self._grids[p], gx[samples], gy[samples],
+                values[samples])
+
+        # Each W-plane is gridded by a single worker, so the workers never
+        # write to the same grid.
+        for batch in _batches(_planes(plane, selection), self._max_planes):
+            for p in self._reserve([p for (p, samples) in batch]):
+                self._grids[p] = numpy.zeros((self._n_correlation,)
+                    + self._padded_shape, dtype=complex)
+            self._map(_grid_plane, batch)
+
+    def weight(self):
+        """Return the sum of the weights of the gridded samples."""
+        return self._weight
+
+    def image(self):
+        """Return the (un-normalized) image of each correlation, of shape
+        (correlation, y, x)."""
+        self._release(list(self._grids))
+        return self._image / self._taper
+
+    def _release(self, planes):
+        """Transform the grids of planes and add them to the image."""
+        grids = [(p, self._grids.pop(p)) for p in planes]
+        size = self._padded_shape[0] * self._padded_shape[1]
+
+        def _transform(item):
+            (p, grid) = item
+            plane = numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(
+                grid, axes=(1, 2))), axes=(1, 2))
+            plane = plane[(slice(None),) + self._crop] * size
+            if p != 0:
+                plane *= self._screen(p)
+            with self._lock:
+                self._image += plane
+
+        self._map(_transform, grids)
+        instrumentation.count("w_planes.transformed", len(grids))
+
+class WStackDegridder(_WStack):
+    """Predicts visibilities from a model image, computing the uv grid of each
+    W-plane when it is needed. At most max_planes grids are cached."""
+    def __init__(self, model, increment, padding, w_step, pool = None,
+        max_planes = 0):
+        """Create a degridder for model, an image of shape (correlation, y,
+        x)."""
+        _WStack.__init__(self, model.shape[1:], increment, padding, w_step,
+            pool, max_planes)
+        self._model = model / self._taper
+
+    def predict(self, uvw, freqs):
+        """Return the visibilities of a block of rows, of shape (row, channel,
+        correlation)."""
+        (gx, gy, plane) = self._positions(uvw, freqs)
+        n_correlation = self._model.shape[0]
+        result = numpy.zeros((len(gx), n_correlation), dtype=complex)
+
+        def _degrid_plane(item):
+            (p, samples) = item
+            result[samples] = degrid_samples(self._grids[p], gx[samples],
+                gy[samples])
+
+        for batch in _batches(_planes(plane, numpy.ones(len(gx),
+            dtype=bool)), self._max_planes):
+            missing = self._reserve([p for (p, samples) in batch])
+            instrumentation.count("w_planes.transformed", len(missing))
+            for (p, grid) in zip(missing, self._map(self._transform,
+                missing)):
+                self._grids[p] = grid
+            self._map(_degrid_plane, batch)
+        return result.reshape(uvw.shape[0], -1, n_correlation)
+
+    def _transform(self, p):
+        """Return the uv grid of plane p."""
+        padded = numpy.zeros((self._model.shape[0],) + self._padded_shape,
+            dtype=complex)
+        padded[(slice(None),) + self._crop] = self._model if p == 0 \
+            else self._model * numpy.conj(self._screen(p))
+        return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(padded,
+            axes=(1, 2))), axes=(1, 2))
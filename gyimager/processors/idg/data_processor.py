@@ -0,0 +1,7 @@
+from ..data_processor_default import DataProcessorDefault
+import data_processor_low_level
+
+class DataProcessor(DataProcessorDefault):
+    def _create_processor(self, measurement, options) :
+        self._processor = \
+            data_processor_low_level.DataProcessorLowLevel(measurement, options)
@@ -0,0 +1,101 @@
+import importlib
+import numpy
+from ..reference import data_processor_low_level as reference
+from .. import image_domain_gridding
+from .. import registry
+from ..sparse_model import as_dense
+from .. import gridding
+
+class DataProcessorLowLevel(reference.DataProcessorLowLevel):
+    """Pure numpy data processor that uses image-domain gridding (see
+    image_domain_gridding) instead of convolutional gridding. The subgrids are
+    distributed over the worker threads.
+
+    Direction dependent effects (A-terms) are applied to the coarse image of
+    each subgrid, as returned by _aterm(). A-terms are only applied if a
+    Python class that computes them is given by the idg_aterm option (see
+    load_aterm()).
+    """
+    def __init__(self, measurement, options):
+        reference.DataProcessorLowLevel.__init__(self, measurement, options)
+        self._subgrid_size = options.get("subgrid_size",
+            image_domain_gridding.SUBGRID_SIZE)
+        self._time_window = options.get("time_window", 300.0)
+        self._aterm_model = load_aterm(measurement, options)
+
+    def capabilities(self):
+        return registry.capabilities("idg")
+
+    def _aterm(self):
+        """Return the A-term callable (see image_domain_gridding._IDG), or
+        None if no A-terms should be applied."""
+        return self._aterm_model
+
+    def _add(self, gridder, chunk, weight):
+        gridder.add(chunk["UVW"], self.channel_frequency(), chunk.get("DATA"),
+            weight, chunk["ANTENNA1"], chunk["ANTENNA2"], chunk["TIME"])
+
+    def _predict(self, degridder, start, nrow):
+        return degridder.predict(self._ms.getcol("UVW", start, nrow),
+            self.channel_frequency(), self._ms.getcol("ANTENNA1", start, nrow),
+            self._ms.getcol("ANTENNA2", start, nrow), self._ms.getcol("TIME",
+            start, nrow))
+
+    def _w_step(self, coordinates, shape):
+        # The W-term within a W-plane is applied exactly, so the W-planes only
+        # need to be as narrow as the support of the W-term on a subgrid
+        # requires, unless the number of W-planes is given.
+        if self._w_planes > 0:
+            return reference.DataProcessorLowLevel._w_step(self, coordinates,
+                shape)
+        return image_domain_gridding.w_step(shape[2:],
+            coordinates.get_increment()[2], self._padding, self._subgrid_size)
+
+    def _gridder(self, coordinates, shape, n_correlation):
+        # The PSF is gridded as a single correlation, without A-terms.
+        aterm = self._aterm() if n_correlation > 1 else None
+        return image_domain_gridding.IDGGridder(shape[2:],
+            coordinates.get_increment()[2], self._padding,
+            self._w_step(coordinates, shape), n_correlation,
+            self._worker_pool(), self._max_planes(shape, n_correlation),
+            self._subgrid_size, self._time_window, aterm)
+
+    def _degridder(self, coordinates, model):
+        shape = model.shape
+        model = as_dense(model)
+        # Only a single frequency is supported.
+        model = gridding.stokes_to_linear(model[0], self._n_correlation())
+        return image_domain_gridding.IDGDegridder(model,
+            coordinates.get_increment()[2], self._padding,
+            self._w_step(coordinates, shape), self._worker_pool(),
+            self._max_planes(shape, model.shape[0]), self._subgrid_size,
+            self._time_window, self._aterm())
+
+def load_aterm(measurement, options):
+    """Return the A-term model selected by options, or None if no A-terms
+    should be applied.
+
+    The idg_aterm option names the class ("module.Class") of the model, which
+    is imported and created as cls(measurement, options). The model is called
+    as model(station, time, l, m), and should return the Jones matrices of
+    station at time (MJD, s) for the directions (l, m) (direction cosines
+    relative to the phase center, 1-D arrays), as an array of shape (len(m),
+    len(l), 2, 2). It is called from the worker threads concurrently.
+
+    This interface is specific to the idg processor; the ATermPython options
+    of the casa processor are ignored.
+    """
+    name = options.get("idg_aterm")
+    if not name:
+        return None
+    (module, _, name) = name.rpartition(".")
+    if not module:
+        raise RuntimeError("Invalid A-term class: %s (expected"
+            " module.Class)" % name)
+
+    try:
+        cls = getattr(importlib.import_module(module), name)
+    except (ImportError, AttributeError), exception:
+        raise RuntimeError("Unable to load A-term class %s.%s (%s)" % (module,
+            name, exception))
+    return cls(measurement, options)
@@ -0,0 +1,311 @@
+"""Image-domain gridding (IDG).
+
+Instead of convolving each sample with a (baseline and time dependent)
+convolution kernel, the samples are partitioned into subgrids: groups of
+samples of a single baseline and W-plane, close in time, that fall within a
+small patch of the uv grid. For each subgrid, the samples are transformed
+(direct Fourier transform) onto a coarse image of the whole field, where the
+direction dependent effects (A-terms) of both stations are applied and the
+image is multiplied by the taper of the gridding kernel. The FFT of this image
+is the contribution of the samples to the patch of the uv grid, which is added
+to the uv grid of the W-plane. Degridding is the adjoint operation.
+
+The W-term within a W-plane is applied exactly, as part of the direct Fourier
+transform, so the W-planes can be much wider than for convolutional gridding:
+their width is only limited by the support of the W-term on the subgrid. The
+W-term of the plane itself is handled by W-stacking, as in gridding.
+
+Subgrids are independent, and are processed concurrently if a thread pool is
+given. This module only depends on numpy.
+"""
+
+import numpy
+import numpy.fft
+
+import gridding
+from ..algorithms import constants
+from ..algorithms import instrumentation
+
+# Default size (cells) of a subgrid.
+SUBGRID_SIZE = 32
+
+# Maximum number of samples per subgrid, which bounds the size of the phase
+# matrix (sample, pixel) of a subgrid.
+MAX_SAMPLES = 1024
+
+# Half width (cells) of the support of the W-term on a subgrid, for a sample
+# at the edge of its W-plane.
+_W_SUPPORT = 4
+
+def w_step(shape, increment, padding, subgrid_size = SUBGRID_SIZE):
+    """Return the width (wavelengths) of a W-plane, such that the support of
+    the remaining W-term fits on a subgrid (see _W_SUPPORT)."""
+    padded = gridding.padded_shape(shape, padding)
+    lm = [0.5 * padded[i] * abs(increment[i]) for i in range(2)]
+    n = numpy.sqrt(max(1.0 - lm[0] ** 2 - lm[1] ** 2, 1e-6))
+
+    # Bandwidth (cells per wavelength of W) of the W-term along each axis at
+    # the edge of the padded image.
+    bandwidth = max(lm[i] / n * abs(increment[i]) * padded[i] for i in
+        range(2))
+    return 2.0 * _W_SUPPORT / max(bandwidth, 1e-12)
+
+class Subgrid:
+    def __init__(self, plane, x0, y0, samples, station1, station2, time):
+        """A subgrid of W-plane plane, centered at cell (x0, y0) relative to
+        the center of the uv grid, that contains samples (flat indices),
+        of baseline (station1, station2) at (mean) time."""
+        self.plane = plane
+        self.x0 = x0
+        self.y0 = y0
+        self.samples = samples
+        self.station1 = station1
+        self.station2 = station2
+        self.time = time
+
+def make_subgrids(station1, station2, time, gx, gy, plane, selection, size,
+    time_window):
+    """Partition the selected samples into subgrids.
+
+    Keyword arguments:
+    station1, station2, time -- Baseline and time of each sample.
+    gx, gy -- Grid position of each sample.
+    plane -- W-plane of each sample.
+    selection -- Mask that selects the samples to partition.
+    size -- Size (cells) of a subgrid.
+    time_window -- Maximum time covered by a subgrid (s).
+    """
+    # The samples of a subgrid, and the kernel and W-term around them, should
+    # fit on the subgrid.
+    extent = size - gridding.SUPPORT - 2 * _W_SUPPORT - 2
+    if extent < 0:
+        raise RuntimeError("Subgrid size too small: %d" % size)
+
+    selection = numpy.flatnonzero(selection)
+    order = selection[numpy.lexsort((time[selection], plane[selection],
+        station2[selection], station1[selection]))]
+    change = (numpy.diff(station1[order]) != 0) \
+        | (numpy.diff(station2[order]) != 0) | (numpy.diff(plane[order]) != 0)
+    groups = numpy.split(order, numpy.flatnonzero(change) + 1)
+
+    subgrids = []
+    for group in groups:
+        start = 0
+        while start < len(group):
+            samples = group[start:start + MAX_SAMPLES]
+            (x, y, t) = (gx[samples], gy[samples], time[samples])
+            (x_min, x_max) = (numpy.minimum.accumulate(x),
+                numpy.maximum.accumulate(x))
+            (y_min, y_max) = (numpy.minimum.accumulate(y),
+                numpy.maximum.accumulate(y))
+            fits = (x_max - x_min <= extent) & (y_max - y_min <= extent) \
+                & (t - t[0] <= time_window)
+
+            # The first sample always fits.
+            n = len(samples) if numpy.all(fits) else numpy.argmin(fits)
+            samples = samples[:n]
+            subgrids.append(Subgrid(plane[samples[0]], int(numpy.round(0.5
+                * (x_min[n - 1] + x_max[n - 1]))), int(numpy.round(0.5
+                * (y_min[n - 1] + y_max[n - 1]))), samples,
+                station1[samples[0]], station2[samples[0]], numpy.mean(t[:n])))
+            start += n
+    return subgrids
+
+def _apply(aterm1, image, aterm2):
+    """Return aterm1 * image * aterm2^H for each pixel, where image has shape
+    (4, y, x) (XX, XY, YX, YY) and the A-terms have shape (y, x, 2, 2)."""
+    matrix = numpy.rollaxis(image, 0, 3).reshape(image.shape[1:] + (2, 2))
+    matrix = numpy.einsum("yxij,yxjk,yxlk->yxil", aterm1, matrix,
+        numpy.conj(aterm2))
+    return numpy.rollaxis(matrix.reshape(image.shape[1:] + (4,)), 2)
+
+class _IDG:
+    def _init_subgrids(self, subgrid_size, time_window, aterm):
+        """Set up the coarse image of a subgrid. The A-terms are given by
+        aterm(station, time, l, m), which should return the Jones matrices of
+        station at time for directions (l, m), as an array of shape (y, x, 2,
+        2); if aterm is None, no A-terms are applied."""
+        self._subgrid_size = subgrid_size
+        self._time_window = time_window
+        self._aterm = aterm
+
+        # Pixel offsets of the coarse image relative to its center, as a
+        # fraction of the image size, and the corresponding directions.
+        size = subgrid_size
+        self._offset = (numpy.arange(size) - size // 2) / float(size)
+        self._l = self._offset * self._padded_shape[1] * self._increment[1]
+        self._m = self._offset * self._padded_shape[0] * self._increment[0]
+        r2 = numpy.add.outer(numpy.square(self._m), numpy.square(self._l))
+        self._n = (numpy.sqrt(numpy.maximum(1.0 - r2, 0.0)) - 1.0).ravel()
+
+        # The taper of the gridding kernel, evaluated on the coarse image.
+        self._subgrid_taper = numpy.outer(gridding.kernel_response(
+            self._offset * self._padded_shape[0], self._padded_shape[0]),
+            gridding.kernel_response(self._offset * self._padded_shape[1],
+            self._padded_shape[1]))
+
+    def _coordinates(self, uvw, freqs):
+        """Return the grid positions (gx, gy), the W coordinate (wavelengths)
+        and the W-plane of each sample (row, channel), flattened."""
+        (gx, gy, plane) = self._positions(uvw, freqs)
+        scale = numpy.asarray(freqs) / constants.speed_of_light
+        return (gx, gy, numpy.outer(uvw[:, 2], scale).ravel(), plane)
+
+    def _subgrids(self, antenna1, antenna2, time, gx, gy, plane, selection):
+        """Partition the selected samples into subgrids that fit on the uv
+        grid."""
+        # Samples should be far enough from the edge of the uv grid for their
+        # kernel and W-term to fit. Subgrids that would extend beyond the
+        # edge are moved inwards, which keeps their samples on the subgrid.
+        margin = gridding.SUPPORT // 2 + _W_SUPPORT + 1
+        selection = selection \
+            & (numpy.abs(gx) < self._padded_shape[1] // 2 - margin) \
+            & (numpy.abs(gy) < self._padded_shape[0] // 2 - margin)
+        n_channel = len(gx) // len(time)
+        subgrids = make_subgrids(numpy.repeat(antenna1, n_channel),
+            numpy.repeat(antenna2, n_channel), numpy.repeat(time, n_channel),
+            gx, gy, plane, selection, self._subgrid_size, self._time_window)
+
+        half = self._subgrid_size // 2
+        (x_max, y_max) = (self._padded_shape[1] // 2 - half,
+            self._padded_shape[0] // 2 - half)
+        for subgrid in subgrids:
+            subgrid.x0 = min(max(subgrid.x0, -x_max), x_max)
+            subgrid.y0 = min(max(subgrid.y0, -y_max), y_max)
+        return subgrids
+
+    def _phase(self, subgrid, gx, gy, w):
+        """Return the phase factors (sample, pixel) of the direct Fourier
+        transform of the samples of subgrid to its coarse image."""
+        samples = subgrid.samples
+        ex = numpy.exp(2j * numpy.pi * numpy.outer(gx[samples] - subgrid.x0,
+            self._offset))
+        ey = numpy.exp(2j * numpy.pi * numpy.outer(gy[samples] - subgrid.y0,
+            self._offset))
+        ew = numpy.exp(2j * numpy.pi * numpy.outer(w[samples] - subgrid.plane
+            * self._w_step, self._n))
+        return (ey[:, :, numpy.newaxis] * ex[:, numpy.newaxis, :]).reshape(
+            len(samples), -1) * ew
+
+    def _aterms(self, subgrid):
+        if self._aterm is None:
+            return None
+        return (self._aterm(subgrid.station1, subgrid.time, self._l, self._m),
+            self._aterm(subgrid.station2, subgrid.time, self._l, self._m))
+
+    def _window(self, subgrid):
+        """Return the slices of the uv grid covered by subgrid."""
+        size = self._subgrid_size
+        x = subgrid.x0 + self._padded_shape[1] // 2 - size // 2
+        y = subgrid.y0 + self._padded_shape[0] // 2 - size // 2
+        return (slice(None), slice(y, y + size), slice(x, x + size))
+
+    def _by_plane(self, subgrids):
+        """Return the subgrids in batches that cover at most max_planes
+        W-planes."""
+        planes = sorted(set(subgrid.plane for subgrid in subgrids))
+        batches = []
+        for i in range(0, len(planes), self._max_planes):
+            batch = set(planes[i:i + self._max_planes])
+            batches.append((sorted(batch), [subgrid for subgrid in subgrids if
+                subgrid.plane in batch]))
+        return batches
+
+class IDGGridder(_IDG, gridding.WStackGridder):
+    """Accumulates visibilities on one uv grid per W-plane by image-domain
+    gridding, and turns them into an image (see gridding.WStackGridder)."""
+    def __init__(self, shape, increment, padding, w_step, n_correlation,
+        pool = None, max_planes = 0, subgrid_size = SUBGRID_SIZE,
+        time_window = 300.0, aterm = None):
+        gridding.WStackGridder.__init__(self, shape, increment, padding,
+            w_step, n_correlation, pool, max_planes)
+        if aterm is not None and n_correlation != 4:
+            raise RuntimeError("A-terms require four correlations")
+        self._init_subgrids(subgrid_size, time_window, aterm)
+
+    def add(self, uvw, freqs, data, weight, antenna1, antenna2, time):
+        """Grid a block of rows (see gridding.WStackGridder.add()). The
+        stations and time of each row are used to partition the samples into
+        subgrids and to evaluate the A-terms."""
+        (gx, gy, w, plane) = self._coordinates(uvw, freqs)
+        weight = weight.ravel()
+        if data is None:
+            values = numpy.repeat(weight[:, numpy.newaxis],
+                self._n_correlation, axis=1).astype(complex)
+        else:
+            values = data.reshape(-1, self._n_correlation) \
+                * weight[:, numpy.newaxis]
+
+        subgrids = self._subgrids(antenna1, antenna2, time, gx, gy, plane,
+            weight != 0.0)
+        instrumentation.count("subgrids.gridded", len(subgrids))
+
+        def _grid_subgrid(subgrid):
+            # Direct Fourier transform onto the coarse image.
+            image = numpy.dot(values[subgrid.samples].T, self._phase(subgrid,
+                gx, gy, w)).reshape((self._n_correlation,)
+                + self._subgrid_taper.shape)
+
+            aterms = self._aterms(subgrid)
+            if aterms is not None:
+                image = _apply(numpy.conj(numpy.swapaxes(aterms[0], 2, 3)),
+                    image, numpy.conj(numpy.swapaxes(aterms[1], 2, 3)))
+            image *= self._subgrid_taper
+
+            return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(image,
+                axes=(1, 2))), axes=(1, 2)) / image[0].size
+
+        for (planes, batch) in self._by_plane(subgrids):
+            for p in self._reserve(planes):
+                self._grids[p] = numpy.zeros((self._n_correlation,)
+                    + self._padded_shape, dtype=complex)
+            for (subgrid, uv) in zip(batch, self._map(_grid_subgrid, batch)):
+                self._grids[subgrid.plane][self._window(subgrid)] += uv
+                self._weight += numpy.sum(weight[subgrid.samples])
+
+class IDGDegridder(_IDG, gridding.WStackDegridder):
+    """Predicts visibilities from a model image by image-domain degridding
+    (see gridding.WStackDegridder)."""
+    def __init__(self, model, increment, padding, w_step, pool = None,
+        max_planes = 0, subgrid_size = SUBGRID_SIZE, time_window = 300.0,
+        aterm = None):
+        gridding.WStackDegridder.__init__(self, model, increment, padding,
+            w_step, pool, max_planes)
+        if aterm is not None and model.shape[0] != 4:
+            raise RuntimeError("A-terms require four correlations")
+        self._init_subgrids(subgrid_size, time_window, aterm)
+
+    def predict(self, uvw, freqs, antenna1, antenna2, time):
+        """Return the visibilities of a block of rows, of shape (row, channel,
+        correlation). Samples that do not fit on the uv grid are zero."""
+        (gx, gy, w, plane) = self._coordinates(uvw, freqs)
+        n_correlation = self._model.shape[0]
+        result = numpy.zeros((len(gx), n_correlation), dtype=complex)
+
+        subgrids = self._subgrids(antenna1, antenna2, time, gx, gy, plane,
+            numpy.ones(len(gx), dtype=bool))
+        instrumentation.count("subgrids.degridded", len(subgrids))
+
+        def _degrid_subgrid(subgrid):
+            uv = self._grids[subgrid.plane][self._window(subgrid)]
+            image = numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(uv,
+                axes=(1, 2))), axes=(1, 2)) * uv[0].size
+            image *= self._subgrid_taper
+
+            aterms = self._aterms(subgrid)
+            if aterms is not None:
+                image = _apply(aterms[0], image, aterms[1])
+
+            # Direct Fourier transform to the samples.
+            result[subgrid.samples] = numpy.dot(numpy.conj(self._phase(
+                subgrid, gx, gy, w)), image.reshape(n_correlation, -1).T) \
+                / image[0].size
+
+        for (planes, batch) in self._by_plane(subgrids):
+            missing = self._reserve(planes)
+            instrumentation.count("w_planes.transformed", len(missing))
+            for (p, grid) in zip(missing, self._map(self._transform,
+                missing)):
+                self._grids[p] = grid
+            self._map(_degrid_subgrid, batch)
+        return result.reshape(uvw.shape[0], -1, n_correlation)
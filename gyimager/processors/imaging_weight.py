@@ -0,0 +1,124 @@
+import numpy
+from ..algorithms import constants
+
+def density(uvw, freqs, weight_spectrum, shape, increment):
+    """Compute the (symmetric) density of the visibility weights on a uv grid.
+
+    Keyword arguments:
+    uvw -- UVW coordinates (m) of shape (row, 3).
+    freqs -- Channel frequencies (Hz).
+    weight_spectrum -- Visibility weights of shape (row, channel,
+        correlation).
+    shape -- Shape (v, u) of the uv grid, i.e. the shape of the image.
+    increment -- Pixel increments (rad) of the image along (y, x).
+    """
+    weight = numpy.sum(weight_spectrum, axis=2)
+
+    (u, v, inside) = _uv_cells(uvw, freqs, shape, increment)
+    (uorig, vorig) = (shape[1] // 2, shape[0] // 2)
+
+    index = numpy.concatenate(((vorig + v[inside]) * shape[1] + uorig
+        + u[inside], (vorig - v[inside]) * shape[1] + uorig - u[inside]))
+    weight = numpy.concatenate((weight[inside], weight[inside]))
+    return numpy.bincount(index, weight, minlength=shape[0]
+        * shape[1]).reshape(shape)
+
+def _uv_cells(uvw, freqs, shape, increment):
+    """Return the (u, v) cell indices (relative to the center of the grid) of
+    each visibility sample, along with a mask that selects the samples that
+    fall within the grid."""
+    f = numpy.asarray(freqs) / constants.speed_of_light
+    uscale = shape[1] * increment[1]
+    vscale = shape[0] * increment[0]
+
+    # Conversion to int truncates towards zero, as int() does.
+    u = numpy.outer(uvw[:, 0] * uscale, f).astype(int)
+    v = numpy.outer(uvw[:, 1] * vscale, f).astype(int)
+    inside = (numpy.abs(u) < shape[1] // 2) & (numpy.abs(v) < shape[0] // 2)
+    return (u, v, inside)
+
+class ImagingWeight :
+    def __init__( self, **kwargs ):
+        try :
+            weighttype = kwargs["weighttype"]
+        except KeyError:
+            raise RuntimeError("No weighttype defined")
+        weighttypes = ["uniform", "radial", "natural", "robust"]
+        if weighttype not in weighttypes:
+            raise RuntimeError("Unknown weighttype: " + weighttype + "\n" + "weighttype should be one of " + str(weighttypes))
+
+        self.weighttype = weighttype
+        self.density = None
+        if weighttype == "natural":
+            self.imaging_weight = self.weightNatural
+        elif weighttype == "radial":
+            self.imaging_weight = self.weightRadial
+        elif weighttype == "uniform":
+            self.imaging_weight = self.weightDensityDependent
+        elif weighttype == "robust":
+            self.imaging_weight = self.weightDensityDependent
+            try:
+                rmode = kwargs["rmode"]
+            except KeyError:
+                raise RuntimeError("Robust weighting requires rmode parameter")
+            rmodes = ["abs", "normal"]
+            if rmode not in rmodes:
+                raise RuntimeError("Unknown rmode: " + rmode + "\n" + "rmode should be one of " + str(rmodes))
+            self.rmode = rmode
+            try:
+                self.robustness = kwargs["robustness"]
+            except KeyError:
+                raise RuntimeError("Robust weighting requires robustness parameter")
+            if rmode == "abs":
+                try:
+                    self.noise = kwargs["noise"]
+                except KeyError:
+                   raise RuntimeError("Robust weighting with rmode = abs requires noise parameter")
+
+    def needs_density(self):
+        """Return True if the weights depend on the density of the uv
+        coverage, i.e. set_density() needs to be called first."""
+        return self.imaging_weight == self.weightDensityDependent
+
+    def weightNatural(self, uvw, freqs, flag, weight_spectrum):
+        imaging_weight = weight_spectrum.mean(axis=2) * numpy.float32((1 - flag.any(axis=2)))
+        return imaging_weight
+
+    def weightRadial(self, uvw, freqs, flag, weight_spectrum):
+        raise RuntimeError("weightRadial not implemented")
+
+    def weightDensityDependent(self, uvw, freqs, flag, weight_spectrum):
+        if self.density is None:
+            raise RuntimeError("Density dependent weighting requires the"
+                " density to be set first")
+
+        imaging_weight = weight_spectrum.mean(axis=2) * numpy.float32((1 - flag.any(axis=2)))
+
+        (u, v, inside) = _uv_cells(uvw, freqs, self.density.shape,
+            self.density_increment)
+        (uorig, vorig) = (self.density.shape[1] // 2,
+            self.density.shape[0] // 2)
+
+        # Samples in empty cells can only have zero weight, so these are left
+        # alone to avoid dividing by zero.
+        scale = self.density[vorig + v[inside], uorig + u[inside]] * self.f2 \
+            + self.d2
+        imaging_weight[inside] /= numpy.where(scale > 0.0, scale, 1.0)
+        return imaging_weight
+
+    def set_density( self, density, coordinates):
+        self.density = density
+        self.density_increment = coordinates.get_increment()[2]
+        if self.weighttype == "uniform":
+            self.f2 = 1.0
+            self.d2 = 0.0
+        else:
+            if self.rmode == "abs":
+                # Same definition as CASA, with the noise in Jy.
+                self.f2 = self.robustness**2
+                self.d2 = 2.0 * self.noise**2
+            elif self.rmode == "normal":
+                sumwt = numpy.sum(density)
+                sumlocwt = numpy.sum(density*density)
+                self.f2 = (5.0*pow(10.0,-self.robustness))**2 / (sumlocwt / sumwt)
+                self.d2 = 1.0
@@ -0,0 +1,18 @@
+# $Id$
+
+from data_processor_local import DataProcessorLocal
+from data_processor_local_low_level import DataProcessorLocalLowLevel
+
+def create_data_processor(measurement, options):
+    """Factory function that can be used to switch to a specialized class
+    depending on the options and the measurement(s) to be processed.
+    """
+
+    return DataProcessorLocal(measurement, options)
+
+def create_data_processor_low_level(measurement, options):
+    """Factory function that can be used to switch to a specialized class
+    depending on the options and the measurement(s) to be processed.
+    """
+
+    return DataProcessorLocalLowLevel(measurement, options)
@@ -0,0 +1,7 @@
+from ..data_processor_default import DataProcessorDefault
+from data_processor_local_low_level import DataProcessorLocalLowLevel
+
+class DataProcessorLocal(DataProcessorDefault):
+
+    def _create_processor(self, measurement, options):
+        self._processor = DataProcessorLocalLowLevel(measurement, options)
@@ -0,0 +1,240 @@
+"""Intra-node parallel data processor.
+
+The selected rows of a measurement are split into time slices of (about) the
+same number of rows. Each slice is processed by a worker process, with its own
+instance of the data processor selected by the processor option (and thus its
+own casa context). No ipcontroller is needed.
+
+The images computed by the workers are passed back through shared memory
+(files in /dev/shm) instead of being pickled through a pipe, and are summed by
+the parent process. Degridding is not supported, because the workers would
+write to the same measurement concurrently.
+"""
+
+import os
+import shutil
+import tempfile
+import traceback
+import multiprocessing
+import numpy
+from ..data_processor_low_level_base import DataProcessorLowLevelBase
+from ..ms_reader import MSReader
+from ..reduction import sum_results
+from .. import registry
+from ...algorithms import instrumentation
+
+# Directory in which shared memory buffers are created (if it exists).
+_SHARED_MEMORY = "/dev/shm"
+
+# How the result of a call is passed back to the parent process: pickled, or
+# (the image part of the result) through a shared memory buffer.
+(_VALUE, _SUM) = range(2)
+
+def time_slices(time, n_slice):
+    """Return at most n_slice (start, end) time slices (end exclusive) that
+    together cover all values in time, such that each slice covers about the
+    same number of time stamps."""
+    unique = numpy.unique(time)
+    if len(unique) == 0:
+        return [None]
+
+    n_slice = max(1, min(n_slice, len(unique)))
+    bounds = [unique[(k * len(unique)) // n_slice] for k in range(n_slice)]
+    bounds.append(numpy.nextafter(unique[-1], numpy.inf))
+    return [(float(start), float(end)) for (start, end) in zip(bounds[:-1],
+        bounds[1:])]
+
+def _selected_time(measurement, options):
+    return MSReader(measurement, options).getcol("TIME")
+
+def _share(directory, array):
+    """Copy array to a new shared memory buffer in directory, and return its
+    description (path, shape, dtype)."""
+    array = numpy.asarray(array)
+    (handle, path) = tempfile.mkstemp(dir = directory)
+    os.close(handle)
+    buffer = numpy.memmap(path, dtype = array.dtype, mode = "w+", shape =
+        array.shape)
+    buffer[...] = array
+    buffer.flush()
+    return (path, array.shape, array.dtype.str)
+
+def _sum_shared(buffers):
+    """Return the sum of the shared memory buffers, and remove them."""
+    total = None
+    for (path, shape, dtype) in buffers:
+        buffer = numpy.memmap(path, dtype = dtype, mode = "r", shape = shape)
+        if total is None:
+            total = numpy.array(buffer)
+        else:
+            total += buffer
+        del buffer
+        os.remove(path)
+    return total
+
+def _serve(connection, measurement, options, directory):
+    """Worker process: create the data processor, and execute the calls
+    received through connection until None is received."""
+    from .. import create_data_processor_low_level
+
+    try:
+        processor = create_data_processor_low_level(measurement, options)
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+        return
+    connection.send(("ok", None))
+
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+
+        (method, args, mode) = request
+        try:
+            result = getattr(processor, method)(*args)
+            if mode == _VALUE:
+                reply = result
+            elif isinstance(result, tuple):
+                reply = (_share(directory, result[0]), result[1])
+            else:
+                reply = (_share(directory, result), None)
+        except Exception:
+            connection.send(("error", traceback.format_exc()))
+            continue
+        connection.send(("ok", reply))
+
+class DataProcessorLocalLowLevel(DataProcessorLowLevelBase):
+    def __init__(self, measurement, options):
+        slices = time_slices(_selected_time(measurement, options),
+            options.get("processes", 1))
+
+        self._directory = tempfile.mkdtemp(prefix = "gyimager-", dir =
+            _SHARED_MEMORY if os.path.isdir(_SHARED_MEMORY) else None)
+        self._processes = []
+        self._connections = []
+        for time_slice in slices:
+            worker_options = dict(options)
+            worker_options["processes"] = 1
+            worker_options["time_slice"] = time_slice
+            # The threads are divided among the workers.
+            worker_options["threads"] = max(1, options.get("threads", 1)
+                // len(slices))
+
+            (connection, child_connection) = multiprocessing.Pipe()
+            process = multiprocessing.Process(target = _serve, args =
+                (child_connection, measurement, worker_options,
+                self._directory))
+            process.daemon = True
+            process.start()
+            child_connection.close()
+            self._processes.append(process)
+            self._connections.append(connection)
+
+        # Wait until all workers have created their data processor.
+        self._receive(self._connections)
+
+    def capabilities(self):
+        capabilities = self._call("capabilities", (), _VALUE,
+            self._connections[:1])[0]
+        capabilities[registry.DEGRID] = False
+        capabilities[registry.INCREMENTAL] = False
+        return capabilities
+
+    def phase_reference(self):
+        return self._call("phase_reference", (), _VALUE,
+            self._connections[:1])[0]
+
+    def channel_frequency(self):
+        return self._call("channel_frequency", (), _VALUE,
+            self._connections[:1])[0]
+
+    def channel_width(self):
+        return self._call("channel_width", (), _VALUE,
+            self._connections[:1])[0]
+
+    def maximum_baseline_length(self):
+        return max(self._call("maximum_baseline_length"))
+
+    def density(self, coordinates, shape):
+        return self._sum("density", (coordinates, shape))
+
+    def set_density(self, density, coordinates):
+        self._call("set_density", (density, coordinates))
+
+    def response(self, coordinates, shape):
+        # The average response of the whole measurement is approximated by
+        # the mean of the average responses of the slices, which contain about
+        # the same number of rows.
+        return self._sum("response", (coordinates, shape)) \
+            / len(self._connections)
+
+    # The images returned by the data processors of the workers are not
+    # normalized (see DataProcessorLowLevelBase), and are summed together with
+    # their weights.
+
+    def point_spread_function(self, coordinates, shape, as_grid):
+        return self._sum("point_spread_function", (coordinates, shape,
+            as_grid))
+
+    def grid(self, coordinates, shape, as_grid):
+        return self._sum("grid", (coordinates, shape, as_grid))
+
+    def grid_chunk(self, coordinates, shape, as_grid, chunksize):
+        return self._sum("grid_chunk", (coordinates, shape, as_grid,
+            chunksize))
+
+    def degrid(self, coordinates, model, as_grid):
+        raise NotImplementedError("degrid not implemented")
+
+    def degrid_chunk(self, coordinates, model, as_grid, chunksize):
+        raise NotImplementedError("degrid not implemented")
+
+    def residual(self, coordinates, model, as_grid):
+        return self._sum("residual", (coordinates, model, as_grid))
+
+    def close(self):
+        for connection in self._connections:
+            try:
+                connection.send(None)
+            except (IOError, EOFError):
+                pass
+        for process in self._processes:
+            process.join()
+        self._connections = []
+        self._processes = []
+        shutil.rmtree(self._directory, ignore_errors = True)
+
+    def __del__(self):
+        self.close()
+
+    def _call(self, method, args = (), mode = _VALUE, connections = None):
+        """Call method with args on the data processors of the workers
+        (default: all), and return their replies."""
+        if connections is None:
+            connections = self._connections
+        with instrumentation.timer("local.remote"):
+            for connection in connections:
+                connection.send((method, args, mode))
+            return self._receive(connections)
+
+    def _receive(self, connections):
+        """Return the replies of the workers. If any worker failed, raise a
+        RuntimeError (after all replies have been received)."""
+        replies = [connection.recv() for connection in connections]
+        for (status, reply) in replies:
+            if status != "ok":
+                raise RuntimeError("Worker process failed:\n%s" % reply)
+        return [reply for (status, reply) in replies]
+
+    def _sum(self, method, args):
+        """Call method on all workers, and return the sum of the results."""
+        replies = self._call(method, args, _SUM)
+        with instrumentation.timer("local.reduce"):
+            image = _sum_shared([buffer for (buffer, weight) in replies])
+            if replies[0][1] is None:
+                return image
+            return (image, sum_results([weight for (buffer, weight) in
+                replies]))
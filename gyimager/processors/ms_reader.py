@@ -0,0 +1,241 @@
+"""Access to the visibility data of a measurement set, restricted to a
+selection of rows, channels and correlations.
+
+Row selections (time range, uv range) are pushed down into a TaQL query, such
+that unselected rows are never read. Channel and correlation selections are
+pushed down into getcolslice(), such that only the selected part of each cell
+is read from disk.
+
+The gridders expect cells that cover all channels and correlations of the
+spectral window. Therefore, by default, the arrays returned by getcol() are
+expanded to the full cell shape, where the unselected samples are flagged and
+all other columns are zero.
+"""
+
+import os.path as path
+import numpy
+import pyrap.tables
+
+from ..algorithms import instrumentation
+
+# Rows that are always excluded: auto-correlations and all observations,
+# fields and data descriptions other than the first.
+_BASE_QUERY = "ANTENNA1 != ANTENNA2 && OBSERVATION_ID == 0 && FIELD_ID == 0" \
+    " && DATA_DESC_ID == 0"
+
+# Approximate size (number of elements) of the tiles of a column created by
+# ensure_column(), if the number of rows per tile is not specified.
+_TILE_SIZE = 131072
+
+# Columns that contain a (channel, correlation) array per row.
+_SPECTRAL_COLUMNS = ["DATA", "CORRECTED_DATA", "MODEL_DATA", "FLAG",
+    "WEIGHT_SPECTRUM", "SIGMA_SPECTRUM"]
+
+class MSReader:
+    def __init__(self, measurement, options, readonly = True):
+        """Open measurement and apply the selection defined by options.
+
+        Supported options (all optional, None means no selection):
+        time_range -- (start, end) time (s) relative to the start of the
+            observation.
+        time_slice -- (start, end) absolute time (s), where end is
+            exclusive, such that adjacent slices do not overlap.
+        uv_range -- (min, max) projected baseline length (m).
+        channels -- (first, last) channel (inclusive).
+        correlations -- List of correlation indices.
+        """
+        self._measurement = measurement
+        self._table = pyrap.tables.table(measurement, readonly = readonly)
+
+        # Shape of a cell of a spectral column, i.e. (channel, correlation).
+        spw = pyrap.tables.table(path.join(measurement, "SPECTRAL_WINDOW"))
+        pol = pyrap.tables.table(path.join(measurement, "POLARIZATION"))
+        self._cell_shape = (spw.getcell("NUM_CHAN", 0), pol.getcell("NUM_CORR",
+            0))
+
+        self._time_range = options.get("time_range")
+        self._time_slice = options.get("time_slice")
+        self._uv_range = options.get("uv_range")
+
+        channels = options.get("channels")
+        if channels is None:
+            channels = (0, self._cell_shape[0] - 1)
+        if channels[0] < 0 or channels[1] >= self._cell_shape[0] \
+            or channels[0] > channels[1]:
+            raise RuntimeError("Invalid channel range: %d-%d (measurement has"
+                " %d channels)" % (channels[0], channels[1],
+                self._cell_shape[0]))
+        self._channels = (int(channels[0]), int(channels[1]))
+
+        correlations = options.get("correlations")
+        if correlations is None:
+            correlations = range(self._cell_shape[1])
+        correlations = sorted(set(int(x) for x in correlations))
+        if len(correlations) == 0 or correlations[0] < 0 \
+            or correlations[-1] >= self._cell_shape[1]:
+            raise RuntimeError("Invalid correlation selection: %s (measurement"
+                " has %d correlations)" % (correlations, self._cell_shape[1]))
+        self._correlations = correlations
+
+        self._ms = self._table.query(self.query())
+
+    def query(self):
+        """Return the TaQL expression that selects the rows to process."""
+        terms = [_BASE_QUERY]
+
+        if self._time_range is not None:
+            observation = pyrap.tables.table(path.join(self._measurement,
+                "OBSERVATION"))
+            start = observation.getcell("TIME_RANGE", 0)[0]
+            terms.append("TIME >= %.17g && TIME <= %.17g" % (start
+                + self._time_range[0], start + self._time_range[1]))
+
+        if self._time_slice is not None:
+            terms.append("TIME >= %.17g && TIME < %.17g" % self._time_slice)
+
+        if self._uv_range is not None:
+            # The query is evaluated in Python style (the default of
+            # table.query()), i.e. array indices are 0-based.
+            uv_distance = "SQRT(SQUARE(UVW[0]) + SQUARE(UVW[1]))"
+            terms.append("%s >= %.17g && %s <= %.17g" % (uv_distance,
+                self._uv_range[0], uv_distance, self._uv_range[1]))
+
+        return " && ".join(terms)
+
+    def selection(self):
+        """Return a description of the selection, which can be used to
+        identify data derived from it."""
+        return {"query": self.query(), "channels": list(self._channels),
+            "correlations": list(self._correlations)}
+
+    def selects_samples(self):
+        """Return True if a subset of the channels or correlations is
+        selected."""
+        return self._channels != (0, self._cell_shape[0] - 1) \
+            or len(self._correlations) != self._cell_shape[1]
+
+    def nrows(self):
+        return self._ms.nrows()
+
+    def __len__(self):
+        return self.nrows()
+
+    def rownumbers(self):
+        """Return the row numbers in the measurement set of the selected
+        rows."""
+        return numpy.asarray(self._ms.rownumbers(self._table))
+
+    def getcol(self, name, start = 0, nrow = -1, expand = True):
+        """Read column name for nrow rows starting at row start.
+
+        For spectral columns only the selected channels and correlations are
+        read. If expand is True, the result is expanded to the full cell
+        shape, where unselected samples are zero (or True for FLAG).
+        """
+        with instrumentation.timer("ms.read"):
+            value = self._getcol(name, start, nrow, expand)
+        instrumentation.count("ms.read.bytes", value.nbytes)
+        return value
+
+    def _getcol(self, name, start, nrow, expand):
+        if not self._is_spectral(name) or not self.selects_samples():
+            return self._ms.getcol(name, start, nrow)
+
+        # Read the bounding box of the selection.
+        (first, last) = (self._correlations[0], self._correlations[-1])
+        value = self._ms.getcolslice(name, [self._channels[0], first],
+            [self._channels[1], last], [], start, nrow)
+        contiguous = last - first + 1 == len(self._correlations)
+        if not contiguous:
+            value = value[:, :, [x - first for x in self._correlations]]
+
+        if not expand:
+            return value
+
+        if name == "FLAG":
+            result = numpy.ones(value.shape[:1] + self._cell_shape,
+                dtype=value.dtype)
+        else:
+            result = numpy.zeros(value.shape[:1] + self._cell_shape,
+                dtype=value.dtype)
+        result[:, self._channels[0]:self._channels[1] + 1,
+            self._correlations] = value
+        return result
+
+    def putcol(self, name, value, start = 0, nrow = -1):
+        """Write column name for nrow rows starting at row start. For
+        spectral columns, value should be of the full cell shape; only the
+        selected channels and correlations are written."""
+        with instrumentation.timer("ms.write"):
+            self._putcol(name, value, start, nrow)
+        instrumentation.count("ms.write.bytes", value.nbytes)
+
+    def _putcol(self, name, value, start, nrow):
+        if not self._is_spectral(name) or not self.selects_samples():
+            self._ms.putcol(name, value, start, nrow)
+            return
+
+        channels = slice(self._channels[0], self._channels[1] + 1)
+        for (first, last) in _ranges(self._correlations):
+            self._ms.putcolslice(name, value[:, channels, first:last + 1],
+                [self._channels[0], first], [self._channels[1], last], [],
+                start, nrow)
+
+    def ensure_column(self, name, like = "DATA", tile_rows = 0):
+        """Create spectral column name if it does not exist, with the same
+        description as column like, stored with the tiled column storage
+        manager. Each tile covers all channels and correlations of tile_rows
+        rows (if 0, rows are added until a tile holds about 128K elements).
+
+        If the column does exist, check that it can hold visibility data.
+        """
+        if name in self._table.colnames():
+            description = self._table.getcoldesc(name)
+            if description.get("valueType") not in ("complex", "dcomplex") \
+                or description.get("ndim", 2) not in (-1, 2):
+                raise RuntimeError("Column %s cannot hold visibility data"
+                    % name)
+            return
+
+        if tile_rows <= 0:
+            tile_rows = max(1, _TILE_SIZE // (self._cell_shape[0]
+                * self._cell_shape[1]))
+
+        description = self._table.getcoldesc(like)
+        description["name"] = name
+        description.pop("dataManagerType", None)
+        description.pop("dataManagerGroup", None)
+
+        # The tile shape is in Fortran order, i.e. (correlation, channel,
+        # row).
+        dminfo = {"TYPE": "TiledColumnStMan", "NAME": name + "_TSM",
+            "SPEC": {"DEFAULTTILESHAPE": [self._cell_shape[1],
+            self._cell_shape[0], tile_rows]}}
+        self._table.addcols(pyrap.tables.maketabdesc(
+            pyrap.tables.makecoldesc(name, description)), dminfo)
+
+        # The selection does not include columns added afterwards.
+        self._ms = self._table.query(self.query())
+
+    def tile_rows(self, name):
+        """Return the number of rows per tile of column name, or 1 if the
+        column is not tiled."""
+        spec = self._table.getdminfo(name).get("SPEC", {})
+        shape = spec.get("DEFAULTTILESHAPE")
+        if shape is None:
+            return 1
+        return max(1, int(shape[-1]))
+
+    def _is_spectral(self, name):
+        return name in _SPECTRAL_COLUMNS
+
+def _ranges(indices):
+    """Split a sorted list of indices into (first, last) ranges of
+    consecutive indices."""
+    ranges = []
+    for index in indices:
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1] = (ranges[-1][0], index)
+        else:
+            ranges.append((index, index))
+    return ranges
@@ -0,0 +1,152 @@
+"""Buffered, asynchronous writing of degridded visibilities.
+
+Degridding produces the model visibilities chunk by chunk. Writing each chunk
+with a separate putcol() stalls the degridder on I/O, and small writes that do
+not line up with the tiles of the output column cause tiles to be read,
+modified and written more than once.
+
+OutputSink collects consecutive chunks until a configurable amount of data is
+buffered, and hands the buffered rows to a background thread that writes them
+with a single putcol(). The rows written are rows of the selection of the
+reader, which need not be consecutive in the measurement set. Therefore, each
+write ends at a row of which the row number in the measurement set is a
+multiple of the number of rows per tile of the output column, or where the
+selection skips rows of the measurement set (both end a tile). A write is only
+split at tile boundaries, but it covers whole tiles only if the selection is
+contiguous.
+
+The writes only overlap with the degridding of the next chunks while the
+degridder releases the GIL. casaimwrap releases it during degridding, unless
+the A-term is implemented in Python (ATermPython, which the gyimager commands
+use): then the GIL is held for the whole call, and the writes mostly proceed
+while the next chunk is read.
+"""
+
+import time
+import Queue
+import threading
+import numpy
+
+from ..algorithms import util
+
+class OutputSink:
+    def __init__(self, reader, column, buffer_size = 64.0):
+        """Create a sink that writes to column through reader (an MSReader).
+        The column should exist (see MSReader.ensure_column()). Up to
+        buffer_size MB is collected before it is written."""
+        self._reader = reader
+        self._column = column
+        self._buffer_size = buffer_size * 1024.0 * 1024.0
+        self._tile_rows = reader.tile_rows(column)
+        self._rownumbers = reader.rownumbers()
+
+        # Buffered chunks, consecutive rows starting at self._start.
+        self._chunks = []
+        self._start = 0
+        self._rows = 0
+
+        self._bytes = 0
+        self._seconds = 0.0
+        self._error = None
+
+        # At most one write is queued while another is in progress, which
+        # bounds the memory used by the sink.
+        self._queue = Queue.Queue(maxsize = 1)
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, value, start):
+        """Write value (an array of shape (row, channel, correlation)) to rows
+        start, start + 1, ... of the output column. The value should not be
+        modified afterwards, as it is written asynchronously."""
+        self._check()
+
+        if self._rows > 0 and start != self._start + self._rows:
+            self._flush(self._rows)
+
+        if self._rows == 0:
+            self._start = start
+        self._chunks.append(value)
+        self._rows += value.shape[0]
+
+        row_size = value.nbytes / float(max(1, value.shape[0]))
+        rows = int(self._buffer_size / max(1.0, row_size))
+        rows = max(self._tile_rows, rows - rows % self._tile_rows)
+        while self._rows >= rows:
+            # Only write up to a tile boundary; the remainder is kept until
+            # more data arrives, or until close().
+            self._flush(self._aligned(rows))
+
+    def close(self):
+        """Write all buffered data and wait until it has been written."""
+        if self._rows > 0:
+            self._flush(self._rows)
+        self._queue.put(None)
+        self._thread.join()
+        self._check()
+
+        if self._seconds > 0.0:
+            util.notice("wrote %.1f MB to %s in %.1f s (%.1f MB/s)"
+                % (self._bytes / 1048576.0, self._column, self._seconds,
+                self._bytes / 1048576.0 / self._seconds))
+
+    def _aligned(self, rows):
+        """Return the largest number of rows, at most rows, that can be
+        written from self._start such that the write ends at a tile boundary
+        of the output column in the measurement set. Returns rows if there is
+        no such boundary."""
+        end = self._start + rows
+        if end >= len(self._rownumbers):
+            return rows
+
+        # Row i (relative to self._start) starts a new tile if its row number
+        # is a multiple of the tile size, or if the selection skips the rows
+        # before it.
+        base = self._rownumbers[self._start:end + 1]
+        boundary = numpy.flatnonzero((base[1:] % self._tile_rows == 0)
+            | (base[1:] != base[:-1] + 1))
+        if len(boundary) == 0:
+            return rows
+        return int(boundary[-1]) + 1
+
+    def _flush(self, rows):
+        """Queue the first rows buffered rows for writing."""
+        if rows <= 0:
+            return
+
+        value = numpy.concatenate(self._chunks) if len(self._chunks) > 1 \
+            else self._chunks[0]
+        self._queue.put((self._start, value[:rows]))
+
+        self._chunks = [value[rows:]] if rows < self._rows else []
+        self._start += rows
+        self._rows -= rows
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+
+            (start, value) = item
+            try:
+                begin = time.time()
+                self._reader.putcol(self._column, value, start,
+                    value.shape[0])
+                self._seconds += time.time() - begin
+                self._bytes += value.nbytes
+            except Exception as exception:
+                self._error = exception
+                continue
+
+            util.notice("wrote rows %d-%d to %s (%.1f MB/s)" % (start, start
+                + value.shape[0] - 1, self._column, self._bytes / 1048576.0
+                / max(self._seconds, 1e-6)))
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError("Unable to write column %s: %s"
+                % (self._column, self._error))
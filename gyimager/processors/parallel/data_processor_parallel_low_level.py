@@ -1,5 +1,4 @@
 import numpy
-import casaimwrap
 import time
 import os
 import socket
@@ -10,6 +9,9 @@ import itertools
 import json
 from ...processors import ImageWeight, Normalization
 from ..data_processor_low_level_base import DataProcessorLowLevelBase
+from ...algorithms import instrumentation
+from ..reduction import sum_results
+from .. import registry
 
 dataprocessor_id = 0
 def get_dataprocessor_id() :
@@ -41,7 +43,7 @@ class DataProcessorParallelLowLevel(DataProcessorLowLevelBase):
             print dview['msname']
         self._dview = self._rc[:]
         self._dview['options'] = options
-        self._dview.execute('from pyimager.processors import create_data_processor_low_level')
+        self._dview.execute('from gyimager.processors import create_data_processor_low_level')
         self._dview.execute('localdataprocessor = create_data_processor_low_level(msname, options)', block = True)
         self._remoteprocessor = IPython.parallel.Reference('localdataprocessor')
         self._cached_channels = None
@@ -116,6 +118,13 @@ class DataProcessorParallelLowLevel(DataProcessorLowLevelBase):
         for result in results[1:] :
             assert(capabilities == result)
         self.clear()    
+
+        # The engines grid and compute residuals, but degridding and chunked
+        # processing are not distributed.
+        capabilities[registry.DEGRID] = False
+        capabilities[registry.CHUNKED_IO] = False
+        capabilities[registry.INCREMENTAL] = False
+        capabilities[registry.MEMORY_MODEL] = "distributed"
         return capabilities
 
     def phase_reference(self):
@@ -151,7 +160,8 @@ class DataProcessorParallelLowLevel(DataProcessorLowLevelBase):
         return [channel[1] for channel in self.channels()]
     
     def maximum_baseline_length(self):
-        results = self._rc[:].apply_sync(lambda processor : processor.maximum_baseline_length(), self._remoteprocessor)
+        with instrumentation.timer("parallel.remote"):
+            results = self._rc[:].apply_sync(lambda processor : processor.maximum_baseline_length(), self._remoteprocessor)
         maximum_baseline_length = max(results)
         self.clear()    
         return maximum_baseline_length
@@ -162,16 +172,12 @@ class DataProcessorParallelLowLevel(DataProcessorLowLevelBase):
         self.clear()    
 
     def point_spread_function(self, coordinates, shape, as_grid):
-        results = self._rc[:].apply_sync(lambda processor, *args :
-            processor.point_spread_function(*args), self._remoteprocessor, \
-            coordinates, shape, as_grid)
-        psf, weight = results[0]
-        psf = psf.copy()
-        weight = weight.copy()
-        for result in results[1:] :
-            psf1, weight1 = result
-            psf += psf1
-            weight += weight1
+        with instrumentation.timer("parallel.remote"):
+            results = self._rc[:].apply_sync(lambda processor, *args :
+                processor.point_spread_function(*args), self._remoteprocessor, \
+                coordinates, shape, as_grid)
+        with instrumentation.timer("parallel.reduce"):
+            psf, weight = sum_results(results)
         self.clear()    
         return (psf, weight)
 
@@ -182,52 +188,54 @@ class DataProcessorParallelLowLevel(DataProcessorLowLevelBase):
         print shape
         print  "****************************************************************"
         
-        results = self._rc[:].apply_sync(lambda processor, *args :
-            processor.grid(*args), self._remoteprocessor, coordinates,
-            shape, as_grid)
-        image, weight = results[0]
-        image = image.copy()
-        weight = weight.copy()
-        for result in results[1:] :
-            image1, weight1 = result
-            image += image1
-            weight += weight1
+        with instrumentation.timer("parallel.remote"):
+            results = self._rc[:].apply_sync(lambda processor, *args :
+                processor.grid(*args), self._remoteprocessor, coordinates,
+                shape, as_grid)
+        with instrumentation.timer("parallel.reduce"):
+            image, weight = sum_results(results)
         self.clear()    
         return (image, weight)
 
+    def grid_chunk(self, coordinates, shape, as_grid, chunksize):
+        # Each engine processes its own measurement as a whole (see
+        # registry.CHUNKED_IO).
+        return self.grid(coordinates, shape, as_grid)
+
     def degrid(self, coordinates, model, as_grid):
         raise NotImplementedError("degrid not implemented")
 
+    def degrid_chunk(self, coordinates, model, as_grid, chunksize):
+        raise NotImplementedError("degrid not implemented")
+
     def residual(self, coordinates, model, as_grid):
-        results = self._rc[:].apply_sync(lambda processor, *args :
-            processor.residual(*args), self._remoteprocessor, coordinates,
-            model, as_grid)
-        residual, weight = results[0]
-        residual = residual.copy()
-        weight = weight.copy()
-        for result in results[1:] :
-            residual1, weight1 = result
-            residual += residual1
-            weight += weight1
+        # The model can be a SparseModel, which is a lot cheaper to ship to the
+        # engines than a dense image. The engines convert it as needed.
+        with instrumentation.timer("parallel.remote"):
+            results = self._rc[:].apply_sync(lambda processor, *args :
+                processor.residual(*args), self._remoteprocessor, coordinates,
+                model, as_grid)
+        with instrumentation.timer("parallel.reduce"):
+            residual, weight = sum_results(results)
         self.clear()    
         return (residual, weight)
 
     def density(self, coordinates, shape):
-        results = self._dview.apply_sync(lambda processor, *args :
-            processor.density(*args), self._remoteprocessor, \
-            coordinates, shape)
-        density = results[0].copy()
-        for result in results[1:] :
-            density += result
+        with instrumentation.timer("parallel.remote"):
+            results = self._dview.apply_sync(lambda processor, *args :
+                processor.density(*args), self._remoteprocessor, \
+                coordinates, shape)
+        with instrumentation.timer("parallel.reduce"):
+            density = sum_results(results)
         return density
 
     def response(self, coordinates, shape):
-        results = self._rc[:].apply_sync(lambda processor, *args :
-            processor.response(*args), self._remoteprocessor, \
-            coordinates, shape)
-        response = results[0].copy()
-        for result in results[1:] :
-            response += result
+        with instrumentation.timer("parallel.remote"):
+            results = self._rc[:].apply_sync(lambda processor, *args :
+                processor.response(*args), self._remoteprocessor, \
+                coordinates, shape)
+        with instrumentation.timer("parallel.reduce"):
+            response = sum_results(results)
         self.clear()    
         return response
 
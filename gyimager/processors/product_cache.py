@@ -0,0 +1,162 @@
+"""Content addressed on-disk cache for derived imaging products.
+
+Products such as the point spread function, the fitted beam, the uv density
+and the average response only depend on the measurement(s), the gridding and
+weighting parameters, and the image coordinates and shape. When a measurement
+is imaged repeatedly with the same configuration (e.g. re-cleaning with a
+different threshold), these products can be re-used instead of recomputed.
+
+Each cache entry is a directory named after a hash of the configuration. It
+contains one .npy file per array product and one .json file per (small)
+non-array product. The least recently used entries are evicted when the total
+size of the cache exceeds the configured maximum.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy
+
+# Options that affect the products stored in the cache. The A-term options
+# select the model of the direction dependent effects (casa and idg), which
+# changes the PSF and the response. With more than one process, the response
+# is approximated by the mean of the responses of the time slices (see
+# local.DataProcessorLocalLowLevel.response()).
+_KEY_OPTIONS = ["processor", "w_max", "padding", "weighttype", "rmode",
+    "noise", "robustness", "time_range", "uv_range", "channels",
+    "correlations", "averaging_tolerance", "w_planes", "subgrid_size",
+    "time_window", "gridding.ATerm.name", "ATermPython.module",
+    "ATermPython.class", "idg_aterm", "processes"]
+
+# Version of the products, included in the key such that products computed
+# by earlier versions are not re-used (2: the PSF is normalized by the sum of
+# the weights for all data processors).
+_FORMAT = 2
+
+class ProductCache:
+    def __init__(self, root, max_size):
+        """Create a cache in directory root that holds at most max_size bytes.
+        """
+        self._root = root
+        self._max_size = max_size
+
+        if not os.path.isdir(self._root):
+            os.makedirs(self._root)
+
+    @staticmethod
+    def from_options(options):
+        """Create a cache from the "cache_dir" and "cache_size" (MB) options,
+        or return None if caching is disabled."""
+        root = options.get("cache_dir", "")
+        size = options.get("cache_size", 0)
+        if not root or size <= 0:
+            return None
+        return ProductCache(os.path.expanduser(root), int(size * 1024 * 1024))
+
+    def key(self, measurement, options, coordinates, shape):
+        """Return the key of the products computed from measurement with the
+        given options, for an image of the given coordinates and shape."""
+        identity = {}
+        identity["format"] = _FORMAT
+        identity["measurement"] = measurement_identity(measurement)
+        identity["options"] = dict((name, options.get(name)) for name in
+            _KEY_OPTIONS)
+        identity["coordinates"] = _canonical(coordinates.dict())
+        identity["shape"] = [int(x) for x in shape]
+
+        return hashlib.sha1(json.dumps(identity, sort_keys=True)).hexdigest()
+
+    def get(self, key, name):
+        """Return product name of entry key, or None if not available."""
+        entry = os.path.join(self._root, key)
+
+        path = os.path.join(entry, name + ".npy")
+        if os.path.isfile(path):
+            value = numpy.load(path)
+        else:
+            path = os.path.join(entry, name + ".json")
+            if not os.path.isfile(path):
+                return None
+            with open(path) as fin:
+                value = json.load(fin)
+
+        # Mark the entry as recently used.
+        os.utime(entry, None)
+        return value
+
+    def put(self, key, name, value):
+        """Store product name in entry key. Arrays are stored in NumPy format,
+        anything else should be JSON serializable."""
+        entry = os.path.join(self._root, key)
+        if not os.path.isdir(entry):
+            os.makedirs(entry)
+
+        # Write to a temporary file first, such that concurrent readers never
+        # see a partially written product.
+        if isinstance(value, numpy.ndarray):
+            path = os.path.join(entry, name + ".npy")
+            with open(path + ".tmp", "wb") as fout:
+                numpy.save(fout, value)
+        else:
+            path = os.path.join(entry, name + ".json")
+            with open(path + ".tmp", "w") as fout:
+                json.dump(_canonical(value), fout)
+        os.rename(path + ".tmp", path)
+
+        os.utime(entry, None)
+        self._evict(keep=key)
+
+    def _evict(self, keep):
+        entries = []
+        total = 0
+        for key in os.listdir(self._root):
+            entry = os.path.join(self._root, key)
+            if not os.path.isdir(entry):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in
+                os.listdir(entry))
+            entries.append((os.path.getmtime(entry), key, size))
+            total += size
+
+        # Remove least recently used entries first.
+        for (_, key, size) in sorted(entries):
+            if total <= self._max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self._root, key), ignore_errors=True)
+            total -= size
+
+def measurement_identity(measurement):
+    """Identify a measurement by its absolute path, and the size and
+    modification time of the table files it consists of."""
+    if isinstance(measurement, dict):
+        return sorted((key, measurement_identity(value)) for (key, value) in
+            measurement.iteritems())
+
+    if isinstance(measurement, list):
+        return [measurement_identity(value) for value in measurement]
+
+    path = os.path.abspath(measurement)
+    stamp = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.startswith("table."):
+                info = os.stat(os.path.join(path, name))
+                stamp.append((name, info.st_size, int(info.st_mtime)))
+    return [path, stamp]
+
+def _canonical(value):
+    """Convert value into a JSON serializable equivalent."""
+    if isinstance(value, dict):
+        return dict((str(key), _canonical(item)) for (key, item) in
+            value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    if isinstance(value, numpy.ndarray):
+        return _canonical(value.tolist())
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
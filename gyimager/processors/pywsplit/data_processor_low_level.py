@@ -6,16 +6,26 @@ import numpy.fft
 import casaimwrap
 import pyrap.tables
 from ...algorithms import util
+from ...algorithms import instrumentation
 from ...algorithms import constants
 import mod_threadpool as threadpool
-import imaging_weight
+from .. import imaging_weight
+from .. import registry
+from .. import averaging
+from .. import spans
+from ..sparse_model import as_dense
+from ..ms_reader import MSReader
+from ..vis_cache import VisibilityCache
+from reorder_cache import ReorderCache
 
 class DataProcessorLowLevel(DataProcessorLowLevelBase):
     def __init__(self, measurement, options):
         self._measurement = measurement
-        self._ms = pyrap.tables.table(measurement, readonly = False)
-        self._ms = self._ms.query("ANTENNA1 != ANTENNA2 && OBSERVATION_ID ==" \
-            " 0 && FIELD_ID == 0 && DATA_DESC_ID == 0")
+        self._ms = MSReader(measurement, options, readonly = False)
+        if options.get("vis_cache"):
+            self._ms = VisibilityCache(self._ms, measurement,
+                options["vis_cache"], options.get("vis_cache_precision",
+                "single"), options.get("vis_cache_compress", False))
 
 #        assert(options["weight_algorithm"] == WeightAlgorithm.NATURAL)
         self._data_column = "CORRECTED_DATA"
@@ -33,6 +43,16 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         self._options["oversample"] = self._options.get("oversample", 8)
         self._options["PBCut"] = 5e-2
 
+        # Optionally store the columns used for degridding in the order in
+        # which they are processed.
+        self._reorder_cache = None
+        if self._options.get("reorder_cache", False):
+            self._reorder_cache = ReorderCache(measurement)
+
+        # Baseline dependent averaging before gridding (disabled if None or
+        # 0.0).
+        self._averaging_tolerance = self._options.get("averaging_tolerance")
+
         # Defaults from awimager.
         parms = {}
         parms["wmax"] = self._options["w_max"]
@@ -87,7 +107,7 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         casaimwrap.init(self._context, self._measurement, parms)
 
     def capabilities(self):
-        return {}
+        return registry.capabilities("pywsplit")
 
     def phase_reference(self):
         field = pyrap.tables.table(path.join(self._measurement, "FIELD"))
@@ -114,33 +134,11 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         return numpy.max(numpy.sqrt(numpy.sum(numpy.square( \
             self._ms.getcol("UVW")), 1)))
 
+    @instrumentation.timed("density")
     def density(self, coordinates, shape):
-        increment = coordinates.get_increment()
-        freqs = self.channel_frequency()
-        f = freqs/constants.speed_of_light
-
-        density_shape = shape[2:]
-        density_increment = increment[2]
-
-        uorig = int(density_shape[1]/2)
-        vorig = int(density_shape[0]/2)
-
-        density = numpy.zeros(density_shape)
-        uscale = density_shape[1]*density_increment[1]
-        vscale = density_shape[0]*density_increment[0]
-        uvw = self._ms.getcol("UVW")
-        weight = self._ms.getcol("WEIGHT_SPECTRUM")
-        for i in range(len(self._ms)):
-            u1 = uvw[i,0]*uscale
-            v1 = uvw[i,1]*vscale
-            for j in range(len(f)):
-                u = int(u1*f[j])
-                v = int(v1*f[j])
-                if abs(u)<uorig and abs(v)<vorig:
-                    w = sum(weight[i, j,:])
-                    density[vorig+v,uorig+u] += w
-                    density[vorig-v,uorig-u] += w
-        return density
+        return imaging_weight.density(self._ms.getcol("UVW"),
+            self.channel_frequency(), self._ms.getcol("WEIGHT_SPECTRUM"),
+            shape[2:], coordinates.get_increment()[2])
 
     def set_density(self, density, coordinates) :
         self.imw.set_density(density, coordinates)
@@ -162,14 +160,14 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         args["TIME_CENTROID"] = self._ms.getcol("TIME_CENTROID")
         args["FLAG_ROW"] = self._ms.getcol("FLAG_ROW")
         args["FLAG"] = self._ms.getcol("FLAG")
-        args["IMAGING_WEIGHT"] = self.imw.imaging_weight(args["UVW"],
-            self.channel_frequency(), args["FLAG"],
-            self._ms.getcol("WEIGHT_SPECTRUM"))
+        weight_spectrum = self._ms.getcol("WEIGHT_SPECTRUM")
+        with instrumentation.timer("weights"):
+            args["IMAGING_WEIGHT"] = self.imw.imaging_weight(args["UVW"],
+                self.channel_frequency(), args["FLAG"], weight_spectrum)
         args["DATA"] = numpy.ones(args["FLAG"].shape, dtype=numpy.complex64)
 
-        casaimwrap.begin_grid(self._context, shape, coordinates.dict(),
-            True, args)
-        result = casaimwrap.end_grid(self._context, False)
+        result = self._grid(coordinates, shape, True,
+            self._average(args, coordinates, shape))
         return (result["image"], result["weight"])
 
     def grid(self, coordinates, shape, as_grid):
@@ -188,19 +186,27 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
             dtype=numpy.float32)
         args["DATA"] = self._ms.getcol(self._data_column)
 
-        casaimwrap.begin_grid(self._context, shape, coordinates.dict(),
-            False, args)
-        result = casaimwrap.end_grid(self._context, False)
+        result = self._grid(coordinates, shape, False,
+            self._average(args, coordinates, shape))
         self._response_available = True
         return (result["image"], result["weight"])
 
+    def grid_chunk(self, coordinates, shape, as_grid, chunksize):
+        # The visibilities are always processed as a whole (see
+        # registry.CHUNKED_IO).
+        return self.grid(coordinates, shape, as_grid)
+
     def degrid(self, coordinates, model, as_grid):
         assert(not as_grid)
 #        self._ms.putcol(self._data_column, self._degrid(coordinates, model))
 
+    def degrid_chunk(self, coordinates, model, as_grid, chunksize):
+        self.degrid(coordinates, model, as_grid)
+
     def residual(self, coordinates, model, as_grid):
         assert(not as_grid)
         self._update_image_configuration(coordinates, model.shape)
+        model = as_dense(model)
 
         # Degrid model.
         model_vis = self._degrid(coordinates, model)
@@ -221,28 +227,36 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
             dtype=numpy.float32)
         args["DATA"] = residual
 
-        casaimwrap.begin_grid(self._context, model.shape, \
-            coordinates.dict(), False, args)
-        result = casaimwrap.end_grid(self._context, False)
+        result = self._grid(coordinates, model.shape, False,
+            self._average(args, coordinates, model.shape))
         self._response_available = True
 
         return (result["image"], result["weight"])
 
     def _degrid(self, coordinates, model):
-        antenna1 = self._ms.getcol("ANTENNA1")
-        antenna2 = self._ms.getcol("ANTENNA2")
-        uvw = self._ms.getcol("UVW")
-        time_centroid = self._ms.getcol("TIME_CENTROID")
-        flag = self._ms.getcol("FLAG")
-
-        ref_freq = self.reference_frequency()
         ch_freq = self.channel_frequency()
 
-        # Initialize LOFAR::LofarConvolutionFunction machinery.
-        casaimwrap.init_cf(self._context, model.shape, coordinates.dict())
-        casaimwrap.init_aterm(self._context, time_centroid)
+        # Initialize LOFAR::LofarConvolutionFunction machinery. The W-planes
+        # are configured by init_cf(), and are needed for the spans.
+        with instrumentation.timer("kernel"):
+            casaimwrap.init_cf(self._context, model.shape,
+                coordinates.dict())
+
+        # The columns are permuted into processing order, such that each span
+        # (see _layout()) is a contiguous range of rows. From here on, all row
+        # indices refer to the permuted order.
+        layout = self._layout(coordinates, model.shape)
+        antenna1 = layout["ANTENNA1"]
+        antenna2 = layout["ANTENNA2"]
+        uvw = numpy.array(layout["UVW"])
+        time_centroid = layout["TIME_CENTROID"]
+        flag = layout["FLAG"]
+        order = layout["order"]
+
+        with instrumentation.timer("kernel"):
+            casaimwrap.init_aterm(self._context, time_centroid)
+            spheroid = casaimwrap.spheroid(self._context)
 
-        spheroid = casaimwrap.spheroid(self._context)
         spheroid = numpy.where(spheroid >= self._options["PBCut"],
             1.0 / numpy.square(spheroid), 0.0)
 
@@ -257,13 +271,6 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         model = casaimwrap.stokes_to_linear(self._context,
             coordinates.dict(), model * spheroid)
 
-        # Create an index of spans of visibility data that can be gridded
-        # independently.
-        w_map, w_index_map = self._make_mapping_time_W(antenna1, antenna2, uvw,
-            time_centroid, ref_freq, self._options["time_window"],
-            self._options["uv_min"], self._options["uv_max"],
-            self._options["w_max"])
-
         # Comment from CASA source code:
         #
         # NEGATING to correct for an image inversion problem.
@@ -291,13 +298,12 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         # single W-plane in parallel.
         #
         pool = threadpool.ThreadPool(self._options.get("threads", 1))
-        for i in range(len(w_map)):
-            active_w_map = w_map[i]
+        plane = layout["spans"][:, 0]
+        for i in range(len(layout["w_index"])):
+            active_w_map = layout["spans"][plane == i, 1:]
             if len(active_w_map) == 0:
                 continue
 
-            print "W-plane index:", i, "W-index:", w_index_map[i]
-
             # NB. Applying the W-term and FFT does not seem to take much time.
             #
             wcorr = casaimwrap.apply_w_term_image(self._context, model,
@@ -311,7 +317,8 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
             # implementation (LofarFTMachine::getSplitWplanes). This is true for
             # images of even sizes, not sure for odd sizes.
             #
-            wcorr = numpy.fft.ifftshift(numpy.fft.fft2(numpy.fft.fftshift(wcorr, (2, 3))), (2, 3))
+            with instrumentation.timer("fft"):
+                wcorr = numpy.fft.ifftshift(numpy.fft.fft2(numpy.fft.fftshift(wcorr, (2, 3))), (2, 3))
 
 #            if i == 0:
 #                util.store_image("widx0_after_fft_re.img", coordinates, numpy.real(wcorr))
@@ -325,35 +332,98 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
             def _process_span(thread, index):
                 """Helper function to processes spans in parallel."""
 
-                assert(len(active_w_map[index]) > 0)
-                start = active_w_map[index][0]
-                end = active_w_map[index][-1]
+                (start, stop) = active_w_map[index]
+                end = stop - 1
                 time_mean = 0.5 * (time_centroid[start] + time_centroid[end])
                 w_mean = 0.5 * (uvw[start, 2] + uvw[end, 2])
 
                 # Create convolution kernel.
-                kernel = \
-                    casaimwrap.make_convolution_function(self._context,
-                        thread, antenna1[start], antenna2[start], time_mean,
-                        w_mean)
-
-                # Degrid.
-                casaimwrap.degrid_reimplemented(inc_ra, inc_dec,
-                    oversample, wcorr, kernel, uvw, ch_freq, flag, vis,
-                    active_w_map[index])
+                with instrumentation.timer("kernel"):
+                    kernel = \
+                        casaimwrap.make_convolution_function(self._context,
+                            thread, antenna1[start], antenna2[start],
+                            time_mean, w_mean)
+
+                # Degrid the span, passed as slices of the (permuted) rows.
+                # The row indices are relative to the slices.
+                with instrumentation.timer("casaimwrap.degrid"):
+                    casaimwrap.degrid_reimplemented(inc_ra, inc_dec,
+                        oversample, wcorr, kernel, uvw[start:stop], ch_freq,
+                        flag[start:stop], vis[start:stop], numpy.arange(stop
+                        - start, dtype=numpy.uint32))
+                instrumentation.count("rows.degridded", stop - start)
 
             # Multi-threaded execution of _process_plane() for all spans in this
             # W-plane.
             map(pool.putRequest, threadpool.makeRequests(_process_span,
                 range(len(active_w_map))))
 
-#            start = datetime.datetime.now()
-            pool.wait()
-#            end = datetime.datetime.now()
-#            delta = end - start
-#            print "threads:", threads, "use_processes:", use_processes,
-#                "time:", delta.seconds + delta.microseconds / 1e6
-        return vis
+            with instrumentation.timer("degrid.w_plane"):
+                pool.wait()
+
+        # Undo the permutation.
+        result = numpy.empty_like(vis)
+        result[order] = vis
+        return result
+
+    def _layout(self, coordinates, shape):
+        """Return the columns used for degridding, permuted into processing
+        order, as a dict: ANTENNA1, ANTENNA2, UVW, TIME_CENTROID and FLAG,
+        order (the row of each permuted row), spans (the W-plane, start and
+        end (exclusive) of each span, in permuted rows, sorted by W-plane), and
+        w_index (the W-index of each W-plane).
+
+        Each span contains the rows of a single baseline within a single
+        W-plane, that can be degridded with the same kernel (see spans). Rows
+        that are not degridded follow all spans. If the reorder cache is
+        enabled, the result is loaded from the cache if available.
+        """
+        parameters = dict((key, self._options[key]) for key in
+            ["time_window", "uv_min", "uv_max", "w_max", "padding"])
+        parameters["shape"] = [int(x) for x in shape]
+        parameters["increment"] = [numpy.asarray(x).tolist() for x in
+            coordinates.get_increment()]
+        if self._reorder_cache is not None:
+            layout = self._reorder_cache.load(self._ms, parameters)
+            if layout is not None:
+                return layout
+
+        columns = dict((name, self._ms.getcol(name)) for name in ["ANTENNA1",
+            "ANTENNA2", "UVW", "TIME_CENTROID"])
+
+        # Create an index of spans of visibility data that can be gridded
+        # independently.
+        with instrumentation.timer("mapping"):
+            (w_map, w_index_map, index) = self._make_mapping_time_W(
+                columns["ANTENNA1"], columns["ANTENNA2"], columns["UVW"],
+                columns["TIME_CENTROID"], self.reference_frequency(),
+                self._options["time_window"], self._options["uv_min"],
+                self._options["uv_max"], self._options["w_max"])
+
+        # Concatenate the spans, followed by the rows that are not degridded.
+        rows = [numpy.asarray(span, dtype=numpy.int64) for plane in w_map for
+            span in plane if len(span) > 0]
+        bounds = numpy.zeros((len(rows), 3), dtype=numpy.int64)
+        bounds[:, 0] = [i for (i, plane) in enumerate(w_map) for span in plane
+            if len(span) > 0]
+        bounds[:, 2] = numpy.cumsum([len(span) for span in rows])
+        bounds[1:, 1] = bounds[:-1, 2]
+        degridded = numpy.zeros(len(index), dtype=bool)
+        if rows:
+            rows = numpy.concatenate(rows)
+            degridded[rows] = True
+        order = numpy.concatenate([rows, numpy.flatnonzero(~degridded)]) \
+            .astype(numpy.int64)
+
+        layout = dict((name, column[order]) for (name, column) in
+            columns.iteritems())
+        layout["FLAG"] = self._ms.getcol("FLAG")[order]
+        layout["order"] = order
+        layout["spans"] = bounds
+        layout["w_index"] = numpy.asarray(w_index_map, dtype=numpy.int64)
+        if self._reorder_cache is not None:
+            self._reorder_cache.store(self._ms, parameters, layout)
+        return layout
 
     def _make_mapping_time(self, antenna1, antenna2, uvw, time, ref_freq,
         time_window, uv_min, uv_max, w_max):
@@ -396,58 +466,36 @@ class DataProcessorLowLevel(DataProcessorLowLevelBase):
         """Re-implementation of LofarFTMachine::make_mapping_time()_W."""
 
         tmp = casaimwrap.w_index(self._context, uvw[:,2], 0)
-        w_index = tmp["w_index"]
-
-        ref_wl = constants.speed_of_light / ref_freq
-
-        # The last array passed to numpy.lexsort() is the primary sort key,
-        # hence the reversal of antenna1 and antenna2.
-        index = numpy.lexsort((antenna2, antenna1, w_index))
-        active_baseline = None
-        active_window = None
-        active_w_index = None
-
-        w_map = []
-        w_index_map = []
-        sub_map = []
-        sub_w_map = []
-
-        for row in index:
-            if numpy.abs(uvw[row, 2]) >= w_max:
-                continue
-
-            # Compute UV distance in klambda.
-            uv_distance = numpy.sqrt(numpy.sum(numpy.square(uvw[row,:2]))) / \
-                (1e3 * ref_wl)
-            if uv_distance <= uv_min or uv_distance >= uv_max:
-                continue
-
-            if active_baseline is None:
-                active_baseline = (antenna1[row], antenna2[row])
-                active_window = time[row] + time_window
-                active_w_index = w_index[row]
-
-            baseline = (antenna1[row], antenna2[row])
-            if time[row] > active_window or baseline != active_baseline:
-                active_window = time[row] + time_window
-                active_baseline = baseline
-                sub_w_map.append(sub_map)
-                sub_map = []
-
-            if w_index[row] != active_w_index:
-                w_map.append(sub_w_map)
-                w_index_map.append(active_w_index)
-
-                active_w_index = w_index[row]
-                sub_w_map = []
-
-            sub_map.append(row)
-
-        sub_w_map.append(sub_map)
-        w_map.append(sub_w_map)
-        w_index_map.append(active_w_index)
-
-        return (w_map, w_index_map)
+        return spans.make_mapping_time_w(antenna1, antenna2, uvw, time,
+            tmp["w_index"], ref_freq, time_window, uv_min, uv_max, w_max)
+
+    @instrumentation.timed("averaging")
+    def _average(self, chunk, coordinates, shape):
+        """Return chunk averaged in time and frequency, if enabled. The
+        imaging weight per (row, channel) (IMAGING_WEIGHT) is replaced by an
+        imaging weight per correlation (IMAGING_WEIGHT_CUBE), as expected by
+        casaimwrap.grid()."""
+        chunk = dict(chunk)
+        weight = chunk.pop("IMAGING_WEIGHT")
+        chunk["IMAGING_WEIGHT_CUBE"] = numpy.repeat(weight[:, :,
+            numpy.newaxis], chunk["FLAG"].shape[2], axis=2).astype(
+            numpy.float32)
+        if not self._averaging_tolerance:
+            return chunk
+
+        return averaging.average(chunk, self.channel_frequency(),
+            averaging.field_of_view(coordinates, shape),
+            self._averaging_tolerance)
+
+    def _grid(self, coordinates, shape, psf, chunk):
+        """Grid chunk (all rows at once) onto an image of the given
+        coordinates and shape, and return the result of
+        casaimwrap.end_grid()."""
+        casaimwrap.begin_grid(self._context, shape, coordinates.dict(), psf)
+        with instrumentation.timer("casaimwrap.grid"):
+            casaimwrap.grid(self._context, chunk)
+        with instrumentation.timer("casaimwrap.end_grid"):
+            return casaimwrap.end_grid(self._context, False)
 
     def _update_image_configuration(self, coordinates, shape):
         # Comparing coordinate systems is tricky!
@@ -0,0 +1,79 @@
+"""On-disk store of visibility columns in baseline / W-plane order.
+
+The pywsplit degridder processes the visibilities in spans of consecutive
+time samples of a single baseline, grouped by W-plane. In a (time ordered)
+measurement set, the rows of a span are scattered over the entire table, such
+that each span touches memory all over the UVW, FLAG and TIME_CENTROID arrays.
+
+The degridder therefore permutes the columns it needs into the order in which
+they are processed, such that each span is a contiguous range of rows. This
+module stores the permuted columns, together with the permutation and the
+spans, next to the measurement set as .npy files, which are memory mapped
+when loaded. The entry is identified by the measurement, the selection and
+the parameters that determine the spans, such that a later run neither reads
+the metadata columns nor recomputes the spans.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy
+
+from ..product_cache import measurement_identity
+
+_MANIFEST = "manifest.json"
+
+class ReorderCache:
+    def __init__(self, measurement, root = None):
+        """Create a reorder cache for measurement. By default, the cache is
+        stored in a directory next to the measurement, with the suffix
+        ".reorder"."""
+        self._measurement = measurement
+        if root is None:
+            root = os.path.normpath(measurement) + ".reorder"
+        self._root = root
+
+    def load(self, reader, parameters):
+        """Return the arrays stored for the selection of reader (an MSReader)
+        and parameters (a dict that can be serialized to JSON), as a dict of
+        memory mapped arrays, or None if they are not available."""
+        path = os.path.join(self._root, _MANIFEST)
+        if not os.path.isfile(path):
+            return None
+
+        with open(path) as fin:
+            manifest = json.load(fin)
+        if manifest.get("key") != self._key(reader, parameters):
+            return None
+
+        return dict((name, numpy.load(os.path.join(self._root, name + ".npy"),
+            mmap_mode="r")) for name in manifest["arrays"])
+
+    def store(self, reader, parameters, arrays):
+        """Store arrays (a dict of arrays) for the selection of reader and
+        parameters, replacing the current contents of the cache."""
+        # Write to a temporary directory first, such that a concurrent reader
+        # never sees a partially written cache.
+        tmp_root = self._root + ".tmp"
+        if os.path.exists(tmp_root):
+            shutil.rmtree(tmp_root)
+        os.makedirs(tmp_root)
+
+        for (name, array) in arrays.iteritems():
+            numpy.save(os.path.join(tmp_root, name + ".npy"), array)
+
+        with open(os.path.join(tmp_root, _MANIFEST), "w") as fout:
+            json.dump({"key": self._key(reader, parameters), "arrays":
+                sorted(arrays.keys())}, fout)
+
+        if os.path.exists(self._root):
+            shutil.rmtree(self._root)
+        os.rename(tmp_root, self._root)
+
+    def _key(self, reader, parameters):
+        identity = {}
+        identity["measurement"] = measurement_identity(self._measurement)
+        identity["selection"] = reader.selection()
+        identity["parameters"] = parameters
+        return hashlib.sha1(json.dumps(identity, sort_keys=True)).hexdigest()
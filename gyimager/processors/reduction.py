@@ -0,0 +1,23 @@
+"""Reduction of the partial results computed for each part of the data."""
+
+import numpy
+
+def sum_results(results):
+    """Return the sum of a list of results. Each result is either an array,
+    or a tuple of arrays that are summed element-wise. The results are not
+    modified."""
+    if isinstance(results[0], tuple):
+        return tuple(sum_results([result[k] for result in results]) for k in
+            range(len(results[0])))
+
+    total = numpy.array(results[0], copy=True)
+    for result in results[1:]:
+        total += result
+    return total
+
+def normalized(image, weight):
+    """Return image divided by the weight of each (channel, Stokes) plane, as
+    returned by the point_spread_function(), grid() and residual() methods of
+    the low level data processors (zero where the weight is zero)."""
+    exp_weight = weight[:, :, numpy.newaxis, numpy.newaxis]
+    return numpy.where(exp_weight > 0.0, image / exp_weight, 0.0)
@@ -0,0 +1,296 @@
+from ..data_processor_low_level_base import DataProcessorLowLevelBase
+import os.path as path
+import multiprocessing.pool
+import numpy
+import pyrap.tables
+from .. import imaging_weight
+from .. import registry
+from .. import streaming
+from .. import averaging
+from .. import gridding
+from ..sparse_model import as_dense
+from ..ms_reader import MSReader
+from ..vis_cache import VisibilityCache
+from ..output_sink import OutputSink
+from ...algorithms import constants
+from ...algorithms import instrumentation
+
+# Correlation types (Stokes enumeration of casacore) supported by the gridder:
+# XX, XY, YX, YY, or XX, YY.
+_LINEAR = [[9, 10, 11, 12], [9, 12]]
+
+class DataProcessorLowLevel(DataProcessorLowLevelBase):
+    """Pure numpy data processor: convolutional (de)gridding with a prolate
+    spheroidal kernel and W-stacking (see gridding), without any direction
+    dependent effects.
+
+    As those of the casa processor, the images returned by
+    point_spread_function(), grid() and residual() are not normalized by the
+    sum of the weights (DataProcessorDefault divides it out), such that the
+    results of different parts of the data can be summed.
+    """
+    def __init__(self, measurement, options):
+        self._measurement = measurement
+        self._ms = MSReader(measurement, options, readonly = False)
+        if options.get("vis_cache"):
+            self._ms = VisibilityCache(self._ms, measurement,
+                options["vis_cache"], options.get("vis_cache_precision",
+                "single"), options.get("vis_cache_compress", False))
+
+        pol = pyrap.tables.table(path.join(measurement, "POLARIZATION"))
+        if list(pol.getcell("CORR_TYPE", 0)) not in _LINEAR:
+            raise RuntimeError("The numpy data processor only supports linear"
+                " correlations (XX, XY, YX, YY or XX, YY)")
+
+        self._data_column = options.get("outcol", "CORRECTED_DATA")
+        if options.has_key("outcol"):
+            self._ms.ensure_column(self._data_column, tile_rows =
+                options.get("outcol_tile_rows", 0))
+        self._write_buffer = options.get("write_buffer", 64.0)
+
+        self._w_max = options["w_max"]
+        self._w_planes = options.get("w_planes", 0)
+        self._padding = max(options.get("padding", 1.0), 1.0)
+
+        # The W-planes are processed by a pool of worker threads, and the uv
+        # grids of the W-planes kept in memory are limited to w_memory MB.
+        self._threads = options.get("threads", 1)
+        self._w_memory = options.get("w_memory", 1024.0)
+        self._pool = None
+
+        weightoptionnames = ["weighttype", "rmode", "noise", "robustness"]
+        weightoptions = dict((key, value) for (key, value) in \
+            options.iteritems() if key in weightoptionnames)
+        self.imw = imaging_weight.ImagingWeight(**weightoptions)
+
+        # Baseline dependent averaging before gridding (disabled if None or
+        # 0.0).
+        self._averaging_tolerance = options.get("averaging_tolerance")
+
+    def capabilities(self):
+        return registry.capabilities("reference")
+
+    def phase_reference(self):
+        field = pyrap.tables.table(path.join(self._measurement, "FIELD"))
+        # Assumed to be in J2000 for now.
+        assert(field.getcolkeyword("PHASE_DIR", "MEASINFO")["Ref"] == "J2000")
+        return field.getcell("PHASE_DIR", 0)[0]
+
+    def channel_frequency(self):
+        spw = pyrap.tables.table(path.join(self._measurement, \
+            "SPECTRAL_WINDOW"))
+        return spw.getcell("CHAN_FREQ", 0)
+
+    def channel_width(self):
+        spw = pyrap.tables.table(path.join(self._measurement, \
+            "SPECTRAL_WINDOW"))
+        return spw.getcell("CHAN_WIDTH", 0)
+
+    def maximum_baseline_length(self):
+        return numpy.max(numpy.sqrt(numpy.sum(numpy.square( \
+            self._ms.getcol("UVW")), 1)))
+
+    @instrumentation.timed("density")
+    def density(self, coordinates, shape):
+        return imaging_weight.density(self._ms.getcol("UVW"),
+            self.channel_frequency(), self._ms.getcol("WEIGHT_SPECTRUM"),
+            shape[2:], coordinates.get_increment()[2])
+
+    def set_density(self, density, coordinates) :
+        self.imw.set_density(density, coordinates)
+
+    def response(self, coordinates, shape):
+        # No direction dependent effects are applied, and the taper of the
+        # gridding kernel is divided out, so the response is flat.
+        return numpy.ones(shape[2:])
+
+    def point_spread_function(self, coordinates, shape, as_grid):
+        assert(not as_grid)
+        gridder = self._gridder(coordinates, shape, 1)
+        for (start, nrow) in self._blocks(0):
+            self._grid(gridder, self._chunk(start, nrow, False), coordinates,
+                shape)
+
+        # The PSF is the same for all Stokes parameters.
+        with instrumentation.timer("reference.fft"):
+            image = numpy.real(gridder.image()[0])
+        psf = numpy.repeat(image[numpy.newaxis, numpy.newaxis], shape[1],
+            axis=1)
+        return (psf, numpy.repeat(gridder.weight(), shape[1]).reshape(
+            shape[:2]))
+
+    def grid(self, coordinates, shape, as_grid):
+        return self.grid_chunk(coordinates, shape, as_grid, 0)
+
+    def grid_chunk(self, coordinates, shape, as_grid, chunksize):
+        assert(not as_grid)
+        gridder = self._gridder(coordinates, shape, self._n_correlation())
+        for (start, nrow) in self._blocks(chunksize):
+            self._grid(gridder, self._chunk(start, nrow, True), coordinates,
+                shape)
+        return self._stokes(gridder, shape)
+
+    def open_grid(self, coordinates, shape):
+        return _StreamingGridder(self, coordinates, shape)
+
+    def degrid(self, coordinates, model, as_grid):
+        self.degrid_chunk(coordinates, model, as_grid, 0)
+
+    def degrid_chunk(self, coordinates, model, as_grid, chunksize):
+        assert(not as_grid)
+        degridder = self._degridder(coordinates, model)
+
+        self._ms.ensure_column(self._data_column)
+        sink = OutputSink(self._ms, self._data_column, self._write_buffer)
+        for (start, nrow) in self._blocks(chunksize):
+            sink.write(self._degrid(degridder, start, nrow), start)
+        sink.close()
+
+    def residual(self, coordinates, model, as_grid):
+        assert(not as_grid)
+        degridder = self._degridder(coordinates, model)
+        gridder = self._gridder(coordinates, model.shape,
+            self._n_correlation())
+
+        # Degrid, subtract and grid one block at a time, such that the model
+        # visibilities of the whole measurement are never in memory.
+        for (start, nrow) in self._blocks(0):
+            chunk = self._chunk(start, nrow, True)
+            chunk["DATA"] = chunk["DATA"] - self._degrid(degridder, start,
+                nrow)
+            self._grid(gridder, chunk, coordinates, model.shape)
+
+        return self._stokes(gridder, model.shape)
+
+    def _n_correlation(self):
+        return self._ms.getcol("FLAG", 0, 1).shape[2]
+
+    def _blocks(self, chunksize):
+        """Return the (start, nrow) blocks of rows to process. If chunksize
+        is 0, the block size is chosen such that a block contains about
+        gridding.BLOCK_SIZE samples per correlation per worker thread, such
+        that the W-planes of a block keep all workers busy."""
+        if chunksize <= 0:
+            chunksize = max(1, max(1, self._threads) * gridding.BLOCK_SIZE
+                // len(self.channel_frequency()))
+        nrows = self._ms.nrows()
+        return [(start, min(chunksize, nrows - start)) for start in
+            range(0, nrows, chunksize)]
+
+    def _chunk(self, start, nrow, data):
+        """Read a block of rows, with imaging weights, and with the
+        visibilities if data is True."""
+        chunk = {}
+        for name in ["ANTENNA1", "ANTENNA2", "UVW", "TIME", "TIME_CENTROID",
+            "FLAG_ROW", "FLAG"]:
+            chunk[name] = self._ms.getcol(name, start, nrow)
+
+        with instrumentation.timer("weights"):
+            chunk["IMAGING_WEIGHT_CUBE"] = streaming.imaging_weight_cube(
+                dict(chunk, WEIGHT_SPECTRUM = self._ms.getcol(
+                "WEIGHT_SPECTRUM", start, nrow)), self.imw,
+                self.channel_frequency())
+
+        if data:
+            chunk["DATA"] = self._ms.getcol(self._data_column, start, nrow)
+        return chunk
+
+    def _grid(self, gridder, chunk, coordinates, shape):
+        """Grid a chunk, averaged in time and frequency if enabled."""
+        if self._averaging_tolerance:
+            with instrumentation.timer("averaging"):
+                chunk = averaging.average(chunk, self.channel_frequency(),
+                    averaging.field_of_view(coordinates, shape),
+                    self._averaging_tolerance)
+
+        # The gridder takes a single weight per sample. The weights of the
+        # correlations only differ if they are flagged differently, in which
+        # case the sample is skipped.
+        weight = numpy.where(numpy.any(chunk["FLAG"], axis=2), 0.0,
+            chunk["IMAGING_WEIGHT_CUBE"][:, :, 0])
+        with instrumentation.timer("reference.grid"):
+            self._add(gridder, chunk, weight)
+        instrumentation.count("rows.gridded", len(chunk["UVW"]))
+
+    def _add(self, gridder, chunk, weight):
+        gridder.add(chunk["UVW"], self.channel_frequency(), chunk.get("DATA"),
+            weight)
+
+    def _degrid(self, degridder, start, nrow):
+        """Return the model visibilities of a block of rows."""
+        with instrumentation.timer("reference.degrid"):
+            data = self._predict(degridder, start, nrow)
+        instrumentation.count("rows.degridded", nrow)
+        return data.astype(numpy.complex64)
+
+    def _predict(self, degridder, start, nrow):
+        return degridder.predict(self._ms.getcol("UVW", start, nrow),
+            self.channel_frequency())
+
+    def _w_step(self, coordinates, shape):
+        w_max = self._w_max * numpy.max(self.channel_frequency()) \
+            / constants.speed_of_light
+        return gridding.w_step(shape[2:], coordinates.get_increment()[2],
+            w_max, self._w_planes)
+
+    def _worker_pool(self):
+        if self._pool is None and self._threads > 1:
+            self._pool = multiprocessing.pool.ThreadPool(self._threads)
+        return self._pool
+
+    def _max_planes(self, shape, n_correlation):
+        """Return the number of W-planes that fit in w_memory MB."""
+        size = gridding.plane_size(shape[2:], self._padding, n_correlation)
+        return max(1, int(self._w_memory * 1024.0 * 1024.0 / size))
+
+    def _gridder(self, coordinates, shape, n_correlation):
+        return gridding.WStackGridder(shape[2:],
+            coordinates.get_increment()[2], self._padding,
+            self._w_step(coordinates, shape), n_correlation,
+            self._worker_pool(), self._max_planes(shape, n_correlation))
+
+    def _degridder(self, coordinates, model):
+        shape = model.shape
+        model = as_dense(model)
+        # Only a single frequency is supported.
+        model = gridding.stokes_to_linear(model[0], self._n_correlation())
+        return gridding.WStackDegridder(model, coordinates.get_increment()[2],
+            self._padding, self._w_step(coordinates, shape),
+            self._worker_pool(), self._max_planes(shape, model.shape[0]))
+
+    def _stokes(self, gridder, shape):
+        """Return the (un-normalized) Stokes image and the weight of each
+        Stokes parameter."""
+        with instrumentation.timer("reference.fft"):
+            image = gridder.image()
+        image = gridding.linear_to_stokes(image)[numpy.newaxis]
+        weight = numpy.repeat(gridder.weight(), shape[1]).reshape(shape[:2])
+        if self._n_correlation() == 2:
+            weight[:, 2:] = 0.0
+        return (image, weight)
+
+class _StreamingGridder(streaming.StreamingGridder):
+    """Streaming gridder on top of the (W-stacking) gridder of the processor.
+    A snapshot transforms the uv grids filled since the previous snapshot and
+    adds them to the image of the gridder, after which gridding continues on
+    empty uv grids."""
+    def __init__(self, processor, coordinates, shape):
+        streaming.StreamingGridder.__init__(self)
+        self._processor = processor
+        self._coordinates = coordinates
+        self._shape = shape
+        self._gridder = processor._gridder(coordinates, shape,
+            processor._n_correlation())
+
+    def _add(self, chunk):
+        chunk = dict(chunk)
+        chunk["IMAGING_WEIGHT_CUBE"] = streaming.imaging_weight_cube(chunk,
+            self._processor.imw, self._processor.channel_frequency())
+        self._processor._grid(self._gridder, chunk, self._coordinates,
+            self._shape)
+
+    def _snapshot(self):
+        return self._processor._stokes(self._gridder, self._shape)
+
+    def _close(self):
+        self._gridder = None
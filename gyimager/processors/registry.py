@@ -0,0 +1,181 @@
+"""Registry of the data processor implementations and their capabilities.
+
+Each implementation is registered by name, with the (sub)module of
+gyimager.processors that implements it, the modules it needs to be importable,
+and a dict of the capabilities it declares. The capabilities are known without
+importing the implementation, such that the algorithms can choose a data
+processor, or reject an unsuitable one, before any data is read.
+
+Implementations are registered in order of preference (fastest first), which
+is the order in which select() considers them.
+"""
+
+import imp
+
+# Capabilities. The values are booleans, unless noted otherwise.
+
+# Implements point_spread_function(), grid() and grid_chunk().
+GRID = "grid"
+# Implements degrid() and degrid_chunk(), which write model visibilities.
+DEGRID = "degrid"
+# Implements residual().
+RESIDUAL = "residual"
+# Implements open_grid(), which returns a streaming.StreamingGridder.
+INCREMENTAL = "incremental"
+# grid_chunk() and degrid_chunk() process the rows chunksize rows at a time
+# (otherwise chunksize is ignored).
+CHUNKED_IO = "chunked_io"
+# Uses the threads option to process data concurrently.
+THREADS = "threads"
+# Produces images with more than one channel.
+CUBE = "cube"
+# Applies direction dependent effects (A-terms).
+DIRECTION_DEPENDENT = "direction_dependent"
+# Maximum number of pixels along an image axis (int, 0 if unlimited).
+MAX_IMAGE_SIZE = "max_image_size"
+# Memory model (string): "in_memory" (all visibilities are held in memory),
+# "streaming" (visibilities are read and written in blocks of rows), or
+# "distributed" (the visibilities are spread over remote engines).
+MEMORY_MODEL = "memory_model"
+
+# Name that selects the preferred data processor that has the required
+# capabilities (see select()).
+AUTO = "auto"
+
+class Entry:
+    def __init__(self, name, module, capabilities, requires):
+        self.name = name
+        self.module = module
+        self.capabilities = capabilities
+        self.requires = requires
+
+_ENTRIES = []
+_ALIASES = {}
+
+def register(name, module, capabilities, requires = [], aliases = []):
+    """Register data processor name, implemented by module (relative to
+    gyimager.processors), which should provide create_data_processor() and
+    create_data_processor_low_level(). The implementation can only be used if
+    all modules in requires can be imported."""
+    if name in names() or name in _ALIASES:
+        raise RuntimeError("Data processor already registered: %s" % name)
+
+    declared = {GRID: False, DEGRID: False, RESIDUAL: False, INCREMENTAL:
+        False, CHUNKED_IO: False, THREADS: False, CUBE: False,
+        DIRECTION_DEPENDENT: False, MAX_IMAGE_SIZE: 0, MEMORY_MODEL:
+        "in_memory"}
+    declared.update(capabilities)
+    _ENTRIES.append(Entry(name, module, declared, list(requires)))
+    for alias in aliases:
+        _ALIASES[alias] = name
+
+def names():
+    return [entry.name for entry in _ENTRIES]
+
+def lookup(name):
+    """Return the entry of data processor name (or an alias)."""
+    name = _ALIASES.get(name, name)
+    for entry in _ENTRIES:
+        if entry.name == name:
+            return entry
+    raise RuntimeError("Unknown data processor: %s (available: %s)" % (name,
+        ", ".join(names())))
+
+def capabilities(name):
+    """Return (a copy of) the capabilities declared by data processor name."""
+    return dict(lookup(name).capabilities)
+
+def missing(capabilities, requirements):
+    """Return the names of the requirements that are not met by capabilities.
+    Requirements map a capability to the required value: True for a boolean
+    capability, the image size for MAX_IMAGE_SIZE, or the memory model."""
+    result = []
+    for (key, value) in sorted(requirements.iteritems()):
+        declared = capabilities.get(key)
+        if key == MAX_IMAGE_SIZE:
+            if declared and value > declared:
+                result.append("%s (%d > %d)" % (key, value, declared))
+        elif value is True or value is False:
+            if value and not declared:
+                result.append(key)
+        elif declared != value:
+            result.append("%s (%s)" % (key, value))
+    return result
+
+def available(name):
+    """Return True if the modules required by data processor name can be
+    imported. The modules are located, but not imported."""
+    for module in lookup(name).requires:
+        try:
+            imp.find_module(module.split(".")[0])
+        except ImportError:
+            return False
+    return True
+
+def check(name, capabilities, requirements):
+    """Raise a RuntimeError if capabilities (of data processor name) do not
+    meet requirements."""
+    unmet = missing(capabilities, requirements)
+    if unmet:
+        raise RuntimeError("Data processor %s does not support: %s" % (name,
+            ", ".join(unmet)))
+
+def select(requirements):
+    """Return the name of the first (i.e. fastest) available data processor
+    that meets requirements."""
+    reasons = []
+    for entry in _ENTRIES:
+        unmet = missing(entry.capabilities, requirements)
+        if unmet:
+            reasons.append("%s: does not support %s" % (entry.name,
+                ", ".join(unmet)))
+        elif not available(entry.name):
+            reasons.append("%s: requires %s" % (entry.name,
+                ", ".join(entry.requires)))
+        else:
+            return entry.name
+    raise RuntimeError("No suitable data processor available (%s)"
+        % "; ".join(reasons))
+
+def resolve(name, requirements):
+    """Return the name of the data processor to use for name, which can be
+    AUTO, an alias or the name of a data processor. Raise a RuntimeError if
+    it does not meet requirements."""
+    if name == AUTO:
+        return select(requirements)
+    entry = lookup(name)
+    check(entry.name, entry.capabilities, requirements)
+    return entry.name
+
+def load(name):
+    """Import and return the module that implements data processor name."""
+    entry = lookup(name)
+    try:
+        # The call to __import__ fails when not passing the global variables.
+        return __import__(entry.module, globals = globals())
+    except ImportError, exception:
+        raise RuntimeError("Unable to import data processor implementation:"
+            " %s (%s)" % (entry.name, exception))
+
+# The casa processor does not implement open_grid() (INCREMENTAL): end_grid()
+# transforms the grid, such that a streaming gridder would have to start a
+# new grid after every snapshot, which has not been verified against
+# casaimwrap.
+register("casa", "casa", {GRID: True, DEGRID: True, RESIDUAL: True,
+    CHUNKED_IO: True, DIRECTION_DEPENDENT: True, MEMORY_MODEL: "streaming"},
+    requires = ["pyrap", "casaimwrap"])
+# The pywsplit processor degrids through casaimwrap functions (init_cf(),
+# make_convolution_function(), degrid_reimplemented(), ...) that are not
+# exported by the current binding, so only gridding works. Its gridding is a
+# single casaimwrap call, which does not use the threads option.
+register("pywsplit", "pywsplit", {GRID: True},
+    requires = ["pyrap", "casaimwrap"])
+register("reference", "reference", {GRID: True, DEGRID: True, RESIDUAL: True,
+    INCREMENTAL: True, CHUNKED_IO: True, THREADS: True, MEMORY_MODEL:
+    "streaming"}, requires = ["pyrap"], aliases = ["numpy"])
+# The idg processor only applies A-terms if a model is given (idg_aterm
+# option), so it does not declare DIRECTION_DEPENDENT.
+register("idg", "idg", {GRID: True, DEGRID: True, RESIDUAL: True,
+    INCREMENTAL: True, CHUNKED_IO: True, THREADS: True, MEMORY_MODEL:
+    "streaming"}, requires = ["pyrap"])
+register("gpu", "gpu", {})
@@ -0,0 +1,76 @@
+"""Partitioning of visibility data into spans that can be (de)gridded
+independently.
+
+A span is a list of rows of a single baseline within a single W-plane, that
+covers at most a given time window, such that a single convolution kernel can
+be used for all rows of the span.
+"""
+
+import numpy
+from ..algorithms import constants
+
+def make_mapping_time_w(antenna1, antenna2, uvw, time, w_index, ref_freq,
+    time_window, uv_min, uv_max, w_max):
+    """Re-implementation of LofarFTMachine::make_mapping_time()_W.
+
+    Return (w_map, w_index_map, index), where w_map is a list that contains a
+    list of spans for each W-plane, w_index_map contains the index of each
+    W-plane, and index is the order in which the rows are processed.
+
+    Keyword arguments:
+    w_index -- W-plane index of each row.
+    ref_freq -- Reference frequency (Hz).
+    time_window -- Maximum time covered by a span (s).
+    uv_min, uv_max -- Range of UV distances to include (klambda).
+    w_max -- Maximum absolute W coordinate (m).
+    """
+    ref_wl = constants.speed_of_light / ref_freq
+
+    # The last array passed to numpy.lexsort() is the primary sort key,
+    # hence the reversal of antenna1 and antenna2.
+    index = numpy.lexsort((antenna2, antenna1, w_index))
+    active_baseline = None
+    active_window = None
+    active_w_index = None
+
+    w_map = []
+    w_index_map = []
+    sub_map = []
+    sub_w_map = []
+
+    for row in index:
+        if numpy.abs(uvw[row, 2]) >= w_max:
+            continue
+
+        # Compute UV distance in klambda.
+        uv_distance = numpy.sqrt(numpy.sum(numpy.square(uvw[row,:2]))) / \
+            (1e3 * ref_wl)
+        if uv_distance <= uv_min or uv_distance >= uv_max:
+            continue
+
+        if active_baseline is None:
+            active_baseline = (antenna1[row], antenna2[row])
+            active_window = time[row] + time_window
+            active_w_index = w_index[row]
+
+        baseline = (antenna1[row], antenna2[row])
+        if time[row] > active_window or baseline != active_baseline:
+            active_window = time[row] + time_window
+            active_baseline = baseline
+            sub_w_map.append(sub_map)
+            sub_map = []
+
+        if w_index[row] != active_w_index:
+            w_map.append(sub_w_map)
+            w_index_map.append(active_w_index)
+
+            active_w_index = w_index[row]
+            sub_w_map = []
+
+        sub_map.append(row)
+
+    sub_w_map.append(sub_map)
+    w_map.append(sub_w_map)
+    w_index_map.append(active_w_index)
+
+    return (w_map, w_index_map, index)
@@ -0,0 +1,130 @@
+import numpy
+
+class SparseModel:
+    """Clean component model, stored as a list of components.
+
+    Each component has a position, stored as a flat index into the (channel,
+    y, x) pixel grid, and a flux per correlation. A model produced by a few
+    thousand minor cycle iterations only has a small number of non-zero pixels,
+    which makes this representation a lot more compact than a dense image.
+
+    The model supports the operations used by the imaging code on dense
+    images: in-place addition of a dense image, multiplication and division by
+    a (broadcastable) dense image, copy() and sum().
+    """
+
+    def __init__(self, shape, index = None, flux = None):
+        """Create a model for an image of shape (channel, correlation, y, x).
+        Without index and flux, the model is empty."""
+        assert(len(shape) == 4)
+        self.shape = tuple(int(x) for x in shape)
+
+        if index is None:
+            index = numpy.zeros(0, dtype=numpy.int64)
+            flux = numpy.zeros((0, self.shape[1]))
+
+        self.index = numpy.asarray(index, dtype=numpy.int64)
+        self.flux = numpy.asarray(flux, dtype=float)
+        assert(self.flux.shape == (len(self.index), self.shape[1]))
+
+    @staticmethod
+    def from_dense(image):
+        """Create a model from the non-zero pixels of a dense image."""
+        assert(len(image.shape) == 4)
+        mask = numpy.any(image != 0.0, axis=1)
+        (ch, y, x) = numpy.nonzero(mask)
+        index = numpy.ravel_multi_index((ch, y, x), mask.shape)
+        return SparseModel(image.shape, index, image[ch, :, y, x])
+
+    def to_dense(self, box = None):
+        """Return the model as a dense image.
+
+        If box is given, only the ((y0, y1), (x0, x1)) part of the image is
+        returned.
+        """
+        if box is None:
+            box = ((0, self.shape[2]), (0, self.shape[3]))
+
+        image = numpy.zeros(self.shape[:2] + (box[0][1] - box[0][0],
+            box[1][1] - box[1][0]))
+
+        (ch, y, x) = self._unravel()
+        inside = (y >= box[0][0]) & (y < box[0][1]) & (x >= box[1][0]) \
+            & (x < box[1][1])
+        image[ch[inside], :, y[inside] - box[0][0], x[inside] - box[1][0]] \
+            = self.flux[inside]
+        return image
+
+    def bounding_box(self):
+        """Return the ((y0, y1), (x0, x1)) bounding box of all components, or
+        None if the model is empty."""
+        if len(self.index) == 0:
+            return None
+
+        (ch, y, x) = self._unravel()
+        return ((numpy.min(y), numpy.max(y) + 1), (numpy.min(x),
+            numpy.max(x) + 1))
+
+    def add(self, image):
+        """Add a dense image (or another model) to this model, in place."""
+        if not isinstance(image, SparseModel):
+            image = SparseModel.from_dense(image)
+        assert(image.shape == self.shape)
+
+        if len(image.index) == 0:
+            return self
+
+        # Merge components at the same position.
+        (index, inverse) = numpy.unique(numpy.concatenate((self.index,
+            image.index)), return_inverse=True)
+        flux = numpy.zeros((len(index), self.shape[1]))
+        numpy.add.at(flux, inverse, numpy.concatenate((self.flux,
+            image.flux)))
+
+        self.index = index
+        self.flux = flux
+        return self
+
+    def scale(self, factor):
+        """Return a new model with the flux of each component multiplied by
+        the value of factor (broadcastable to the image shape) at the position
+        of the component."""
+        (ch, y, x) = self._unravel()
+        factor = numpy.broadcast_to(factor, self.shape)
+        return SparseModel(self.shape, self.index.copy(), self.flux
+            * factor[ch, :, y, x])
+
+    def copy(self):
+        return SparseModel(self.shape, self.index.copy(), self.flux.copy())
+
+    def sum(self):
+        """Return the total flux of the model."""
+        return numpy.sum(self.flux)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iadd__(self, image):
+        return self.add(image)
+
+    def __mul__(self, factor):
+        return self.scale(factor)
+
+    def __div__(self, factor):
+        return self.scale(1.0 / factor)
+
+    __truediv__ = __div__
+
+    @property
+    def nbytes(self):
+        return self.index.nbytes + self.flux.nbytes
+
+    def _unravel(self):
+        return numpy.unravel_index(self.index, (self.shape[0],)
+            + self.shape[2:])
+
+def as_dense(model):
+    """Return model as a dense image, converting it if it is a SparseModel."""
+    if isinstance(model, SparseModel):
+        return model.to_dense()
+    return model
@@ -0,0 +1,110 @@
+"""Incremental gridding of visibilities as they arrive.
+
+A StreamingGridder is returned by the open_grid() method of a data processor
+that declares the registry.INCREMENTAL capability. Chunks of visibilities are
+added in any number and from any source, and snapshot() returns the dirty
+image of all chunks added so far without gridding earlier chunks again:
+
+    gridder = processor.open_grid(coordinates, shape)
+    for chunk in chunks:
+        gridder.add(chunk)
+        (image, weight) = gridder.snapshot()
+    (image, weight) = gridder.close()
+
+A chunk is a dict of numpy arrays with the columns ANTENNA1, ANTENNA2, UVW,
+TIME, TIME_CENTROID, FLAG_ROW, FLAG and DATA of a block of rows, as read from
+a measurement set. The imaging weights are taken from IMAGING_WEIGHT_CUBE if
+present, and are otherwise computed by the data processor from
+WEIGHT_SPECTRUM (unit weights if absent). Weighting schemes other than natural
+weighting require the density to be set on the data processor first.
+
+The images and weights are those returned by the grid() method of the data
+processor: the gridders of the low level data processors return additive
+(unnormalized) images with their weights, DataProcessorDefault.open_grid()
+returns a NormalizedGridder (i.e. flat noise images). While a gridder is open,
+the data processor should not be used to grid or degrid other data.
+"""
+
+import numpy
+from reduction import normalized
+
+# Columns a chunk should contain.
+COLUMNS = ["ANTENNA1", "ANTENNA2", "UVW", "TIME", "TIME_CENTROID", "FLAG_ROW",
+    "FLAG", "DATA"]
+
+def imaging_weight_cube(chunk, imaging_weight, freqs):
+    """Return the imaging weights of chunk, of shape (row, channel,
+    correlation), computed by imaging_weight (an ImagingWeight instance)
+    unless the chunk contains IMAGING_WEIGHT_CUBE."""
+    if chunk.get("IMAGING_WEIGHT_CUBE") is not None:
+        return chunk["IMAGING_WEIGHT_CUBE"]
+
+    weight_spectrum = chunk.get("WEIGHT_SPECTRUM")
+    if weight_spectrum is None:
+        weight_spectrum = numpy.ones(chunk["FLAG"].shape, dtype=numpy.float32)
+    weight = imaging_weight.imaging_weight(chunk["UVW"], freqs, chunk["FLAG"],
+        weight_spectrum)
+    weight[chunk["FLAG_ROW"]] = 0.0
+    return numpy.repeat(weight[:, :, numpy.newaxis], chunk["FLAG"].shape[2],
+        axis=2).astype(numpy.float32)
+
+class StreamingGridder:
+    def __init__(self):
+        self._closed = False
+        self._rows = 0
+
+    def add(self, chunk):
+        """Grid a chunk of visibilities (see module documentation)."""
+        if self._closed:
+            raise RuntimeError("Gridder is closed")
+        missing = [name for name in COLUMNS if name not in chunk]
+        if missing:
+            raise RuntimeError("Chunk lacks column(s): %s" % ", ".join(missing))
+
+        self._add(chunk)
+        self._rows += len(chunk["TIME"])
+
+    def rows(self):
+        """Return the number of rows added so far."""
+        return self._rows
+
+    def snapshot(self):
+        """Return the dirty image of all chunks added so far, and its weight
+        (see grid())."""
+        if self._closed:
+            raise RuntimeError("Gridder is closed")
+        return self._snapshot()
+
+    def close(self):
+        """Return the final snapshot, and release the resources of the
+        gridder."""
+        result = self.snapshot()
+        self._close()
+        self._closed = True
+        return result
+
+    def _add(self, chunk):
+        raise NotImplementedError
+
+    def _snapshot(self):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+class NormalizedGridder(StreamingGridder):
+    """Gridder that divides the snapshots of the gridder of a low level data
+    processor by their weight."""
+    def __init__(self, gridder):
+        StreamingGridder.__init__(self)
+        self._gridder = gridder
+
+    def _add(self, chunk):
+        self._gridder.add(chunk)
+
+    def _snapshot(self):
+        (image, weight) = self._gridder.snapshot()
+        return (normalized(image, weight), weight)
+
+    def _close(self):
+        self._gridder.close()
@@ -0,0 +1,325 @@
+"""Local on-disk cache of the visibility data read from a measurement set.
+
+The major cycles of mfclean read the same columns from the measurement set
+over and over again. When the measurement set lives on a network filesystem,
+this dominates the run time. VisibilityCache wraps an MSReader and stores each
+column the first time it is read in a directory on local disk. Later reads
+are served from memory mapped copies.
+
+To reduce the size of the cache (and the amount of data read back), boolean
+columns are stored bit packed, and complex columns can optionally be stored
+at half precision. Half precision keeps about three significant digits. A
+column is only stored at half precision if the relative error of every finite
+sample is below _HALF_TOLERANCE, otherwise it is stored at full precision.
+
+Optionally, the cache is compressed: each block of _BLOCK_SIZE rows is
+compressed separately (zlib), such that a range of rows can be read by
+decompressing only the blocks that contain it. The compressed file is memory
+mapped as well, and the last block decompressed is kept in memory for the
+next read. Compression mostly pays off for the flags and metadata columns;
+noisy visibilities compress poorly.
+
+The cache is only used if the identity of the measurement (path, size and
+modification time of its table files) matches the identity recorded when the
+cache was filled. Writes through putcol() update the measurement and drop the
+cached copy of the column that was written.
+"""
+
+import os
+import json
+import zlib
+import shutil
+import hashlib
+import numpy
+
+from product_cache import measurement_identity
+from ..algorithms import instrumentation
+
+_MANIFEST = "manifest.json"
+
+# Number of rows read from the measurement set at a time when filling the
+# cache, which is also the number of rows compressed together.
+_BLOCK_SIZE = 100000
+
+# Largest relative error of a (finite) sample for a column to be stored at
+# half precision. Rounding to half precision has a relative error of at most
+# 2^-11 for normal numbers; larger errors indicate values that are too small
+# (subnormal) or too large (overflow).
+_HALF_TOLERANCE = 1e-3
+
+# zlib compression level; fast compression suffices, because the data is
+# mostly noise.
+_COMPRESSION_LEVEL = 1
+
+class VisibilityCache:
+    def __init__(self, reader, measurement, root, precision = "single",
+        compress = False):
+        """Create a cache for the data read through reader (an MSReader)
+        from measurement, stored in a sub-directory of root.
+
+        precision -- Precision at which complex columns are stored, either
+            "single" or "half".
+        compress -- Compress the columns in blocks of rows.
+        """
+        if precision not in ("single", "half"):
+            raise RuntimeError("Unknown visibility cache precision: %s"
+                % precision)
+
+        self._reader = reader
+        self._measurement = measurement
+        self._precision = precision
+        self._compress = compress
+
+        key = hashlib.sha1(json.dumps([os.path.abspath(measurement),
+            reader.selection()], sort_keys=True)).hexdigest()
+        self._root = os.path.join(os.path.expanduser(root), key)
+
+        self._identity = measurement_identity(measurement)
+        self._columns = self._load_manifest()
+        self._arrays = {}
+        self._blocks = {}
+
+    def query(self):
+        return self._reader.query()
+
+    def selection(self):
+        return self._reader.selection()
+
+    def selects_samples(self):
+        return self._reader.selects_samples()
+
+    def nrows(self):
+        return self._reader.nrows()
+
+    def __len__(self):
+        return self.nrows()
+
+    @instrumentation.timed("vis_cache.read")
+    def getcol(self, name, start = 0, nrow = -1, expand = True):
+        """Read column name for nrow rows starting at row start, from the
+        cache if possible. See MSReader.getcol()."""
+        if not expand:
+            return self._reader.getcol(name, start, nrow, expand)
+
+        if name not in self._columns:
+            self._fill(name)
+
+        info = self._columns[name]
+        end = self.nrows() if nrow < 0 else start + nrow
+        value = self._rows(name, start, end)
+
+        if info["format"] == "packed":
+            cells = int(numpy.prod(info["shape"]))
+            value = numpy.unpackbits(value, axis=1)[:, :cells]
+            return value.astype(bool).reshape((end - start,)
+                + tuple(info["shape"]))
+
+        if info["format"] == "half":
+            value = numpy.ascontiguousarray(value, dtype=numpy.float32)
+            return value.view(numpy.complex64)[..., 0]
+
+        return numpy.array(value)
+
+    def putcol(self, name, value, start = 0, nrow = -1):
+        """Write column name to the measurement set. See MSReader.putcol()."""
+        self._reader.putcol(name, value, start, nrow)
+
+        # The write changes the identity of the measurement, but only the
+        # column that was written is out of date.
+        self._identity = measurement_identity(self._measurement)
+        if name in self._columns:
+            info = self._columns.pop(name)
+            self._arrays.pop(name, None)
+            self._blocks.pop(name, None)
+            os.remove(self._path(name, info))
+        self._store_manifest()
+
+    def ensure_column(self, name, like = "DATA", tile_rows = 0):
+        self._reader.ensure_column(name, like, tile_rows)
+        self._identity = measurement_identity(self._measurement)
+        self._store_manifest()
+
+    def tile_rows(self, name):
+        return self._reader.tile_rows(name)
+
+    def rownumbers(self):
+        return self._reader.rownumbers()
+
+    def _path(self, name, info):
+        extension = ".zblocks" if "offsets" in info else ".npy"
+        return os.path.join(self._root, name + extension)
+
+    def _array(self, name):
+        if name not in self._arrays:
+            info = self._columns[name]
+            if "offsets" in info:
+                self._arrays[name] = numpy.memmap(self._path(name, info),
+                    dtype=numpy.uint8, mode="r")
+            else:
+                self._arrays[name] = numpy.load(self._path(name, info),
+                    mmap_mode="r")
+        return self._arrays[name]
+
+    def _rows(self, name, start, end):
+        """Return rows start up to end of column name, as stored."""
+        info = self._columns[name]
+        if "offsets" in info and end <= start:
+            return numpy.zeros((0,) + tuple(info["row_shape"]),
+                dtype=numpy.dtype(info["dtype"]))
+
+        array = self._array(name)
+        if "offsets" not in info:
+            return array[start:end]
+
+        # Decompress the blocks that contain the rows.
+        parts = []
+        for index in range(start // _BLOCK_SIZE, (end - 1) // _BLOCK_SIZE
+            + 1):
+            block = self._block(name, info, array, index)
+            offset = index * _BLOCK_SIZE
+            parts.append(block[max(start - offset, 0):end - offset])
+        if len(parts) == 1:
+            return parts[0]
+        return numpy.concatenate(parts)
+
+    def _block(self, name, info, array, index):
+        cached = self._blocks.get(name)
+        if cached is not None and cached[0] == index:
+            return cached[1]
+
+        (first, last) = info["offsets"][index:index + 2]
+        with instrumentation.timer("vis_cache.decompress"):
+            block = numpy.frombuffer(zlib.decompress(array[first:last]
+                .tobytes()), dtype=numpy.dtype(info["dtype"]))
+        block = block.reshape((-1,) + tuple(info["row_shape"]))
+        self._blocks[name] = (index, block)
+        return block
+
+    def _fill(self, name):
+        """Read column name from the measurement set and store it in the
+        cache."""
+        nrows = self.nrows()
+        first = self._reader.getcol(name, 0, min(nrows, _BLOCK_SIZE))
+        shape = first.shape[1:]
+
+        info = {"format": "raw", "shape": list(shape)}
+        if first.dtype == numpy.bool_:
+            info["format"] = "packed"
+        elif numpy.iscomplexobj(first) and self._precision == "half":
+            info["format"] = "half"
+
+        if not self._write(name, info, first):
+            # Fall back to full precision if the column cannot be stored
+            # accurately enough at half precision.
+            info["format"] = "raw"
+            self._write(name, info, first)
+
+        self._columns[name] = info
+        self._store_manifest()
+
+    def _write(self, name, info, first):
+        """Write column name in the format described by info (to which the
+        layout of the file is added). Return False if the column cannot be
+        represented in this format."""
+        nrows = self.nrows()
+        if info["format"] == "packed":
+            cells = int(numpy.prod(info["shape"]))
+            (row_shape, dtype) = (((cells + 7) // 8,), numpy.uint8)
+        elif info["format"] == "half":
+            (row_shape, dtype) = (first.shape[1:] + (2,), numpy.float16)
+        else:
+            (row_shape, dtype) = (first.shape[1:], first.dtype)
+
+        if self._compress:
+            info.update({"dtype": numpy.dtype(dtype).str, "row_shape":
+                list(row_shape), "offsets": [0]})
+        else:
+            for key in ("dtype", "row_shape", "offsets"):
+                info.pop(key, None)
+
+        if not os.path.isdir(self._root):
+            os.makedirs(self._root)
+        path = self._path(name, info)
+        tmp_path = path + ".tmp"
+        if self._compress:
+            output = open(tmp_path, "wb")
+        else:
+            output = numpy.lib.format.open_memmap(tmp_path, mode="w+",
+                dtype=dtype, shape=(nrows,) + row_shape)
+
+        try:
+            for start in range(0, nrows, _BLOCK_SIZE):
+                nrow = min(_BLOCK_SIZE, nrows - start)
+                value = first if start == 0 else self._reader.getcol(name,
+                    start, nrow)
+                value = _encode(info["format"], value)
+                if value is None:
+                    if self._compress:
+                        output.close()
+                    output = None
+                    os.remove(tmp_path)
+                    return False
+
+                if self._compress:
+                    with instrumentation.timer("vis_cache.compress"):
+                        data = zlib.compress(numpy.ascontiguousarray(value,
+                            dtype=dtype).tobytes(), _COMPRESSION_LEVEL)
+                    output.write(data)
+                    info["offsets"].append(info["offsets"][-1] + len(data))
+                else:
+                    output[start:start + nrow] = value
+        finally:
+            if self._compress and output is not None:
+                output.close()
+
+        if not self._compress:
+            output.flush()
+        del output
+        os.rename(tmp_path, path)
+        return True
+
+    def _load_manifest(self):
+        """Return the columns available in the cache. If the cache is out of
+        date, it is removed."""
+        path = os.path.join(self._root, _MANIFEST)
+        if os.path.isfile(path):
+            with open(path) as fin:
+                manifest = json.load(fin)
+            if manifest.get("identity") == json.loads(json.dumps(
+                self._identity)):
+                return manifest["columns"]
+
+        if os.path.exists(self._root):
+            shutil.rmtree(self._root)
+        return {}
+
+    def _store_manifest(self):
+        if not os.path.isdir(self._root):
+            os.makedirs(self._root)
+
+        # Replace the manifest atomically.
+        path = os.path.join(self._root, _MANIFEST)
+        with open(path + ".tmp", "w") as fout:
+            json.dump({"identity": self._identity, "columns": self._columns},
+                fout)
+        os.rename(path + ".tmp", path)
+
+def _encode(format, value):
+    """Return the block of rows value in the given storage format, or None if
+    it cannot be represented accurately enough in this format."""
+    if format == "packed":
+        return numpy.packbits(value.reshape((value.shape[0], -1)), axis=1)
+
+    if format == "half":
+        value = numpy.ascontiguousarray(value, dtype=numpy.complex64)
+        with numpy.errstate(over="ignore", invalid="ignore"):
+            half = value[..., numpy.newaxis].view(numpy.float32).astype(
+                numpy.float16)
+            error = numpy.abs(half.astype(numpy.float32).view(
+                numpy.complex64)[..., 0] - value)
+            exact = error <= _HALF_TOLERANCE * numpy.abs(value)
+        if not numpy.all(exact | ~numpy.isfinite(value)):
+            return None
+        return half
+
+    return value
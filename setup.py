@@ -23,7 +23,7 @@ setup(
     license="GPL2",
     keywords="radio astronomy",
     url="http://github.com/radio-astro/pyimager",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     ext_modules=extensions,
     classifiers=[
         "Development Status :: 3 - Alpha",
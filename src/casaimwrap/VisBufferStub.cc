@@ -90,10 +90,31 @@ void VisBufferStub::setChunk(const Vector<Int> &antenna1,
     itsTime.reference(time);
     itsTimeCentroid.reference(timeCentroid);
     itsFlagRow.reference(flagRow);
-    itsImagingWeightCube.reference(imagingWeightCube);
     itsFlag.reference(flag);
-    std::cout<<"going to set an empty cube..."<<endl; // INI: added comment
-    itsData.reference(data);
+
+    // An empty imaging weight cube means all weights are equal to 1.0.
+    if(imagingWeightCube.empty())
+    {
+        itsImagingWeightCube.reference(unitCube(itsUnitWeight, flag.shape(),
+            1.0f));
+    }
+    else
+    {
+        itsImagingWeightCube.reference(imagingWeightCube);
+    }
+
+    // An empty data cube means all visibilities are equal to 1.0, which is
+    // what is needed to compute the PSF.
+    if(data.empty())
+    {
+        itsData.reference(unitCube(itsUnitData, flag.shape(),
+            Complex(1.0, 0.0)));
+    }
+    else
+    {
+        itsData.reference(data);
+    }
+
     itsNewMS = newMS;
 
     itsNRow = itsTime.size();
@@ -147,9 +168,34 @@ void VisBufferStub::setChunk(const Vector<Int> &antenna1,
     Bool newMS)
 {
     setChunk(antenna1, antenna2, uvw, time, timeCentroid, flagRow, imagingWeight, flag,
-        Cube<Complex>(), newMS);
-    itsData.resize(itsFlag.shape());
-    itsData.set(0.0);
+        Cube<Complex>(flag.shape(), Complex(0.0, 0.0)), newMS);
+}
+
+template <typename T>
+const Cube<T> &VisBufferStub::unitCube(Cube<T> &cube, const IPosition &shape,
+    const T &value)
+{
+    // The cube is only (re)allocated and filled when the shape of the chunk
+    // changes, which is rare as chunks are usually of equal size.
+    if(!cube.shape().isEqual(shape))
+    {
+        cube.resize(shape);
+        cube.set(value);
+    }
+    return cube;
+}
+
+void VisBufferStub::releaseChunk()
+{
+    itsAntenna1.reference(Vector<Int>());
+    itsAntenna2.reference(Vector<Int>());
+    itsTime.reference(Vector<Double>());
+    itsTimeCentroid.reference(Vector<Double>());
+    itsFlagRow.reference(Vector<Bool>());
+    itsImagingWeightCube.reference(Cube<Float>());
+    itsFlag.reference(Cube<Bool>());
+    itsData.reference(Cube<Complex>());
+    itsNRow = 0;
 }
 
 LOFAR::LofarFT::VisBuffer &VisBufferStub::assign(const LOFAR::LofarFT::VisBuffer & vb, Bool copy)
@@ -45,6 +45,9 @@ class VisBufferStub: public LOFAR::LofarFT::VisBuffer
 public:
     VisBufferStub(const MeasurementSet &ms);
 
+    // Set the arrays of the current chunk. The arrays are referenced, not
+    // copied. If imagingWeightCube is empty, all imaging weights are taken to
+    // be 1.0. If data is empty, all visibilities are taken to be 1.0.
     void setChunk(const Vector<Int> &antenna1,
         const Vector<Int> &antenna2,
         const Matrix<Double> &uvw,
@@ -66,6 +69,10 @@ public:
         const Cube<Bool> &flag,
         Bool newMS = false);
 
+    // Drop all references to the arrays passed to setChunk(). Must be called
+    // before the memory of these arrays is released by the caller.
+    void releaseChunk();
+
     virtual VisBuffer & assign(const VisBuffer & vb, Bool copy = True);
     virtual void attachToVisIter(ROVisibilityIterator & iter);
     virtual void detachFromVisIter();
@@ -223,6 +230,10 @@ public:
     virtual Bool newMS() const;
 
 private:
+    template <typename T>
+    static const Cube<T> &unitCube(Cube<T> &cube, const IPosition &shape,
+        const T &value);
+
     ROMSColumns                         itsROMSColumns;
     Vector<Double>                      itsFrequency;
     MDirection                          itsPhaseCenter;
@@ -237,6 +248,8 @@ private:
     Vector<Double>                      itsTime;
     Cube<Bool>                          itsFlag;
     Cube<Complex>                       itsData;
+    Cube<Float>                         itsUnitWeight;
+    Cube<Complex>                       itsUnitData;
     Bool                                itsNewMS;
     Int                                 itsSpectralWindow;
     Int                                 itsNRow;
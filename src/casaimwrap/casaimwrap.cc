@@ -84,8 +84,7 @@
 
 #include <boost/python.hpp>
 #include <boost/python/args.hpp>
-#include <signal.h>
-#include <setjmp.h>
+#include <cstring>
 
 using namespace casa;
 using namespace casa::python;
@@ -96,84 +95,198 @@ namespace LOFAR
 namespace casaimwrap
 {
 
+// Release the Python global interpreter lock (GIL) for the lifetime of the
+// object, such that other Python threads can run while a long running CASA
+// call is in progress. Construct with release = false to keep the GIL, e.g.
+// when the FTMachine calls back into Python (ATermPython).
+//
+// The GIL is reacquired by the destructor, so it is also reacquired when the
+// CASA call throws an exception. No Python API function may be called while
+// the GIL is released.
 class ScopedGILRelease
 {
 public:
-    inline ScopedGILRelease()
+    explicit ScopedGILRelease(bool release = true)
+        :   m_thread_state(release ? PyEval_SaveThread() : 0)
     {
-      m_thread_state = PyEval_SaveThread();
-      m_sig_int_handler = 0;
     }
-    
-    void set_sigint_handler()
+
+    ~ScopedGILRelease()
     {
-      m_previous_release = __release;
-      __release = this;
-      m_sig_int_handler = signal(SIGINT, handler_SIGINT);        
+        if(m_thread_state)
+        {
+            PyEval_RestoreThread(m_thread_state);
+        }
     }
-    
-    void sigint_handler()
-    {      
-        PyEval_RestoreThread(m_thread_state);
-        m_thread_state = 0;
-        
-        PyErr_SetString(PyExc_KeyboardInterrupt, "");
+
+private:
+    ScopedGILRelease(const ScopedGILRelease &);
+    ScopedGILRelease &operator=(const ScopedGILRelease &);
+
+    PyThreadState   *m_thread_state;
+};
+
+// Run the Python signal handlers for any signals that arrived while the GIL
+// was released. Python's own SIGINT handler only records the signal, so a
+// Ctrl-C during gridding is turned into a KeyboardInterrupt here, as soon as
+// the call that released the GIL returns. Must be called with the GIL held.
+void check_signals()
+{
+    if(PyErr_CheckSignals() == -1)
+    {
         throw_error_already_set();
     }
+}
+
+// Element type codes (see the struct module) that are accepted for each
+// casacore type.
+template <typename T>
+struct BufferFormat;
+
+template <>
+struct BufferFormat<Bool>
+{
+    static const char *codes() { return "?"; }
+};
+
+template <>
+struct BufferFormat<Int>
+{
+    static const char *codes() { return "il"; }
+};
 
-    inline ~ScopedGILRelease()
+template <>
+struct BufferFormat<Float>
+{
+    static const char *codes() { return "f"; }
+};
+
+template <>
+struct BufferFormat<Double>
+{
+    static const char *codes() { return "d"; }
+};
+
+template <>
+struct BufferFormat<Complex>
+{
+    static const char *codes() { return "Z"; }
+};
+
+// Return true if format describes a single element of type T, stored in
+// native byte order.
+template <typename T>
+bool format_matches(const char *format)
+{
+    const unsigned int probe = 1;
+    const bool little_endian = *reinterpret_cast<const char*>(&probe) == 1;
+
+    if(format == 0)
     {
-      if (m_sig_int_handler) 
-      {
-        signal(SIGINT, m_sig_int_handler);
-      }
-      
-      __release = m_previous_release;
-      
-      if (m_thread_state)
-      {
-        PyEval_RestoreThread(m_thread_state);
-      }
+        // No format means unsigned bytes.
+        format = "B";
     }
 
-    jmp_buf m_jmp_buf;
+    // Skip the byte order specification, if it denotes native byte order.
+    if(*format == '@' || *format == '=' || *format == (little_endian ? '<'
+        : '>'))
+    {
+        ++format;
+    }
 
-private:
-    PyThreadState *m_thread_state;
-    sighandler_t m_sig_int_handler;
-    
-    static ScopedGILRelease *__release;
-    ScopedGILRelease *m_previous_release;
-    
-    
-    static void handler_SIGINT(int s)
+    if(*format == '\0' || std::strchr(BufferFormat<T>::codes(), *format) == 0)
     {
-      longjmp(__release->m_jmp_buf, 0);
+        return false;
     }
-};
 
-ScopedGILRelease *ScopedGILRelease::__release = 0;
+    // Complex numbers are denoted by 'Z' followed by the type code of the
+    // real and imaginary parts.
+    if(*format == 'Z')
+    {
+        return std::strcmp(format, "Zf") == 0;
+    }
 
-// TODO: substitute by real test for main thread
-// TODO: make sure sigint signal is delivered to main thread
+    return format[1] == '\0';
+}
 
-#define is_main_thread true
+// Expose the memory of a Python object that supports the buffer protocol
+// (e.g. a NumPy array) as a casacore Array, without copying. The buffer must
+// be C contiguous and its elements must be of type T. As usual, the axes of
+// the casacore Array are in reverse (Fortran) order.
+//
+// The Array references the memory of the Python object, so it should not be
+// used after the BufferView is destroyed. Both construction and destruction
+// require the GIL. If obj is None, the Array is empty.
+template <typename T>
+class BufferView
+{
+public:
+    BufferView(const object &obj, const char *name, bool writable = false)
+        :   m_acquired(false)
+    {
+        if(obj.is_none())
+        {
+            return;
+        }
+
+        int flags = PyBUF_C_CONTIGUOUS | PyBUF_FORMAT;
+        if(writable)
+        {
+            flags |= PyBUF_WRITABLE;
+        }
+
+        if(PyObject_GetBuffer(obj.ptr(), &m_buffer, flags) != 0)
+        {
+            throw_error_already_set();
+        }
+        m_acquired = true;
+
+        if(m_buffer.itemsize != static_cast<Py_ssize_t>(sizeof(T))
+            || !format_matches<T>(m_buffer.format))
+        {
+            PyBuffer_Release(&m_buffer);
+            throw AipsError(String("Unsupported element type for: ") + name);
+        }
+
+        IPosition shape(m_buffer.ndim);
+        for(int i = 0; i < m_buffer.ndim; ++i)
+        {
+            shape[m_buffer.ndim - i - 1] = m_buffer.shape[i];
+        }
+
+        m_array.takeStorage(shape, static_cast<T*>(m_buffer.buf), SHARE);
+    }
 
-#define HANDLE_SIGINT(release) \
-if (is_main_thread) \
-{ \
-  if (setjmp(release.m_jmp_buf) ==0) \
-  { \
-    release.set_sigint_handler(); \
-  } \
-  else \
-  { \
-    release.sigint_handler(); \
-  }\
-}
+    ~BufferView()
+    {
+        if(m_acquired)
+        {
+            PyBuffer_Release(&m_buffer);
+        }
+    }
+
+    Array<T> &array()
+    {
+        return m_array;
+    }
+
+private:
+    BufferView(const BufferView &);
+    BufferView &operator=(const BufferView &);
+
+    bool        m_acquired;
+    Py_buffer   m_buffer;
+    Array<T>    m_array;
+};
 
 struct CASAContext
 {
+    CASAContext()
+        :   psf(false),
+            releaseGIL(true)
+    {
+    }
+
     MeasurementSet                          ms;
     CountedPtr<LOFAR::LofarFT::FTMachine>              ft;
 
@@ -186,6 +299,7 @@ struct CASAContext
     Matrix<Float>                           weight;
     CountedPtr<VisBufferStub>               buffer;
     bool                                    psf;
+    bool                                    releaseGIL;
 
     vector<Array<Complex> >                 grids;
     vector<Array<DComplex> >                gridsComplex;
@@ -259,6 +373,14 @@ void init(CASAContext &context, const String &name, const ParameterSet &paramete
       parameters);
 
     context.buffer = CountedPtr<VisBufferStub>(new VisBufferStub(context.ms));
+
+    // An A-term implemented in Python is evaluated from within the
+    // FTMachine, which requires the GIL. The callback is made by LOFAR's
+    // ATermPython, which does not acquire the GIL itself, so the GIL cannot
+    // be released while gridding with such an A-term (the gyimager commands
+    // use ATermPython). Python threads then only run between calls.
+    context.releaseGIL = parameters.getString("gridding.ATerm.name", "")
+        != "ATermPython";
 }
 
 ValueHolder stokes_to_linear(CASAContext &context, const Record &coordinates,
@@ -291,12 +413,18 @@ Record clark_clean(const ValueHolder &psf, const ValueHolder &residual,
     // clean it.
 
     Array<Float> residualArray = residual.asArrayFloat();
-    ConvolutionEquation eqn(psf.asArrayFloat(), residualArray);
+    Array<Float> psfArray = psf.asArrayFloat();
+    Array<Float> maskArray = mask.asArrayFloat();
 
     Array<Float> delta(residualArray.shape(), 0.0);
+    Record result;
+    {
+    ScopedGILRelease release;
+
+    ConvolutionEquation eqn(psfArray, residualArray);
 
     ClarkCleanModel cleaner(delta);
-    cleaner.setMask(mask.asArrayFloat());
+    cleaner.setMask(maskArray);
     cleaner.setGain(options.asFloat("gain"));
     cleaner.setNumberIterations(options.asInt("iterations"));
     cleaner.setInitialNumberIterations(iterations);
@@ -310,7 +438,6 @@ Record clark_clean(const ValueHolder &psf, const ValueHolder &residual,
     cleaner.setSpeedup(0.0);
     cleaner.singleSolve(eqn, residualArray);
 
-    Record result;
     result.define("iterations", cleaner.numberIterations());
     result.define("delta", delta);
 
@@ -320,7 +447,9 @@ Record clark_clean(const ValueHolder &psf, const ValueHolder &residual,
     Array<Float> tmp;
     cleaner.getModel(tmp);
     AlwaysAssert(allTrue(delta == tmp), AipsError);
+    }
 
+    check_signals();
     return result;
 }
 
@@ -383,9 +512,9 @@ ValueHolder average_response(const CASAContext &context)
 void begin_degrid(CASAContext &context, const Record &coordinates,
     const ValueHolder &image)
 {
-//     ScopedGILRelease __release;
-//     HANDLE_SIGINT(__release)
-    
+    {
+    ScopedGILRelease release(context.releaseGIL);
+
     CountedPtr<CoordinateSystem> tmp_coordinates =
         CountedPtr<CoordinateSystem>(CoordinateSystem::restore(coordinates,
         ""));
@@ -402,13 +531,16 @@ void begin_degrid(CASAContext &context, const Record &coordinates,
     PtrBlock<ImageInterface<Float> * > images(1);
     images[0] = &context.image;
     context.ft->initializeToVis(images, False);
+    }
 
+    check_signals();
 }
 
 Record degrid(CASAContext &context, const Record &chunk)
 {
-//     ScopedGILRelease __release;
-//     HANDLE_SIGINT(__release)
+    Record result;
+    {
+    ScopedGILRelease release(context.releaseGIL);
 
     // Update temporary VisBuffer.
     context.buffer->setChunk(chunk.asArrayInt("ANTENNA1"),
@@ -424,17 +556,21 @@ Record degrid(CASAContext &context, const Record &chunk)
     // Degrid into buffer.
     context.ft->get(*context.buffer);
 
-    Record result;
     result.define("data", context.buffer->modelVisCube());
+    }
+
+    check_signals();
     return result;
 }
 
 void end_degrid(CASAContext &context)
 {
-//     ScopedGILRelease __release;
-//     HANDLE_SIGINT(__release)
-
+    {
+    ScopedGILRelease release(context.releaseGIL);
     context.ft->finalizeToVis();
+    }
+
+    check_signals();
 }
 
 //void begin_grid(CASAContext &context, const ValueHolder &shape,
@@ -444,6 +580,9 @@ void begin_grid(CASAContext &context, const ValueHolder &shape,
 {
     context.psf = psf;
 
+    {
+    ScopedGILRelease release(context.releaseGIL);
+
     CountedPtr<CoordinateSystem> tmp_coordinates =
         CountedPtr<CoordinateSystem>(CoordinateSystem::restore(coordinates,
         ""));
@@ -478,11 +617,17 @@ void begin_grid(CASAContext &context, const ValueHolder &shape,
 
     // Grid data.
     //context.ft->put(*context.buffer, -1, context.psf, FTMachine::OBSERVED);
+    }
+
+    check_signals();
 }
 
 //Record grid(CASAContext &context, const Record &chunk, bool normalize)
 void grid(CASAContext &context, const Record &chunk)
 {
+    {
+    ScopedGILRelease release(context.releaseGIL);
+
     // Update temporary VisBuffer.
     context.buffer->setChunk(chunk.asArrayInt("ANTENNA1"),
         chunk.asArrayInt("ANTENNA2"),
@@ -497,21 +642,158 @@ void grid(CASAContext &context, const Record &chunk)
 
     // Grid data.
     context.ft->put(*context.buffer, -1, context.psf, FTMachine::OBSERVED);
+    }
 
+    check_signals();
 }
 
 Record end_grid(CASAContext &context, bool normalize)
 {
+    Record result;
+    {
+    ScopedGILRelease release(context.releaseGIL);
+
     context.ft->finalizeToSky();
 
     context.ft->getImages(context.weight, normalize);
 
-    Record result;
     result.define("weight", context.weight);
     result.define("image", context.image.get());
+    }
+
+    check_signals();
     return result;
 }
 
+// Drops the references of the VisBufferStub to the chunk arrays when going out
+// of scope, also when gridding or degridding throws an exception.
+class ScopedChunk
+{
+public:
+    explicit ScopedChunk(VisBufferStub &buffer)
+        :   m_buffer(buffer)
+    {
+    }
+
+    ~ScopedChunk()
+    {
+        m_buffer.releaseChunk();
+    }
+
+private:
+    ScopedChunk(const ScopedChunk &);
+    ScopedChunk &operator=(const ScopedChunk &);
+
+    VisBufferStub   &m_buffer;
+};
+
+// Check the shapes of the arrays that make up a chunk. Shapes are in casacore
+// (Fortran) order.
+void check_chunk_shape(const IPosition &antenna1, const IPosition &antenna2,
+    const IPosition &uvw, const IPosition &time,
+    const IPosition &timeCentroid, const IPosition &flagRow,
+    const IPosition &imagingWeight, const IPosition &flag)
+{
+    AlwaysAssert(time.size() == 1, AipsError);
+    const IPosition nRow(1, time[0]);
+    AlwaysAssert(antenna1.isEqual(nRow), AipsError);
+    AlwaysAssert(antenna2.isEqual(nRow), AipsError);
+    AlwaysAssert(timeCentroid.isEqual(nRow), AipsError);
+    AlwaysAssert(flagRow.isEqual(nRow), AipsError);
+    AlwaysAssert(uvw.isEqual(IPosition(2, 3, time[0])), AipsError);
+    AlwaysAssert(flag.size() == 3 && flag[2] == time[0], AipsError);
+    AlwaysAssert(imagingWeight.empty() || imagingWeight.isEqual(flag),
+        AipsError);
+}
+
+// Variant of grid() that takes the columns of the chunk as separate NumPy
+// arrays, which are used in place instead of being copied into a Record.
+// If imagingWeight is None, all imaging weights are taken to be 1.0. Data
+// may only be None when computing the PSF.
+void grid_buffers(CASAContext &context, const object &antenna1,
+    const object &antenna2, const object &uvw, const object &time,
+    const object &timeCentroid, const object &flagRow,
+    const object &imagingWeight, const object &flag, const object &data)
+{
+    BufferView<Int> viewAntenna1(antenna1, "ANTENNA1");
+    BufferView<Int> viewAntenna2(antenna2, "ANTENNA2");
+    BufferView<Double> viewUVW(uvw, "UVW");
+    BufferView<Double> viewTime(time, "TIME");
+    BufferView<Double> viewTimeCentroid(timeCentroid, "TIME_CENTROID");
+    BufferView<Bool> viewFlagRow(flagRow, "FLAG_ROW");
+    BufferView<Float> viewImagingWeight(imagingWeight, "IMAGING_WEIGHT_CUBE");
+    BufferView<Bool> viewFlag(flag, "FLAG");
+    BufferView<Complex> viewData(data, "DATA");
+
+    check_chunk_shape(viewAntenna1.array().shape(),
+        viewAntenna2.array().shape(), viewUVW.array().shape(),
+        viewTime.array().shape(), viewTimeCentroid.array().shape(),
+        viewFlagRow.array().shape(), viewImagingWeight.array().shape(),
+        viewFlag.array().shape());
+    AlwaysAssert(context.psf || !viewData.array().empty(), AipsError);
+    AlwaysAssert(viewData.array().empty()
+        || viewData.array().shape().isEqual(viewFlag.array().shape()),
+        AipsError);
+
+    {
+    ScopedGILRelease release(context.releaseGIL);
+    ScopedChunk chunk(*context.buffer);
+
+    context.buffer->setChunk(viewAntenna1.array(), viewAntenna2.array(),
+        viewUVW.array(), viewTime.array(), viewTimeCentroid.array(),
+        viewFlagRow.array(), viewImagingWeight.array(), viewFlag.array(),
+        viewData.array(), false);
+
+    context.ft->put(*context.buffer, -1, context.psf, FTMachine::OBSERVED);
+    }
+
+    check_signals();
+}
+
+// Variant of degrid() that takes the columns of the chunk as separate NumPy
+// arrays. The model visibilities are written into data, which should be a
+// writable complex64 array of the same shape as flag. If imagingWeight is
+// None, all imaging weights are taken to be 1.0.
+void degrid_buffers(CASAContext &context, const object &antenna1,
+    const object &antenna2, const object &uvw, const object &time,
+    const object &timeCentroid, const object &flagRow,
+    const object &imagingWeight, const object &flag, const object &data)
+{
+    BufferView<Int> viewAntenna1(antenna1, "ANTENNA1");
+    BufferView<Int> viewAntenna2(antenna2, "ANTENNA2");
+    BufferView<Double> viewUVW(uvw, "UVW");
+    BufferView<Double> viewTime(time, "TIME");
+    BufferView<Double> viewTimeCentroid(timeCentroid, "TIME_CENTROID");
+    BufferView<Bool> viewFlagRow(flagRow, "FLAG_ROW");
+    BufferView<Float> viewImagingWeight(imagingWeight, "IMAGING_WEIGHT_CUBE");
+    BufferView<Bool> viewFlag(flag, "FLAG");
+    BufferView<Complex> viewData(data, "DATA", true);
+
+    check_chunk_shape(viewAntenna1.array().shape(),
+        viewAntenna2.array().shape(), viewUVW.array().shape(),
+        viewTime.array().shape(), viewTimeCentroid.array().shape(),
+        viewFlagRow.array().shape(), viewImagingWeight.array().shape(),
+        viewFlag.array().shape());
+    AlwaysAssert(viewData.array().shape().isEqual(viewFlag.array().shape()),
+        AipsError);
+
+    {
+    ScopedGILRelease release(context.releaseGIL);
+    ScopedChunk chunk(*context.buffer);
+
+    // Degrid directly into the output array.
+    viewData.array().set(Complex(0.0, 0.0));
+    context.buffer->setChunk(viewAntenna1.array(), viewAntenna2.array(),
+        viewUVW.array(), viewTime.array(), viewTimeCentroid.array(),
+        viewFlagRow.array(), viewImagingWeight.array(), viewFlag.array(),
+        viewData.array(), false);
+
+    context.ft->get(*context.buffer);
+    }
+
+    check_signals();
+}
+
 // void init_cf(CASAContext &context, const ValueHolder &shape,
 //     const Record &coordinates)
 // {
@@ -898,6 +1180,30 @@ BOOST_PYTHON_MODULE(_casaimwrap)
         (boost::python::arg("context"),
         boost::python::arg("chunk")));
 
+    def("grid_buffers", LOFAR::casaimwrap::grid_buffers,
+        (boost::python::arg("context"),
+        boost::python::arg("antenna1"),
+        boost::python::arg("antenna2"),
+        boost::python::arg("uvw"),
+        boost::python::arg("time"),
+        boost::python::arg("time_centroid"),
+        boost::python::arg("flag_row"),
+        boost::python::arg("imaging_weight"),
+        boost::python::arg("flag"),
+        boost::python::arg("data")));
+
+    def("degrid_buffers", LOFAR::casaimwrap::degrid_buffers,
+        (boost::python::arg("context"),
+        boost::python::arg("antenna1"),
+        boost::python::arg("antenna2"),
+        boost::python::arg("uvw"),
+        boost::python::arg("time"),
+        boost::python::arg("time_centroid"),
+        boost::python::arg("flag_row"),
+        boost::python::arg("imaging_weight"),
+        boost::python::arg("flag"),
+        boost::python::arg("data")));
+
     def("end_grid", LOFAR::casaimwrap::end_grid,
         (boost::python::arg("context"),
 	boost::python::arg("normalize")));
@@ -0,0 +1,227 @@
+"""Tests of the release of the GIL by casaimwrap.
+
+Usage: GYIMAGER_TEST_MS=<measurement> python -m unittest discover -s tests
+
+A casaimwrap context can only be created for a (LOFAR) measurement set, which
+is taken from the GYIMAGER_TEST_MS environment variable. The tests are skipped
+if it is not set, or if casaimwrap cannot be imported. The visibilities
+gridded are synthetic: the rows of the measurement are only used for their
+antennas and time stamps.
+
+If the A-term is implemented in Python (ATermPython), the GIL is not released,
+because the FTMachine calls back into Python without acquiring it. The
+ATermPython tests only check that gridding with concurrent Python threads
+completes; they are skipped if the A-term module used by the gyimager
+commands (imager.myaterm) cannot be imported.
+"""
+
+import os
+import sys
+import time
+import signal
+import threading
+import unittest
+import numpy
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+try:
+    import _casaimwrap as casaimwrap
+    import pyrap.images
+    import pyrap.tables
+except ImportError:
+    casaimwrap = None
+
+try:
+    import imager.myaterm as myaterm
+except ImportError:
+    myaterm = None
+
+_MEASUREMENT = os.environ.get("GYIMAGER_TEST_MS")
+
+# Number of synthetic rows gridded per call, and the image size.
+_ROWS = 200000
+_PIXELS = 1024
+
+# Minimum duration (s) of a grid call for the tests to be meaningful.
+_MIN_DURATION = 0.05
+
+def _processor(aterm_python = False):
+    """Return a casa data processor for the test measurement. Unless
+    aterm_python is True, the A-term is not implemented in Python, such that
+    the GIL is released."""
+    from gyimager.processors.casa.data_processor_low_level import \
+        DataProcessorLowLevel
+    options = {"w_max": 10000.0, "padding": 1.0, "image": "test",
+        "weighttype": "natural", "gridding.ATerm.name": "ATermLofar",
+        "ATermPython.module": "", "ATermPython.class": ""}
+    if aterm_python:
+        # The A-term of the gyimager commands.
+        options["gridding.ATerm.name"] = "ATermPython"
+        options["ATermPython.module"] = "imager.myaterm"
+        options["ATermPython.class"] = "MyATerm"
+    return DataProcessorLowLevel(_MEASUREMENT, options)
+
+def _begin_grid(processor):
+    """Start gridding onto a _PIXELS x _PIXELS image."""
+    from gyimager.algorithms import util
+    shape = (1, 4, _PIXELS, _PIXELS)
+    freq = processor.channel_frequency()
+    delta_px = util.image_configuration(2.0 * util.full_width_half_max(70.0,
+        numpy.max(freq)), numpy.max(freq), 10000.0)[1]
+    coordinates = pyrap.images.coordinates.coordinatesystem(
+        casaimwrap.make_coordinate_system(shape[2:], [delta_px, delta_px],
+        processor.phase_reference(), freq, processor.channel_width()))
+    casaimwrap.begin_grid(processor._context, shape, coordinates.dict(),
+        False)
+
+def _synthetic_buffers(processor, nrow):
+    """Return the arguments of casaimwrap.grid_buffers() (after the context)
+    for nrow rows with random UVW coordinates and visibilities, on the
+    baselines and time stamps of the measurement."""
+    from gyimager.processors.casa.data_processor_low_level import \
+        _chunk_buffers
+    ms = pyrap.tables.table(_MEASUREMENT)
+    sample = min(ms.nrows(), 10000)
+    index = numpy.arange(nrow) % sample
+    n_channel = len(processor.channel_frequency())
+    n_correlation = ms.getcell("FLAG", 0).shape[1]
+    random = numpy.random.RandomState(0)
+
+    chunk = {}
+    for name in ["ANTENNA1", "ANTENNA2", "TIME", "TIME_CENTROID"]:
+        chunk[name] = ms.getcol(name, 0, sample)[index]
+    chunk["UVW"] = random.uniform(-2000.0, 2000.0, (nrow, 3))
+    chunk["UVW"][:, 2] *= 0.01
+    chunk["FLAG_ROW"] = numpy.zeros(nrow, dtype=bool)
+    chunk["FLAG"] = numpy.zeros((nrow, n_channel, n_correlation), dtype=bool)
+    chunk["IMAGING_WEIGHT_CUBE"] = None
+    data = (random.normal(size=chunk["FLAG"].shape) + 1j
+        * random.normal(size=chunk["FLAG"].shape)).astype(numpy.complex64)
+    return _chunk_buffers(chunk) + [data]
+
+@unittest.skipIf(casaimwrap is None, "casaimwrap is not available")
+@unittest.skipIf(not _MEASUREMENT, "GYIMAGER_TEST_MS is not set")
+class GILReleaseTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.processor = _processor()
+        cls.buffers = _synthetic_buffers(cls.processor, _ROWS)
+
+    def _grid(self):
+        casaimwrap.grid_buffers(self.processor._context, *self.buffers)
+
+    def _end_grid(self):
+        casaimwrap.end_grid(self.processor._context, False)
+
+    def test_python_thread_runs_during_grid(self):
+        inside = threading.Event()
+        done = threading.Event()
+        interval = []
+
+        def _run():
+            _begin_grid(self.processor)
+            inside.set()
+            begin = time.time()
+            try:
+                self._grid()
+            finally:
+                interval.extend([begin, time.time()])
+                done.set()
+            self._end_grid()
+
+        # Count in Python while the other thread grids, and only keep the
+        # iterations that fall within the grid call. If the GIL were held
+        # during the call, the counter could only advance before the call
+        # starts and after it returns.
+        thread = threading.Thread(target = _run)
+        thread.start()
+        inside.wait()
+        stamps = []
+        while not done.is_set():
+            stamps.append(time.time())
+        thread.join()
+
+        (begin, end) = interval
+        if end - begin < _MIN_DURATION:
+            self.skipTest("grid call too short (%.3f s)" % (end - begin))
+        stamps = numpy.array(stamps)
+        count = numpy.count_nonzero((stamps > begin) & (stamps < end))
+        self.assertGreater(count, 10000 * (end - begin))
+
+    def test_sigint_raised_after_grid(self):
+        # Python's own SIGINT handler only records the signal while the GIL
+        # is released, check_signals() raises it when the call returns.
+        _begin_grid(self.processor)
+        begin = time.time()
+        self._grid()
+        delay = (time.time() - begin) / 4.0
+        self._end_grid()
+        if delay < _MIN_DURATION / 4.0:
+            self.skipTest("grid call too short (%.3f s)" % (4.0 * delay))
+
+        handler = signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            timer = threading.Timer(delay, os.kill, (os.getpid(),
+                signal.SIGINT))
+            returned = False
+            try:
+                _begin_grid(self.processor)
+                timer.start()
+                self._grid()
+                returned = True
+                # A signal that arrives after the call is raised here.
+                time.sleep(4.0 * delay)
+            except KeyboardInterrupt:
+                pass
+            timer.join()
+            self._end_grid()
+            self.assertFalse(returned, "KeyboardInterrupt was not raised by"
+                " the grid call")
+        finally:
+            signal.signal(signal.SIGINT, handler)
+
+@unittest.skipIf(casaimwrap is None, "casaimwrap is not available")
+@unittest.skipIf(myaterm is None, "imager.myaterm is not available")
+@unittest.skipIf(not _MEASUREMENT, "GYIMAGER_TEST_MS is not set")
+class ATermPythonTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.processor = _processor(aterm_python = True)
+        cls.buffers = _synthetic_buffers(cls.processor, _ROWS // 10)
+
+    def test_grid_with_python_threads(self):
+        # The A-term is evaluated in Python from within the call, while
+        # another Python thread runs. The call should neither deadlock nor
+        # crash, and produce a finite image.
+        done = threading.Event()
+        result = []
+
+        def _count():
+            count = 0
+            while not done.is_set():
+                count += 1
+
+        def _run():
+            _begin_grid(self.processor)
+            casaimwrap.grid_buffers(self.processor._context, *self.buffers)
+            result.append(casaimwrap.end_grid(self.processor._context,
+                False))
+
+        counter = threading.Thread(target = _count)
+        counter.start()
+        try:
+            thread = threading.Thread(target = _run)
+            thread.start()
+            thread.join(600.0)
+            self.assertFalse(thread.is_alive(), "grid call did not complete")
+        finally:
+            done.set()
+            counter.join()
+
+        self.assertEqual(len(result), 1)
+        self.assertTrue(numpy.all(numpy.isfinite(result[0]["image"])))
+
+if __name__ == "__main__":
+    unittest.main()